@@ -111,6 +111,7 @@ class MNIST(Dataset):
 
         self.X = X
         self.O = O
+        self.idx = np.arange(self.n)
 
         self.mean_image = self.X.mean(axis=0)
 
@@ -148,6 +149,7 @@ class MNIST(Dataset):
         rnd_idx = np.random.permutation(np.arange(0, self.n, 1))
         self.X = self.X[rnd_idx, :]
         self.O = self.O[rnd_idx, :]
+        self.idx = self.idx[rnd_idx]
 
     def next(self, batch_size=None):
         '''Pull next batch.
@@ -156,7 +158,8 @@ class MNIST(Dataset):
             batch_size: int (Optional).
 
         Returns:
-            rval: OrderedDict of data.
+            rval: OrderedDict of data, labels, and the row `index` of each
+                example in the unshuffled dataset.
 
         '''
         if batch_size is None:
@@ -170,6 +173,7 @@ class MNIST(Dataset):
 
         x = self.X[self.pos:self.pos+batch_size]
         y = self.O[self.pos:self.pos+batch_size]
+        idx = self.idx[self.pos:self.pos+batch_size]
 
         self.pos += batch_size
         if self.pos + batch_size > self.n:
@@ -178,6 +182,7 @@ class MNIST(Dataset):
         rval = OrderedDict()
         rval[self.name] = x
         rval['label'] = y
+        rval['index'] = idx
 
         return rval
 
@@ -5,6 +5,7 @@ Inference methods.
 from air import AIR, DeepAIR
 from gdir import MomentumGDIR
 from rws import RWS, DeepRWS
+from vimco import VIMCO
 
 
 def resolve(model, inference_method=None, deep=False, **inference_args):
@@ -16,6 +17,8 @@ def resolve(model, inference_method=None, deep=False, **inference_args):
             return DeepRWS(model, **inference_args)
         elif inference_method == 'air':
             return DeepAIR(model, **inference_args)
+        elif inference_method == 'vimco':
+            raise NotImplementedError(inference_method)
         else:
             raise ValueError(inference_method)
     else:
@@ -25,5 +28,7 @@ def resolve(model, inference_method=None, deep=False, **inference_args):
             return RWS(model, **inference_args)
         elif inference_method == 'air':
             return AIR(model, **inference_args)
+        elif inference_method == 'vimco':
+            return VIMCO(model, **inference_args)
         else:
             raise ValueError(inference_method)
@@ -3,11 +3,18 @@ Adaptive importance sampling inference.
 '''
 
 from collections import OrderedDict
+import numpy as np
 import theano
+from theano.ifelse import ifelse
 from theano import tensor as T
 
 from irvi import IRVI, DeepIRVI
-from utils import floatX
+from utils import floatX, intX
+from utils.binary import binary_samples
+from utils.importance import (
+    normalized_weights,
+    weighted_sum
+)
 from utils.tools import (
     scan,
     warn_kwargs
@@ -19,32 +26,195 @@ class AIR(IRVI):
                  model,
                  name='AIR',
                  pass_gradients=False,
+                 ess_target=None,
+                 inference_sample_sizes=None,
                  **kwargs):
 
         super(AIR, self).__init__(model, name=name,
                                   pass_gradients=pass_gradients,
                                   **kwargs)
 
-    def step_infer(self, r, q, y, *params):
+        self.ess_target = ess_target
+        if ess_target is not None:
+            if self.inference_tol is not None:
+                raise NotImplementedError('Adaptive sample sizes do not '
+                                          'support early exit')
+            if inference_sample_sizes is None:
+                n = self.n_inference_samples
+                inference_sample_sizes = [max(1, int(n * f))
+                                          for f in [0.25, 0.5, 1, 2, 4]]
+            inference_sample_sizes = sorted(set(inference_sample_sizes))
+        self.inference_sample_sizes = inference_sample_sizes
+
+    def step_terms(self, r, q, y, *params):
+        '''
+        Samples h from q and computes the terms of their importance weights.
+        '''
         model = self.model
         prior_params = model.get_prior_params(*params)
 
-        h        = (r <= q[None, :, :]).astype(floatX)
+        h        = binary_samples(r, q[None, :, :])
         py       = model.p_y_given_h(h, *params)
         log_py_h = -model.conditional.neg_log_prob(y[None, :, :], py)
         log_ph   = -model.prior.step_neg_log_prob(h, *prior_params)
         log_qh   = -model.posterior.neg_log_prob(h, q[None, :, :])
 
-        log_p     = log_py_h + log_ph - log_qh
-        log_p_max = T.max(log_p, axis=0, keepdims=True)
+        return h, py, log_py_h, log_ph, log_qh
+
+    def step_weights(self, r, q, y, *params):
+        '''
+        Samples h from q and computes their normalized importance weights.
+        '''
+        h, _, log_py_h, log_ph, log_qh = self.step_terms(r, q, y, *params)
+
+        log_p      = log_py_h + log_ph - log_qh
+        _, w_tilde = normalized_weights(log_p)
+        return h, w_tilde, log_p
+
+    def step_infer(self, r, q, y, *params):
+        h, w_tilde, log_p = self.step_weights(r, q, y, *params)
 
-        w       = T.exp(log_p - log_p_max)
-        w_tilde = w / w.sum(axis=0, keepdims=True)
         cost    = log_p.mean()
-        q_ = (w_tilde[:, :, None] * h).sum(axis=0)
+        q_ = weighted_sum(w_tilde, h)
         q  = self.inference_rate * q_ + (1 - self.inference_rate) * q
         return q, cost
 
+    def step_infer_adaptive(self, q, level, y, *params):
+        '''
+        AIR step with the number of samples chosen from the previous ESS.
+
+        The batch-mean effective sample size decides the next level in
+        `inference_sample_sizes`: it grows while below `ess_target` and
+        shrinks when the next smaller size would still clear it.
+        '''
+        model = self.model
+        sizes = T.constant(
+            np.array(self.inference_sample_sizes).astype(intX))
+
+        n_samples = sizes[level]
+        r = model.init_inference_samples(
+            size=(n_samples, q.shape[0], model.dim_h))
+        h, w_tilde, log_p = self.step_weights(r, q, y, *params)
+
+        cost = log_p.mean()
+        q_   = weighted_sum(w_tilde, h)
+        q    = self.inference_rate * q_ + (1 - self.inference_rate) * q
+
+        ess      = 1. / (w_tilde ** 2).sum(axis=0)
+        ess_mean = ess.mean()
+        n_smaller = sizes[T.maximum(level - 1, 0)].astype(floatX)
+
+        grow   = T.and_(T.lt(ess_mean, self.ess_target),
+                        T.lt(level, sizes.shape[0] - 1))
+        shrink = T.and_(T.ge(ess_mean * n_smaller / n_samples.astype(floatX),
+                             self.ess_target),
+                        T.gt(level, 0))
+        level  = level + grow.astype(intX) - shrink.astype(intX)
+
+        return q, level, ess, n_samples, cost
+
+    def inference(self, x, y, q0=None, n_inference_steps=None):
+        if n_inference_steps is not None or self.ess_target is None or (
+                self.n_inference_steps == 0):
+            return super(AIR, self).inference(
+                x, y, q0=q0, n_inference_steps=n_inference_steps)
+
+        model = self.model
+
+        if q0 is None:
+            q0 = self.init_variational_inference(x)
+
+        sizes = self.inference_sample_sizes
+        level = min(range(len(sizes)),
+                    key=lambda i: abs(sizes[i] - self.n_inference_samples))
+
+        print ('Doing %d inference steps of %s and a rate of %.5f with %s '
+               'inference samples (ESS target %.2f)'
+               % (self.n_inference_steps, self.name, self.inference_rate,
+                  sizes, self.ess_target))
+
+        outputs_info = [q0, T.constant(level).astype(intX), None, None, None]
+        non_seqs = [y] + model.get_params()
+
+        outs, updates = scan(
+            self.step_infer_adaptive, [], outputs_info, non_seqs,
+            self.n_inference_steps, self.name + '_infer_adaptive'
+        )
+        qs, _, ess, n_samples, i_costs = outs
+        qs = T.concatenate([q0[None, :, :], qs], axis=0)
+
+        if self.pass_gradients:
+            constants = []
+        else:
+            constants = [qs]
+
+        rval = OrderedDict(
+            qk=qs[-1],
+            qs=qs,
+            i_costs=i_costs,
+            ess=ess,
+            n_samples=n_samples
+        )
+
+        return rval, constants, updates
+
+    def inference_fused(self, x, y, q0=None):
+        '''
+        AIR inference with the last step taken outside of `scan`.
+
+        Also returns the samples, conditional output and log probabilities
+        of the last step, which `SBN.__call__` can use (`state`) instead of
+        drawing a fresh set of posterior samples. These are under the
+        proposal of the last step, `qs[-2]`, and there are
+        `n_inference_samples` of them.
+        '''
+        if self.ess_target is not None:
+            raise NotImplementedError('Fused bounds need a fixed number of '
+                                      'inference samples')
+        if self.n_inference_steps < 1:
+            raise ValueError('Fused bounds need at least one inference step')
+
+        model = self.model
+
+        rval, constants, updates = self.inference(
+            x, y, q0=q0, n_inference_steps=self.n_inference_steps - 1)
+        q = rval['qk']
+
+        print 'Taking the last step of %s outside of `scan`' % self.name
+        r = model.init_inference_samples(
+            (self.n_inference_samples, x.shape[0], model.dim_h))
+        h, py, log_py_h, log_ph, log_qh = self.step_terms(
+            r, q, y, *model.get_params())
+
+        log_p      = log_py_h + log_ph - log_qh
+        _, w_tilde = normalized_weights(log_p)
+        cost       = log_p.mean()
+        q_ = weighted_sum(w_tilde, h)
+        qk = self.inference_rate * q_ + (1 - self.inference_rate) * q
+
+        qs = T.concatenate([rval['qs'], qk[None, :, :]], axis=0)
+        if self.n_inference_steps == 1:
+            i_costs = [cost]
+        elif isinstance(rval['i_costs'], list):
+            i_costs = rval['i_costs'] + [cost]
+        else:
+            i_costs = T.concatenate([rval['i_costs'], cost[None]])
+
+        if not self.pass_gradients:
+            constants = [q, qs]
+
+        rval.update(qk=qk, qs=qs, i_costs=i_costs)
+        state = OrderedDict(
+            q=q,
+            h=h,
+            py=py,
+            log_py_h=log_py_h,
+            log_ph=log_ph,
+            log_qkh=log_qh
+        )
+
+        return rval, constants, updates, state
+
     def init_infer(self, q):
         return []
 
@@ -60,13 +230,21 @@ class DeepAIR(DeepIRVI):
                  model,
                  name='AIR',
                  pass_gradients=False,
+                 block_schedule=None,
                  **kwargs):
 
         super(DeepAIR, self).__init__(model, name=name,
                                       pass_gradients=pass_gradients,
                                       **kwargs)
 
+        if block_schedule not in [None, 'round_robin', 'largest_change']:
+            raise ValueError(block_schedule)
+        self.block_schedule = block_schedule
+
     def step_infer(self, *params):
+        if self.block_schedule is not None:
+            return self.step_infer_block(*params)
+
         model = self.model
 
         params       = list(params)
@@ -93,23 +271,140 @@ class DeepAIR(DeepIRVI):
             log_py_h += -model.conditionals[l].neg_log_prob(ys[l], p_ys[l])
             log_qh += -model.posteriors[l].neg_log_prob(hs[l], qs[l][None, :, :])
 
-        log_p     = log_py_h + log_ph - log_qh
-        log_p_max = T.max(log_p, axis=0, keepdims=True)
-
-        w       = T.exp(log_p - log_p_max)
-        w_tilde = w / w.sum(axis=0, keepdims=True)
-        cost = w.mean()
+        log_p          = log_py_h + log_ph - log_qh
+        log_z, w_tilde = normalized_weights(log_p)
+        # Mean of exp(log_p - max), from the normalizer.
+        cost = (T.exp(log_z - log_p.max(axis=0)).mean()
+                / log_p.shape[0].astype(floatX))
 
         for q, h in zip(qs, hs):
-            q_ = (w_tilde[:, :, None] * h).sum(axis=0)
+            q_ = weighted_sum(w_tilde, h)
             new_qs.append(self.inference_rate * q_ + (1 - self.inference_rate) * q)
 
         return tuple(new_qs) + (cost,)
 
-    def init_infer(self, qs):
-        return []
+    def step_infer_block(self, *params):
+        '''
+        Block-coordinate AIR step that refines a single layer.
+
+        Only the chosen layer resamples its `h` and recomputes its
+        conditional. The other layers reuse the samples, conditional outputs
+        and log probabilities cached from their last refinement; only the
+        terms that depend on the chosen layer's samples are recomputed. The
+        layer is chosen round-robin or as the one whose last update changed
+        `q` the most (unvisited layers first).
+        '''
+        model = self.model
+        L     = model.n_layers
+
+        params       = list(params)
+        rs           = params[:L]
+        qs           = params[L:2*L]
+        hs           = params[2*L:3*L]
+        p_ys         = params[3*L:4*L]
+        log_qhs      = params[4*L:5*L]
+        log_py_hs    = params[5*L:6*L]
+        log_ph       = params[6*L]
+        dq           = params[6*L+1]
+        t            = params[6*L+2]
+        y            = params[6*L+3]
+        params       = params[6*L+4:]
+        prior_params = model.get_prior_params(*params)
+
+        if self.block_schedule == 'round_robin':
+            layer = t % L
+        elif self.block_schedule == 'largest_change':
+            layer = T.argmax(dq)
+        else:
+            raise ValueError(self.block_schedule)
+
+        new_hs      = []
+        new_p_ys    = []
+        new_log_qhs = []
+        for l in xrange(L):
+            h      = (rs[l] <= qs[l][None, :, :]).astype(floatX)
+            p_y    = model.p_y_given_h(h, l, *params)
+            log_qh = -model.posteriors[l].neg_log_prob(h, qs[l][None, :, :])
+            h, p_y, log_qh = ifelse(T.eq(layer, l),
+                                    [h, p_y, log_qh],
+                                    [hs[l], p_ys[l], log_qhs[l]])
+            new_hs.append(h)
+            new_p_ys.append(p_y)
+            new_log_qhs.append(log_qh)
+
+        # p(h_{l-1} | h_l) changes with either layer's samples.
+        ys = [y[None, :, :]] + new_hs[:-1]
+        new_log_py_hs = []
+        for l in xrange(L):
+            log_py_h = -model.conditionals[l].neg_log_prob(ys[l], new_p_ys[l])
+            changed = T.eq(layer, l)
+            if l > 0:
+                changed = T.or_(changed, T.eq(layer, l - 1))
+            new_log_py_hs.append(ifelse(changed, log_py_h, log_py_hs[l]))
+
+        log_ph = ifelse(
+            T.eq(layer, L - 1),
+            -model.prior.step_neg_log_prob(new_hs[-1], *prior_params),
+            log_ph)
+
+        log_p          = sum(new_log_py_hs) + log_ph - sum(new_log_qhs)
+        log_z, w_tilde = normalized_weights(log_p)
+        # Mean of exp(log_p - max), from the normalizer.
+        cost = (T.exp(log_z - log_p.max(axis=0)).mean()
+                / log_p.shape[0].astype(floatX))
+
+        new_qs = []
+        dqs    = []
+        for l, (q, h) in enumerate(zip(qs, new_hs)):
+            q_    = weighted_sum(w_tilde, h)
+            q_new = self.inference_rate * q_ + (1 - self.inference_rate) * q
+            q_new, dq_l = ifelse(T.eq(layer, l),
+                                 [q_new, abs(q_new - q).mean()],
+                                 [q, dq[l]])
+            new_qs.append(q_new)
+            dqs.append(dq_l)
+
+        return (tuple(new_qs) + tuple(new_hs) + tuple(new_p_ys)
+                + tuple(new_log_qhs) + tuple(new_log_py_hs)
+                + (log_ph, T.stack(dqs), t + 1, cost))
+
+    def init_infer(self, qs, y):
+        '''
+        Initial samples and cached terms for block-coordinate inference.
+        '''
+        if self.block_schedule is None:
+            return []
+
+        model = self.model
+        print ('Refining one layer per step of %s (%s)'
+               % (self.name, self.block_schedule))
+
+        hs        = []
+        p_ys      = []
+        log_qhs   = []
+        log_py_hs = []
+        for l, q in enumerate(qs):
+            r = model.posteriors[l].distribution.prototype_samples(
+                (self.n_inference_samples, q.shape[0], model.dim_hs[l]))
+            h = (r <= q[None, :, :]).astype(floatX)
+            hs.append(h)
+            p_ys.append(model.conditionals[l].feed(h))
+            log_qhs.append(-model.posteriors[l].neg_log_prob(h, q[None, :, :]))
+
+        ys = [y[None, :, :]] + hs[:-1]
+        for l in xrange(model.n_layers):
+            log_py_hs.append(
+                -model.conditionals[l].neg_log_prob(ys[l], p_ys[l]))
+        log_ph = -model.prior.neg_log_prob(hs[-1])
+
+        dq = T.alloc(np.float32(np.inf), model.n_layers).astype(floatX)
+        t  = T.constant(0).astype(intX)
+
+        return hs + p_ys + log_qhs + log_py_hs + [log_ph, dq, t]
 
     def unpack_infer(self, outs):
+        if self.block_schedule is not None:
+            return outs[:self.model.n_layers], outs[-1]
         return outs[:-1], outs[-1]
 
     def params_infer(self):
@@ -7,6 +7,11 @@ import theano
 from theano import tensor as T
 
 from irvi import IRVI
+from models.distributions import (
+    flatten_params,
+    map_params,
+    unflatten_params
+)
 from utils import floatX
 from utils.tools import (
     scan,
@@ -39,7 +44,9 @@ class GDIR(IRVI):
         y_energy = -log_py_h.mean(axis=0)
 
         cost = (y_energy + KL_q_p).mean(axis=0)
-        grad = theano.grad(cost, wrt=q, consider_constant=consider_constant)
+        grads = theano.grad(cost, wrt=flatten_params([q]),
+                            consider_constant=consider_constant)
+        grad, = unflatten_params(grads, [q])
 
         cost = y_energy.mean()
         return cost, grad
@@ -53,12 +60,12 @@ class MomentumGDIR(GDIR):
     def step_infer(self, epsilon, q, dq_, y, m, *params):
         l = self.inference_rate
         cost, grad = self.e_step(epsilon, q, y, *params)
-        dq = (-l * grad + m * dq_).astype(floatX)
-        q = (q + dq).astype(floatX)
+        dq = map_params(lambda g, d: (-l * g + m * d).astype(floatX), grad, dq_)
+        q = map_params(lambda q, d: (q + d).astype(floatX), q, dq)
         return q, dq, cost
 
     def init_infer(self, q):
-        return [T.zeros_like(q)]
+        return [map_params(T.zeros_like, q)]
 
     def unpack_infer(self, outs):
         qs, dqs, costs = outs
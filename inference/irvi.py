@@ -3,16 +3,83 @@ Iterative refinement of the approximate posterior
 '''
 
 from collections import OrderedDict
+import numpy as np
 import theano
 from theano import tensor as T
 
-from utils import floatX
+from models.distributions import (
+    flatten_params,
+    map_params,
+    unflatten_params
+)
+from utils import floatX, intX
 from utils.tools import (
     scan,
     update_dict_of_lists,
     warn_kwargs
 )
 
+
+_diagnostics = ['none', 'endpoints', 'full']
+
+def structured_scan(f_scan, seqs, outputs_info, non_seqs, n_steps, name):
+    '''
+    `scan` with states that may be GaussianParams.
+
+    States are flattened into their tensors for `theano.scan`, and packed
+    again for `f_scan` and in the outputs. Outputs without a state (None in
+    `outputs_info`) are single tensors.
+    '''
+    n_seqs = len(seqs)
+    states = [o for o in outputs_info if o is not None]
+    n_flat = len(flatten_params(states))
+
+    def step(*args):
+        args = list(args)
+        outs = f_scan(*(args[:n_seqs]
+                        + unflatten_params(args[n_seqs:n_seqs+n_flat], states)
+                        + args[n_seqs+n_flat:]))
+        if isinstance(outs[-1], theano.scan_module.until):
+            return flatten_params(outs[0]), outs[1]
+        return flatten_params(outs)
+
+    outs, updates = scan(step, seqs, flatten_params(outputs_info), non_seqs,
+                         n_steps, name)
+    if not isinstance(outs, (list, tuple)):
+        outs = [outs]
+    return unflatten_params(outs, outputs_info), updates
+
+def _prepend(q0, qs):
+    '''
+    Stacks `q0` before the steps `qs`.
+    '''
+    return map_params(lambda q0, qs: T.concatenate([q0[None], qs], axis=0),
+                      q0, qs)
+
+def diagnostic_steps(n_inference_steps, stride, diagnostics):
+    '''
+    Inference steps at which `__call__` evaluates the model.
+
+    `none` evaluates the final step only, `endpoints` the first and final
+    steps, and `full` also every `stride` steps in between.
+    '''
+    if diagnostics not in _diagnostics:
+        raise ValueError(diagnostics)
+
+    if n_inference_steps > 0:
+        last = n_inference_steps - 1
+    else:
+        last = 0
+
+    if diagnostics == 'none':
+        return [last]
+    elif diagnostics == 'endpoints' or n_inference_steps <= stride or stride == 0:
+        return sorted(set([0, last]))
+    else:
+        steps = [0, 1] + range(stride, n_inference_steps, stride)
+        return steps[:-1] + [last]
+
+
 class IRVI(object):
 
     def __init__(self,
@@ -23,6 +90,10 @@ class IRVI(object):
                  n_inference_steps=20,
                  pass_gradients=True,
                  init_inference='recognition_network',
+                 inference_tol=None,
+                 convergence_criterion='q',
+                 warm_start_mix=0.5,
+                 per_step_noise=False,
                  **kwargs):
 
         self.name = name
@@ -32,6 +103,12 @@ class IRVI(object):
         self.n_inference_steps = n_inference_steps
         self.n_inference_samples = n_inference_samples
         self.pass_gradients = pass_gradients
+        self.inference_tol = inference_tol
+        if convergence_criterion not in ['q', 'i_cost']:
+            raise ValueError(convergence_criterion)
+        self.convergence_criterion = convergence_criterion
+        self.warm_start_mix = warm_start_mix
+        self.per_step_noise = per_step_noise
         warn_kwargs(self, **kwargs)
 
     def step_infer(self, *params):  raise NotImplementedError()
@@ -53,46 +130,160 @@ class IRVI(object):
 
         return q0
 
-    def inference(self, x, y, q0=None):
+    def init_warm_start(self, x, q_c):
+        '''
+        Blends cached posteriors `q_c` with the recognition network.
+
+        Rows of `q_c` containing NaN (not cached yet) fall back to the
+        recognition network output.
+        '''
+        print ('Initializing %s inference from cached posteriors (mix %.2f)'
+               % (self.name, self.warm_start_mix))
+        q_r     = self.model.posterior.feed(x)
+        missing = T.isnan(q_c)
+        filled  = T.eq(missing.sum(axis=1), 0).astype(floatX)
+        w       = self.warm_start_mix * filled[:, None]
+        q0      = w * T.switch(missing, 0., q_c) + (1. - w) * q_r
+
+        return q0
+
+    def init_step_noise(self, f_step):
+        '''
+        Wraps a scan step so that it draws its own inference noise.
+
+        The wrapped step takes the states (the first being `q`) and non
+        sequences, so no noise needs to be preallocated for all steps.
+        '''
+        model = self.model
+
+        def step(q, *params):
+            epsilon = model.init_inference_samples(
+                size=(self.n_inference_samples, q.shape[0], model.dim_h))
+            return f_step(epsilon, q, *params)
+
+        return step
+
+    def step_infer_converge(self, n_states, *params):
+        '''
+        Wraps `step_infer` with per-example convergence checking.
+
+        Rows whose update falls below `inference_tol` are frozen for the
+        remaining steps and scan exits once every row is frozen. With the
+        `q` criterion this is max |q_k - q_{k-1}| per row; with `i_cost` it
+        is the change in the (batch) inference cost.
+        '''
+        params    = list(params)
+        epsilon   = params[0]
+        states    = params[1:1+n_states]
+        done, n_steps, prev_cost = params[1+n_states:4+n_states]
+        non_seqs  = params[4+n_states:]
+
+        outs       = self.step_infer(*([epsilon] + states + non_seqs))
+        new_states = list(outs[:-1])
+        cost       = outs[-1].astype(floatX)
+
+        q, q_new = states[0], new_states[0]
+        if self.convergence_criterion == 'q':
+            dq = [abs(b - a).max(axis=a.ndim-1) for a, b
+                  in zip(flatten_params([q]), flatten_params([q_new]))]
+            converged = T.lt(reduce(T.maximum, dq), self.inference_tol)
+        elif self.convergence_criterion == 'i_cost':
+            converged = T.lt(abs(cost - prev_cost), self.inference_tol)
+        else:
+            raise ValueError(self.convergence_criterion)
+
+        for i, (state, new_state) in enumerate(zip(states, new_states)):
+            if new_state.ndim == 2:
+                new_states[i] = map_params(
+                    lambda s, s_new: T.switch(done[:, None], s, s_new),
+                    state, new_state)
+
+        n_steps = n_steps + (1 - done)
+        done    = T.or_(done, converged.astype('int8'))
+
+        return (new_states + [done, n_steps, cost],
+                theano.scan_module.until(T.all(done)))
+
+    def inference(self, x, y, q0=None, n_inference_steps=None):
 
         model = self.model
         updates = theano.OrderedUpdates()
 
+        if n_inference_steps is None:
+            n_inference_steps = self.n_inference_steps
+
         if q0 is None:
             q0 = self.init_variational_inference(x)
 
-        epsilons = model.init_inference_samples(
-            size=(self.n_inference_steps, self.n_inference_samples,
-                  x.shape[0], model.dim_h))
+        if self.per_step_noise and n_inference_steps > 1:
+            print 'Drawing %s inference noise at each step' % self.name
+            seqs = []
+        elif n_inference_steps == 0:
+            seqs = []
+        else:
+            epsilons = model.init_inference_samples(
+                size=(n_inference_steps, self.n_inference_samples,
+                      x.shape[0], model.dim_h))
+            seqs = [epsilons]
 
-        seqs = [epsilons]
         outputs_info = [q0] + self.init_infer(q0) + [None]
         non_seqs = [y] + self.params_infer() + model.get_params()
 
         print ('Doing %d inference steps of %s and a rate of %.5f with %d '
                'inference samples'
-               % (self.n_inference_steps, self.name,
+               % (n_inference_steps, self.name,
                   self.inference_rate, self.n_inference_samples))
 
-        if self.n_inference_steps > 1:
+        n_steps = None
+        if n_inference_steps > 1 and self.inference_tol is not None:
+            print ('Multiple inference steps. Using `scan` with early exit '
+                   '(tolerance %.2e on %s)'
+                   % (self.inference_tol, self.convergence_criterion))
+            n_states = len(outputs_info) - 1
+
+            def step_infer(*params):
+                return self.step_infer_converge(n_states, *params)
+
+            if len(seqs) == 0:
+                step_infer = self.init_step_noise(step_infer)
+
+            outputs_info = outputs_info[:-1] + [
+                T.zeros((x.shape[0],), dtype='int8'),
+                T.zeros((x.shape[0],), dtype=intX),
+                T.constant(np.inf).astype(floatX)]
+
+            outs, updates_i = structured_scan(
+                step_infer, seqs, outputs_info, non_seqs,
+                n_inference_steps, self.name + '_infer'
+            )
+            updates.update(updates_i)
+            n_steps = outs[n_states + 1][-1]
+            qs, i_costs = self.unpack_infer(outs[:n_states] + outs[-1:])
+            qs = _prepend(q0, qs)
+
+        elif n_inference_steps > 1:
             print 'Multiple inference steps. Using `scan`'
-            outs, updates_i = scan(
-                self.step_infer, seqs, outputs_info, non_seqs, self.n_inference_steps,
+            if len(seqs) == 0:
+                step_infer = self.init_step_noise(self.step_infer)
+            else:
+                step_infer = self.step_infer
+            outs, updates_i = structured_scan(
+                step_infer, seqs, outputs_info, non_seqs, n_inference_steps,
                 self.name + '_infer'
             )
             updates.update(updates_i)
             qs, i_costs = self.unpack_infer(outs)
-            qs = T.concatenate([q0[None, :, :], qs], axis=0)
+            qs = _prepend(q0, qs)
 
-        elif self.n_inference_steps == 1:
+        elif n_inference_steps == 1:
             print 'Single inference step'
             inps = [epsilons[0]] + outputs_info[:-1] + non_seqs
             outs = self.step_infer(*inps)
             q, i_cost = self.unpack_infer(outs)
-            qs = T.concatenate([q0[None, :, :], q[None, :, :]], axis=0)
+            qs = _prepend(q0, q[None])
             i_costs = [i_cost]
 
-        elif self.n_inference_steps == 0:
+        elif n_inference_steps == 0:
             print 'No inference steps'
             qs = q0[None, :, :]
             i_costs = [T.constant(0.).astype(floatX)]
@@ -100,7 +291,7 @@ class IRVI(object):
         if self.pass_gradients:
             constants = []
         else:
-            constants = [qs]
+            constants = flatten_params([qs])
 
         rval = OrderedDict(
             qk=qs[-1],
@@ -108,11 +299,22 @@ class IRVI(object):
             i_costs=i_costs
         )
 
+        if n_steps is not None:
+            rval['n_steps'] = n_steps
+
         return rval, constants, updates
 
     def __call__(self, x, y,
                  stride=1,
+                 diagnostics='endpoints',
                  **model_args):
+        '''
+        Evaluates the model at the inference steps given by `diagnostics`.
+
+        With `none`, `results` only holds the final step. Otherwise it also
+        holds the first step (keys ending in `0`) and their differences
+        (`d_` keys).
+        '''
 
         model = self.model
 
@@ -121,30 +323,41 @@ class IRVI(object):
 
         qs = inference_outs['qs']
 
-        if self.n_inference_steps > stride and stride != 0:
-            steps = [0, 1] + range(stride, self.n_inference_steps, stride)
-            steps = steps[:-1] + [self.n_inference_steps - 1]
-        elif self.n_inference_steps > 0:
-            steps = [0, self.n_inference_steps - 1]
-        else:
-            steps = [0]
+        steps = diagnostic_steps(self.n_inference_steps, stride, diagnostics)
 
         full_results = OrderedDict()
         full_results['i_cost'] = []
         samples = OrderedDict()
         for i in steps:
-            qk  = qs[i]
-            results_k, samples_k, _ = model(x, y, qk, **model_args)
+            if 'n_steps' in inference_outs.keys():
+                # Scan may have exited early, so clip to the last step taken.
+                qk     = qs[T.minimum(i, qs.shape[0] - 1)]
+                i_cost = i_costs[T.minimum(i, i_costs.shape[0] - 1)]
+            else:
+                qk     = qs[i]
+                i_cost = i_costs[i]
+            results_k, samples_k, updates_k = model(x, y, qk, **model_args)
+            if isinstance(updates_k, theano.OrderedUpdates):
+                updates.update(updates_k)
             samples_k['q'] = qk
             update_dict_of_lists(full_results, **results_k)
-            full_results['i_cost'].append(i_costs[i])
+            full_results['i_cost'].append(i_cost)
             update_dict_of_lists(samples, **samples_k)
 
         results = OrderedDict()
         for k, v in full_results.iteritems():
             results[k] = v[-1]
-            results[k + '0'] = v[0]
-            results['d_' + k] = v[0] - v[-1]
+            if diagnostics != 'none':
+                results[k + '0'] = v[0]
+                results['d_' + k] = v[0] - v[-1]
+
+        if 'n_steps' in inference_outs.keys():
+            results['n_steps'] = inference_outs['n_steps']
+
+        if 'ess' in inference_outs.keys():
+            results['ess'] = inference_outs['ess'][-1].mean()
+            results['n_inference_samples'] = (
+                inference_outs['n_samples'].astype(floatX).mean())
 
         return results, samples, full_results, updates
 
@@ -160,6 +373,7 @@ class DeepIRVI(object):
                  pass_gradients=True,
                  sample_posterior=False,
                  init_inference='recognition_network',
+                 per_step_noise=False,
                  **kwargs):
 
         self.name = name
@@ -170,10 +384,11 @@ class DeepIRVI(object):
         self.n_inference_samples = n_inference_samples
         self.pass_gradients = pass_gradients
         self.sample_posterior = sample_posterior
+        self.per_step_noise = per_step_noise
         warn_kwargs(self, **kwargs)
 
     def step_infer(self, *params):  raise NotImplementedError()
-    def init_infer(self, q0s):      raise NotImplementedError()
+    def init_infer(self, q0s, y):   raise NotImplementedError()
     def unpack_infer(self, outs):   raise NotImplementedError()
     def params_infer(self):         raise NotImplementedError()
 
@@ -197,6 +412,25 @@ class DeepIRVI(object):
 
         return q0s
 
+    def init_step_noise(self, f_step):
+        '''
+        Wraps a scan step so that it draws its own inference noise.
+
+        The wrapped step takes the states (the first being the `q` of each
+        layer) and non sequences, so no noise needs to be preallocated for
+        all steps.
+        '''
+        model = self.model
+
+        def step(*params):
+            batch_size = params[0].shape[0]
+            epsilons = [model.posteriors[l].distribution.prototype_samples(
+                    (self.n_inference_samples, batch_size, model.dim_hs[l]))
+                        for l in range(model.n_layers)]
+            return f_step(*(epsilons + list(params)))
+
+        return step
+
     def inference(self, x, y, q0s=None):
         model = self.model
         updates = theano.OrderedUpdates()
@@ -204,17 +438,19 @@ class DeepIRVI(object):
         if q0s is None:
             q0s = self.init_variational_inference(x)
 
-        epsilons = []
-
-        epsilons = [model.posteriors[l].distribution.prototype_samples(
-                (self.n_inference_steps,
-                 self.n_inference_samples,
-                 y.shape[0],
-                 model.dim_hs[l]))
-                   for l in range(model.n_layers)]
-
-        seqs = epsilons
-        outputs_info = q0s + self.init_infer(q0s) + [None]
+        if self.per_step_noise and self.n_inference_steps > 1:
+            print 'Drawing %s inference noise at each step' % self.name
+            seqs = []
+        else:
+            epsilons = [model.posteriors[l].distribution.prototype_samples(
+                    (self.n_inference_steps,
+                     self.n_inference_samples,
+                     y.shape[0],
+                     model.dim_hs[l]))
+                       for l in range(model.n_layers)]
+            seqs = epsilons
+
+        outputs_info = q0s + self.init_infer(q0s, y) + [None]
         non_seqs = [y] + self.params_infer() + model.get_params()
 
         print ('Doing %d inference steps of %s and a rate of %.5f with %d '
@@ -224,8 +460,12 @@ class DeepIRVI(object):
 
         if self.n_inference_steps > 1:
             print 'Multiple inference steps. Using `scan`'
+            if len(seqs) == 0:
+                step_infer = self.init_step_noise(self.step_infer)
+            else:
+                step_infer = self.step_infer
             outs, updates_i = scan(
-                self.step_infer, seqs, outputs_info, non_seqs, self.n_inference_steps,
+                step_infer, seqs, outputs_info, non_seqs, self.n_inference_steps,
                 self.name + '_infer'
             )
             updates.update(updates_i)
@@ -261,7 +501,15 @@ class DeepIRVI(object):
 
     def __call__(self, x, y,
                  stride=10,
+                 diagnostics='endpoints',
                  **model_args):
+        '''
+        Evaluates the model at the inference steps given by `diagnostics`.
+
+        With `none`, `results` only holds the final step. Otherwise it also
+        holds the first step (keys ending in `0`) and their differences
+        (`d_` keys).
+        '''
 
         model = self.model
 
@@ -270,13 +518,7 @@ class DeepIRVI(object):
 
         qss = inference_outs['qss']
 
-        if self.n_inference_steps > stride and stride != 0:
-            steps = [0, 1] + range(stride, self.n_inference_steps, stride)
-            steps = steps[:-1] + [self.n_inference_steps - 1]
-        elif self.n_inference_steps > 0:
-            steps = [0, self.n_inference_steps - 1]
-        else:
-            steps = [0]
+        steps = diagnostic_steps(self.n_inference_steps, stride, diagnostics)
 
         full_results = OrderedDict()
         full_results['i_cost'] = []
@@ -292,7 +534,8 @@ class DeepIRVI(object):
         results = OrderedDict()
         for k, v in full_results.iteritems():
             results[k] = v[-1]
-            results[k + '0'] = v[0]
-            results['d_' + k] = v[0] - v[-1]
+            if diagnostics != 'none':
+                results[k + '0'] = v[0]
+                results['d_' + k] = v[0] - v[-1]
 
         return results, samples, full_results, updates
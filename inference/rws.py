@@ -3,12 +3,17 @@ Reweighted wake-sleep inference
 '''
 
 from collections import OrderedDict
+import numpy as np
 import theano
 from theano import tensor as T
 
 from utils import floatX
+from utils.binary import binary_samples
+from utils.importance import normalized_weights
 from utils.tools import (
     log_sum_exp,
+    online_log_sum_exp,
+    scan,
     warn_kwargs
 )
 
@@ -22,43 +27,157 @@ class RWS(object):
         self.model = model
         warn_kwargs(self, **kwargs)
 
-    def __call__(self, x, y, n_posterior_samples=10, qk=None):
+    def step_energies(self, y, q, q_c, n_samples, from_qk=False, dedup=False):
         model = self.model
 
-        print 'Doing RWS, %d samples' % n_posterior_samples
-        q   = model.posterior.feed(x)
-
-        if qk is None:
-            q_c = q.copy()
-        else:
-            q_c = qk
-
         r  = model.init_inference_samples(
-            (n_posterior_samples, y.shape[0], model.dim_h))
+            (n_samples, y.shape[0], model.dim_h))
 
-        h  = (r <= q_c[None, :, :]).astype(floatX)
-        py = model.conditional.feed(h)
+        h  = binary_samples(r, q_c[None, :, :])
 
-        log_py_h = -model.conditional.neg_log_prob(y[None, :, :], py)
+        log_py_h, py = model.conditional_energies(y, h, dedup=dedup)
         log_ph   = -model.prior.neg_log_prob(h)
         log_qh   = -model.posterior.neg_log_prob(h, q[None, :, :])
 
         assert log_py_h.ndim == log_ph.ndim == log_qh.ndim
 
-        if qk is None:
-            log_p = log_sum_exp(log_py_h + log_ph - log_qh, axis=0) - T.log(n_posterior_samples)
+        if from_qk:
+            log_qkh = -model.posterior.neg_log_prob(h, q_c[None, :, :])
         else:
-            log_qkh = -model.posterior.neg_log_prob(h, qk[None, :, :])
-            log_p = log_sum_exp(log_py_h + log_ph - log_qkh, axis=0) - T.log(n_posterior_samples)
+            log_qkh = log_qh
+
+        return log_py_h, log_ph, log_qh, log_qkh, py
+
+    def step_accumulate(self, p_max, p_sum, w_max, w_sum,
+                        y_sum, prior_sum, h_sum,
+                        y, q, q_c, n_samples, from_qk=False, dedup=False):
+        log_py_h, log_ph, log_qh, log_qkh, py = self.step_energies(
+            y, q, q_c, n_samples, from_qk=from_qk, dedup=dedup)
+
+        p_max, p_sum, _ = online_log_sum_exp(
+            log_py_h + log_ph - log_qkh, p_max, p_sum)
+        w_max, w_sum, (y_sum, prior_sum, h_sum) = online_log_sum_exp(
+            log_py_h + log_ph - log_qh, w_max, w_sum,
+            values=[log_py_h, log_ph, log_qh],
+            value_sums=[y_sum, prior_sum, h_sum])
+
+        return p_max, p_sum, w_max, w_sum, y_sum, prior_sum, h_sum, py
+
+    def chunked_energies(self, y, q, q_c, n_posterior_samples, chunk_size,
+                         from_qk=False, dedup=False):
+        '''
+        RWS energies over chunks of `chunk_size` samples.
+
+        The normalized weights are never formed over all samples, so peak
+        memory scales with `chunk_size`. The weights are constant for
+        gradients, as with `w_tilde` in the one-shot estimator. The returned
+        `py` is from the last chunk.
+        '''
+        n_chunks  = (n_posterior_samples - 1) // chunk_size
+        last_size = n_posterior_samples - n_chunks * chunk_size
+
+        print ('Streaming %d posterior samples in chunks of %d'
+               % (n_posterior_samples, chunk_size))
+
+        def _step(*params):
+            params = list(params)
+            return self.step_accumulate(*(params + [chunk_size]),
+                                        from_qk=from_qk, dedup=dedup)[:-1]
+
+        neg_inf = T.constant(-np.inf, dtype=floatX)
+        outputs_info = [T.alloc(neg_inf, y.shape[0]),
+                        T.zeros((y.shape[0],), dtype=floatX),
+                        T.alloc(neg_inf, y.shape[0])] + [
+                        T.zeros((y.shape[0],), dtype=floatX) for _ in xrange(4)]
+        outs, updates = scan(_step, [], outputs_info, [y, q, q_c], n_chunks,
+                             name=self.name + '_chunked_energies')
+        state = [out[-1] for out in outs]
+
+        p_max, p_sum, w_max, w_sum, y_sum, prior_sum, h_sum, py = (
+            self.step_accumulate(*(state + [y, q, q_c, last_size]),
+                                 from_qk=from_qk, dedup=dedup))
+
+        # The normalizer of the weights is constant, as `w_tilde` is.
+        w_sum        = theano.gradient.disconnected_grad(w_sum)
+        log_p        = p_max + T.log(p_sum) - T.log(n_posterior_samples)
+        y_energy     = -y_sum / w_sum
+        prior_energy = -prior_sum / w_sum
+        h_energy     = -h_sum / w_sum
+
+        return log_p, y_energy, prior_energy, h_energy, py, updates
+
+    def one_shot_energies(self, y, q, q_c, n_posterior_samples,
+                          from_qk=False, dedup=False):
+        '''
+        RWS energies with all samples at once.
+
+        Returns an OrderedDict with the per-sample log probabilities, the
+        log weights `log_pq` of the samples' own posterior, their normalizer
+        `log_z` and normalized weights `w_tilde`, the bound `log_p` and the weighted energies.
+        '''
+        log_py_h, log_ph, log_qh, log_qkh, py = self.step_energies(
+            y, q, q_c, n_posterior_samples, from_qk=from_qk, dedup=dedup)
+
+        log_p = log_sum_exp(log_py_h + log_ph - log_qkh, axis=0) - T.log(n_posterior_samples)
 
         log_pq   = log_py_h + log_ph - log_qh - T.log(n_posterior_samples)
-        w_norm   = log_sum_exp(log_pq, axis=0)
-        log_w    = log_pq - T.shape_padleft(w_norm)
-        w_tilde  = T.exp(log_w)
+        log_z, w_tilde = normalized_weights(log_pq)
+
+        return OrderedDict(
+            log_py_h=log_py_h,
+            log_ph=log_ph,
+            log_qh=log_qh,
+            log_pq=log_pq,
+            log_z=log_z,
+            w_tilde=w_tilde,
+            log_p=log_p,
+            y_energy=-(w_tilde * log_py_h).sum(axis=0),
+            prior_energy=-(w_tilde * log_ph).sum(axis=0),
+            h_energy=-(w_tilde * log_qh).sum(axis=0),
+            py=py
+        )
 
-        y_energy      = -(w_tilde * log_py_h).sum(axis=0)
-        prior_energy  = -(w_tilde * log_ph).sum(axis=0)
-        h_energy      = -(w_tilde * log_qh).sum(axis=0)
+    def posterior_cost(self, energies):
+        '''
+        Per-example cost of the posterior and the extra constants it needs.
+
+        RWS trains the posterior on the normalized weights (wake-phase
+        q update).
+        '''
+        return energies['h_energy'], []
+
+    def __call__(self, x, y, n_posterior_samples=10, qk=None, chunk_size=None,
+                 dedup=False):
+        model = self.model
+
+        print 'Doing %s, %d samples' % (self.name, n_posterior_samples)
+        q   = model.posterior.feed(x)
+
+        if qk is None:
+            q_c = q.copy()
+        else:
+            q_c = qk
+
+        if chunk_size is None or chunk_size >= n_posterior_samples:
+            energies = self.one_shot_energies(
+                y, q, q_c, n_posterior_samples, from_qk=qk is not None,
+                dedup=dedup)
+            log_p         = energies['log_p']
+            y_energy      = energies['y_energy']
+            prior_energy  = energies['prior_energy']
+            h_energy      = energies['h_energy']
+            py            = energies['py']
+            h_cost, extra_constants = self.posterior_cost(energies)
+
+            constants = [energies['w_tilde'], q_c] + extra_constants
+            updates   = theano.OrderedUpdates()
+        else:
+            log_p, y_energy, prior_energy, h_energy, py, updates = (
+                self.chunked_energies(y, q, q_c, n_posterior_samples,
+                                      chunk_size, from_qk=qk is not None,
+                                      dedup=dedup))
+            h_cost = h_energy
+            constants = [q_c]
 
         nll           = -log_p
         prior_entropy = model.prior.entropy()
@@ -66,7 +185,7 @@ class RWS(object):
 
         assert prior_energy.ndim == h_energy.ndim == y_energy.ndim, (prior_energy.ndim, h_energy.ndim, y_energy.ndim)
 
-        cost = (y_energy + prior_energy + h_energy).sum(0)
+        cost = (y_energy + prior_energy + h_cost).sum(0)
         lower_bound = (y_energy + prior_energy - q_entropy).mean()
 
         results = OrderedDict({
@@ -84,8 +203,7 @@ class RWS(object):
             py=py
         )
 
-        constants =  [w_tilde, q_c]
-        return results, samples, constants
+        return results, samples, constants, updates
 
 
 class DeepRWS(object):
@@ -140,9 +258,7 @@ class DeepRWS(object):
         log_p = log_sum_exp(log_py_h + log_ph - log_qch, axis=0) - T.log(n_posterior_samples)
 
         log_pq   = log_py_h + log_ph - log_qh - T.log(n_posterior_samples)
-        w_norm   = log_sum_exp(log_pq, axis=0)
-        log_w    = log_pq - T.shape_padleft(w_norm)
-        w_tilde  = T.exp(log_w)
+        _, w_tilde = normalized_weights(log_pq)
 
         y_energy      = -(w_tilde * log_py_h).sum(axis=0)
         prior_energy  = -(w_tilde * log_ph).sum(axis=0)
@@ -173,4 +289,4 @@ class DeepRWS(object):
         )
 
         constants = [w_tilde] + qcs
-        return results, samples, constants
+        return results, samples, constants, theano.OrderedUpdates()
@@ -0,0 +1,262 @@
+'''
+Tests for AIR
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from inference import resolve
+from models.distributions import Binomial
+from models.sbn import SBN
+from utils import floatX
+
+
+def test_build_sbn(dim_in=11, dim_h=7):
+    model = SBN(dim_in, dim_h, prior=Binomial(dim_h))
+    model.set_tparams()
+    return model
+
+def test_early_exit(batch_size=5, n_inference_steps=9):
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    air = resolve(model, inference_method='air', inference_rate=0.1,
+                  n_inference_steps=n_inference_steps, n_inference_samples=13,
+                  inference_tol=1.)
+    rval, _, updates = air.inference(X, X)
+    f = theano.function([X], [rval['qs'], rval['n_steps']], updates=updates)
+    qs, n_steps = f(x)
+
+    # Every row changes by less than 1 on the first step.
+    assert qs.shape[0] == 2, qs.shape
+    assert np.all(n_steps == 1), n_steps
+
+    air = resolve(model, inference_method='air', inference_rate=0.1,
+                  n_inference_steps=n_inference_steps, n_inference_samples=13,
+                  inference_tol=0.)
+    rval, _, updates = air.inference(X, X)
+    f = theano.function([X], [rval['qs'], rval['n_steps']], updates=updates)
+    qs, n_steps = f(x)
+
+    assert qs.shape[0] == n_inference_steps + 1, qs.shape
+    assert np.all(n_steps == n_inference_steps), n_steps
+
+    results, _, _, updates = air(X, X, n_posterior_samples=7)
+    f = theano.function([X], results.values(), updates=updates)
+    r = dict(zip(results.keys(), f(x)))
+    assert r['n_steps'].shape == (batch_size,), r['n_steps'].shape
+
+def test_warm_start(batch_size=5, warm_start_mix=0.25):
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    Q = T.matrix('q', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+    q_c = np.random.uniform(size=(batch_size, model.dim_h)).astype(floatX)
+    q_c[:2] = np.nan
+
+    air = resolve(model, inference_method='air', n_inference_steps=3,
+                  n_inference_samples=13, warm_start_mix=warm_start_mix)
+    q0 = air.init_warm_start(X, Q)
+    f = theano.function([X, Q], [q0, model.posterior.feed(X)])
+    q0, q_r = f(x, q_c)
+
+    # Rows that are not cached yet start from the recognition network.
+    np.testing.assert_allclose(q0[:2], q_r[:2], rtol=1e-6)
+    np.testing.assert_allclose(
+        q0[2:], warm_start_mix * q_c[2:] + (1 - warm_start_mix) * q_r[2:],
+        rtol=1e-5)
+
+def test_per_step_noise(batch_size=5, n_inference_steps=4):
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    for inference_tol in [None, 0.]:
+        air = resolve(model, inference_method='air', inference_rate=0.1,
+                      n_inference_steps=n_inference_steps,
+                      n_inference_samples=13, per_step_noise=True,
+                      inference_tol=inference_tol)
+        results, _, _, updates = air(X, X, n_posterior_samples=7)
+        f = theano.function([X], results['i_cost'], updates=updates)
+
+        # Noise is redrawn on every call, so the random state is updated.
+        assert f(x) != f(x)
+
+def test_deep_per_step_noise(batch_size=5, dim_in=11, dim_hs=[7, 5],
+                             n_inference_steps=4):
+    from models.dsbn import DeepSBN
+
+    model = DeepSBN(dim_in, dim_hs)
+    model.set_tparams()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    air = resolve(model, inference_method='air', deep=True,
+                  n_inference_steps=n_inference_steps, n_inference_samples=13,
+                  per_step_noise=True)
+    rval, _, updates = air.inference(X, X)
+    f = theano.function([X], rval['qss'], updates=updates)
+    qss = f(x)
+    for qs, dim_h in zip(qss, dim_hs):
+        assert qs.shape == (n_inference_steps + 1, batch_size, dim_h), qs.shape
+
+def test_adaptive_samples(batch_size=5, n_inference_steps=4):
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+    sizes = [3, 6, 12]
+
+    def run(ess_target):
+        air = resolve(model, inference_method='air',
+                      n_inference_steps=n_inference_steps,
+                      n_inference_samples=6, ess_target=ess_target,
+                      inference_sample_sizes=sizes)
+        rval, _, updates = air.inference(X, X)
+        f = theano.function([X], [rval['qs'], rval['ess'], rval['n_samples']],
+                            updates=updates)
+        return f(x)
+
+    # An unreachable target grows to the largest size and stays there.
+    qs, ess, n_samples = run(1e6)
+    assert qs.shape == (n_inference_steps + 1, batch_size, model.dim_h)
+    assert ess.shape == (n_inference_steps, batch_size), ess.shape
+    assert n_samples.tolist() == [6, 12, 12, 12], n_samples
+    assert np.all(ess >= 1. - 1e-5) and np.all(ess[1:] <= 12. + 1e-5), ess
+
+    # A trivial target shrinks to the smallest size.
+    _, _, n_samples = run(0.)
+    assert n_samples.tolist() == [6, 3, 3, 3], n_samples
+
+    air = resolve(model, inference_method='air',
+                  n_inference_steps=n_inference_steps,
+                  n_inference_samples=6, ess_target=2.,
+                  inference_sample_sizes=sizes)
+    results, _, _, updates = air(X, X, n_posterior_samples=7)
+    f = theano.function([X], [results['ess'], results['n_inference_samples']],
+                        updates=updates)
+    ess, n = f(x)
+    assert 3 <= n <= 12, n
+
+def test_block_deep_air(batch_size=5, dim_in=11, dim_hs=[7, 5, 3],
+                        n_inference_steps=6):
+    from models.dsbn import DeepSBN
+
+    model = DeepSBN(dim_in, dim_hs)
+    model.set_tparams()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    for block_schedule in ['round_robin', 'largest_change']:
+        air = resolve(model, inference_method='air', deep=True,
+                      n_inference_steps=n_inference_steps,
+                      n_inference_samples=13, block_schedule=block_schedule)
+        rval, _, updates = air.inference(X, X)
+        f = theano.function([X], rval['qss'], updates=updates)
+        qss = f(x)
+
+        # Exactly one layer changes per step.
+        for k in xrange(n_inference_steps):
+            changed = [not np.allclose(qs[k], qs[k+1]) for qs in qss]
+            assert sum(changed) == 1, (block_schedule, k, changed)
+            if block_schedule == 'round_robin':
+                assert changed.index(True) == k % len(dim_hs), changed
+
+        # Every layer is visited before any is refined twice.
+        first = [[not np.allclose(qs[k], qs[k+1]) for qs in qss].index(True)
+                 for k in xrange(len(dim_hs))]
+        assert sorted(first) == range(len(dim_hs)), first
+
+        results, _, _, updates = air(X, X, n_posterior_samples=7)
+        f = theano.function([X], results['lower_bound'], updates=updates)
+        assert np.isfinite(f(x))
+
+def test_fused_bound(batch_size=5, n_inference_steps=3,
+                     n_inference_samples=13):
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    air = resolve(model, inference_method='air', inference_rate=0.1,
+                  n_inference_steps=n_inference_steps,
+                  n_inference_samples=n_inference_samples)
+    rval, _, updates, state = air.inference_fused(X, X)
+    results, _, _ = model(X, X, state=state)
+    keys = results.keys()
+    f = theano.function(
+        [X], results.values() + [rval['qs'], rval['i_costs'], state['h']],
+        updates=updates)
+    outs = f(x)
+    qs, i_costs, h = outs[-3:]
+    assert qs.shape == (n_inference_steps + 1, batch_size, model.dim_h)
+    assert i_costs.shape == (n_inference_steps,), i_costs.shape
+
+    # The same bound as resampling from the last proposal with the same noise.
+    R = T.tensor3('r', dtype=floatX)
+    Q = T.matrix('q', dtype=floatX)
+    model.init_inference_samples = lambda size: R
+    try:
+        results_r, _, _ = model(X, X, Q, n_posterior_samples=n_inference_samples)
+    finally:
+        del model.init_inference_samples
+    f_r = theano.function([X, R, Q], [results_r[k] for k in keys],
+                          on_unused_input='ignore')
+    outs_r = f_r(x, (1. - h).astype(floatX), qs[-2])
+
+    for k, v, v_r in zip(keys, outs, outs_r):
+        np.testing.assert_allclose(v, v_r, rtol=1e-4, atol=1e-4, err_msg=k)
+
+def test_diagnostics(batch_size=5, n_inference_steps=7):
+    from inference.irvi import diagnostic_steps
+
+    assert diagnostic_steps(20, 5, 'full') == [0, 1, 5, 10, 19]
+    assert diagnostic_steps(20, 5, 'endpoints') == [0, 19]
+    assert diagnostic_steps(20, 5, 'none') == [19]
+    assert diagnostic_steps(1, 5, 'endpoints') == [0]
+    assert diagnostic_steps(0, 5, 'full') == [0]
+
+    model = test_build_sbn()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+    air = resolve(model, inference_method='air',
+                  n_inference_steps=n_inference_steps, n_inference_samples=13)
+
+    for diagnostics, n_evals in [('none', 1), ('endpoints', 2), ('full', 5)]:
+        results, samples, full_results, updates = air(
+            X, X, n_posterior_samples=7, stride=2, diagnostics=diagnostics)
+        assert len(full_results['lower_bound']) == n_evals
+        assert len(samples['py']) == n_evals
+        assert ('lower_bound0' in results) == (diagnostics != 'none')
+        f = theano.function([X], results.values(), updates=updates)
+        assert np.all(np.isfinite(f(x)))
+
+def test_precision_parity(batch_size=5, n_inference_steps=3,
+                          n_inference_samples=11, n_posterior_samples=7):
+    model = test_build_sbn()
+    r = np.random.uniform(
+        size=(n_inference_steps, n_inference_samples, batch_size,
+              model.dim_h)).astype(floatX)
+    r_p = np.random.uniform(
+        size=(n_posterior_samples, batch_size, model.dim_h)).astype(floatX)
+    # Inference noise is drawn for all steps at once, posterior samples after.
+    model.init_inference_samples = lambda size: theano.shared(
+        r if len(size) == 4 else r_p)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    rvals = {}
+    for precision in ['float32', 'float16']:
+        model.precision = precision
+        air = resolve(model, inference_method='air', inference_rate=0.1,
+                      n_inference_steps=n_inference_steps,
+                      n_inference_samples=n_inference_samples)
+        results, _, _, updates = air(X, X,
+                                     n_posterior_samples=n_posterior_samples)
+        f = theano.function([X], [results['lower_bound'], results['-log p(x)']],
+                            updates=updates)
+        rvals[precision] = f(x)
+
+    for v, v_r in zip(rvals['float32'], rvals['float16']):
+        assert np.allclose(v, v_r, atol=1e-2), (v, v_r)
@@ -0,0 +1,65 @@
+'''
+Tests for RWS
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from inference.rws import RWS
+from models.tests import test_sbn
+from utils import floatX
+
+
+def test_chunked_rws(dim_in=11, dim_h=7, batch_size=5, chunk_size=4,
+                     n_chunks=3):
+    model = test_sbn.test_build_sbn(dim_in, dim_h)
+    n_posterior_samples = chunk_size * n_chunks + 3
+    r = np.random.uniform(size=(chunk_size, batch_size, dim_h))
+    r = np.tile(r, (n_chunks + 1, 1, 1)).astype(floatX)
+    test_sbn.fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    rws = RWS(model)
+    wrt = [model.conditional.W0, model.posterior.W0]
+    results, _, constants, updates = rws(
+        X, X, n_posterior_samples=n_posterior_samples)
+    grads = T.grad(results['cost'], wrt=wrt, consider_constant=constants)
+    results_c, _, constants_c, updates_c = rws(
+        X, X, n_posterior_samples=n_posterior_samples, chunk_size=chunk_size)
+    grads_c = T.grad(results_c['cost'], wrt=wrt, consider_constant=constants_c)
+
+    f = theano.function([X], results.values() + grads, updates=updates)
+    f_c = theano.function([X], results_c.values() + grads_c, updates=updates_c)
+
+    keys = results.keys() + ['grad_W0', 'grad_posterior_W0']
+    for k, v, v_c in zip(keys, f(x), f_c(x)):
+        assert np.allclose(v, v_c, atol=1e-5), (k, v, v_c)
+
+def test_precision_parity(dim_in=11, dim_h=7, batch_size=5,
+                          n_posterior_samples=13):
+    model = test_sbn.test_build_sbn(dim_in, dim_h)
+    r = np.random.uniform(
+        size=(n_posterior_samples, batch_size, dim_h)).astype(floatX)
+    test_sbn.fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    rws = RWS(model)
+    wrt = [model.conditional.W0, model.posterior.W0]
+    rvals = {}
+    for precision in ['float32', 'float16']:
+        model.precision = precision
+        results, _, constants, updates = rws(
+            X, X, n_posterior_samples=n_posterior_samples)
+        grads = T.grad(results['cost'], wrt=wrt, consider_constant=constants)
+        f = theano.function([X], [results['lower_bound'],
+                                  results['-log p(x)']] + grads,
+                            updates=updates)
+        rvals[precision] = f(x)
+
+    for v, v_r in zip(rvals['float32'], rvals['float16']):
+        assert np.allclose(v, v_r, atol=1e-2), (v, v_r)
@@ -0,0 +1,85 @@
+'''
+Tests for VIMCO
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from inference.rws import RWS
+from inference.vimco import (
+    VIMCO,
+    leave_one_out
+)
+from models.tests import test_sbn
+from utils import floatX
+
+
+def _log_sum_exp(x, axis=0):
+    x_max = x.max(axis=axis)
+    return np.log(np.exp(x - np.expand_dims(x_max, axis)).sum(axis=axis)) + x_max
+
+def _leave_one_out(log_w):
+    loo = np.zeros_like(log_w)
+    for s in xrange(log_w.shape[0]):
+        log_w_s = log_w.copy()
+        log_w_s[s] = np.delete(log_w, s, axis=0).mean(axis=0)
+        loo[s] = _log_sum_exp(log_w_s)
+    return loo
+
+def test_leave_one_out(n_samples=6, batch_size=5):
+    log_w = np.random.normal(size=(n_samples, batch_size)).astype(floatX)
+    L = T.matrix('log_w', dtype=floatX)
+    loo = theano.function([L], leave_one_out(L))(log_w)
+    np.testing.assert_allclose(loo, _leave_one_out(log_w), rtol=1e-5)
+
+def test_vimco(batch_size=5, n_posterior_samples=4):
+    model = test_sbn.test_build_sbn()
+    r = np.random.uniform(
+        size=(n_posterior_samples, batch_size, model.dim_h)).astype(floatX)
+    test_sbn.fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    wrt = [model.conditional.W0, model.posterior.W0]
+    rvals = []
+    for inference in [RWS(model), VIMCO(model)]:
+        results, _, constants, updates = inference(
+            X, X, n_posterior_samples=n_posterior_samples)
+        grads = T.grad(results['cost'], wrt=wrt, consider_constant=constants)
+        f = theano.function([X], [results['-log p(x)'], constants[-1]] + grads,
+                            updates=updates)
+        rvals.append(f(x))
+
+    (nll, _, grad_p, _), (nll_v, signal_v, grad_p_v, grad_q_v) = rvals
+    # Same bound and generative gradient.
+    np.testing.assert_allclose(nll, nll_v, rtol=1e-5)
+    np.testing.assert_allclose(grad_p, grad_p_v, rtol=1e-4, atol=1e-6)
+
+    # Reference log weights and VIMCO posterior gradient.
+    def binomial_prob(z):
+        return 1. / (1. + np.exp(-z)) * 0.9999 + 0.000005
+    def log_bernoulli(h, p):
+        return (h * np.log(p) + (1 - h) * np.log(1 - p)).sum(axis=-1)
+
+    s = 1. / (1. + np.exp(-(x.dot(model.posterior.W0.get_value())
+                            + model.posterior.b0.get_value())))
+    q = s * 0.9999 + 0.000005
+    h = (r <= q[None, :, :]).astype(floatX)
+    py = binomial_prob(h.dot(model.conditional.W0.get_value())
+                       + model.conditional.b0.get_value())
+    p_prior = binomial_prob(model.prior.z.get_value())
+
+    log_qh = log_bernoulli(h, q[None, :, :])
+    log_pq = (log_bernoulli(x[None, :, :], py) + log_bernoulli(h, p_prior)
+              - log_qh - np.log(n_posterior_samples))
+    log_z = _log_sum_exp(log_pq)
+    w_tilde = np.exp(log_pq - log_z[None, :])
+    signal = log_z[None, :] - _leave_one_out(log_pq) - w_tilde
+    np.testing.assert_allclose(signal_v, signal, rtol=1e-4, atol=1e-5)
+
+    # d log q(h) / d preactivation of the posterior.
+    dlog_qh = (h / q - (1 - h) / (1 - q)) * 0.9999 * s * (1 - s)
+    grad_q = -x.T.dot((signal[:, :, None] * dlog_qh).sum(axis=0))
+    np.testing.assert_allclose(grad_q_v, grad_q, rtol=1e-3, atol=1e-5)
@@ -0,0 +1,62 @@
+'''
+Multi-sample score function estimator with leave-one-out baselines (VIMCO).
+'''
+
+from theano import tensor as T
+
+from rws import RWS
+from utils.tools import log_sum_exp
+
+
+def leave_one_out(log_w):
+    '''
+    Bounds with each sample replaced by the others' geometric mean.
+
+    For (n_samples, batch) log weights, entry (s, b) is log_sum_exp over
+    samples of `log_w[:, b]` with `log_w[s, b]` replaced by the mean of the
+    other log weights of example `b`.
+    '''
+    n_samples = log_w.shape[0]
+    log_w_hat = ((log_w.sum(axis=0)[None, :] - log_w)
+                 / (n_samples - 1).astype(log_w.dtype))
+    # (s, j, b): sample j of example b with sample s replaced.
+    replaced = T.eye(n_samples, dtype='int8')[:, :, None]
+    log_ws = T.switch(replaced, log_w_hat[:, None, :], log_w[None, :, :])
+    return log_sum_exp(log_ws, axis=1)
+
+
+class VIMCO(RWS):
+    '''
+    Importance-weighted bound with a VIMCO gradient for the posterior.
+
+    Samples share the importance weights of RWS: the conditional and prior
+    are trained on the normalized weights `w_tilde`. The posterior takes the
+    score function gradient of the bound, where each sample's learning
+    signal is the bound minus its leave-one-out bound (see `leave_one_out`),
+    less its normalized weight. The baselines lower the variance of the
+    posterior gradient at a few samples per example. The signal is the last
+    of the returned constants.
+    '''
+    def __init__(self,
+                 model,
+                 name='VIMCO',
+                 **kwargs):
+        super(VIMCO, self).__init__(model, name=name, **kwargs)
+
+    def posterior_cost(self, energies):
+        log_pq = energies['log_pq']
+        signal = (energies['log_z'][None, :] - leave_one_out(log_pq)
+                  - energies['w_tilde'])
+        return -(signal * energies['log_qh']).sum(axis=0), [signal]
+
+    def __call__(self, x, y, n_posterior_samples=10, chunk_size=None,
+                 dedup=False):
+        if n_posterior_samples < 2:
+            raise ValueError('VIMCO needs at least 2 posterior samples, got %d'
+                             % n_posterior_samples)
+        if chunk_size is not None and chunk_size < n_posterior_samples:
+            raise NotImplementedError('Leave-one-out baselines need all '
+                                      'samples at once. Evaluate the bound '
+                                      'with RWS.')
+        return super(VIMCO, self).__call__(
+            x, y, n_posterior_samples=n_posterior_samples, dedup=dedup)
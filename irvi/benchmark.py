@@ -0,0 +1,664 @@
+'''
+Benchmarks for inference and model graphs.
+
+Each benchmark is a subcommand, e.g.:
+
+    python benchmark.py noise -s 50 -i 1000
+    python benchmark.py deep_air ../exps/mnist/sbn_air_200x3.yaml
+    python benchmark.py darn -H 200 -n 99
+    python benchmark.py mlp -S 20 100
+    python benchmark.py precision -m air rws
+    python benchmark.py mmmlp -M 4
+    python benchmark.py lfmlp -P 28 28 -F 5 5
+    python benchmark.py dedup -p 1000 -B 2 4 8
+    python benchmark.py vimco ../exps/mnist/sbn_rws_200.yaml -s 2 5 20
+
+Benchmarks that compare memory run each variant in its own process and
+report its peak resident memory.
+'''
+
+import argparse
+from collections import OrderedDict
+import multiprocessing as mp
+import numpy as np
+import resource
+from tabulate import tabulate
+import theano
+from theano import tensor as T
+import time
+
+from datasets import load_data
+from inference import resolve as resolve_inference
+from models.darn import AutoRegressor
+from models.distributions import Binomial
+from models.mlp import (
+    LFMLP,
+    MLP,
+    MultiModalMLP
+)
+from models.dsbn import (
+    DeepSBN,
+    unpack as unpack_deepsbn
+)
+from models.sbn import SBN
+from utils import (
+    floatX,
+    op
+)
+from utils.binary import (
+    binary_samples,
+    unique_samples
+)
+from utils.tools import (
+    load_experiment,
+    load_model
+)
+
+
+def _peak_memory():
+    '''
+    Peak resident memory of this process in MB.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def _run_in_process(f, *args):
+    '''
+    Runs `f(*args)` in a child process and returns its result dictionary,
+    with the peak memory of the child added.
+    '''
+    queue = mp.Queue()
+
+    def target():
+        rval = f(*args)
+        rval['peak MB'] = _peak_memory()
+        queue.put(rval)
+
+    p = mp.Process(target=target)
+    p.start()
+    rval = queue.get()
+    p.join()
+    return rval
+
+def _time(f, inps, n_calls):
+    f(*inps)
+    t0 = time.time()
+    for _ in xrange(n_calls):
+        f(*inps)
+    return (time.time() - t0) / float(n_calls)
+
+def _data(batch_size, dim_in):
+    return np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+def build_sbn(dim_in, dim_h):
+    model = SBN(dim_in, dim_h, prior=Binomial(dim_h))
+    model.set_tparams()
+    return model
+
+def _noise(per_step_noise, dim_in, dim_h, batch_size, n_inference_steps,
+           n_inference_samples, n_calls):
+    model = build_sbn(dim_in, dim_h)
+    X = T.matrix('x', dtype=floatX)
+    inference = resolve_inference(
+        model, inference_method='air', inference_rate=0.1,
+        n_inference_steps=n_inference_steps,
+        n_inference_samples=n_inference_samples,
+        per_step_noise=per_step_noise)
+    rval, _, updates = inference.inference(X, X)
+    f = theano.function([X], rval['qk'], updates=updates)
+
+    dt = _time(f, [_data(batch_size, dim_in)], n_calls)
+    return OrderedDict([('per step noise', per_step_noise),
+                        ('s / call', dt)])
+
+def benchmark_noise(dim_in=784, dim_h=200, batch_size=100,
+                    n_inference_steps=20, n_inference_samples=100, n_calls=5):
+    '''
+    Compares preallocated and per-step inference noise for AIR.
+    '''
+    print ('AIR noise: %d steps, %d samples, batch of %d, %d -> %d units'
+           % (n_inference_steps, n_inference_samples, batch_size, dim_in,
+              dim_h))
+    noise_mb = (4. * n_inference_steps * n_inference_samples * batch_size
+                * dim_h / 2 ** 20)
+    print 'Preallocated noise: %.1f MB' % noise_mb
+
+    rows = []
+    for per_step_noise in [False, True]:
+        rval = _run_in_process(
+            _noise, per_step_noise, dim_in, dim_h, batch_size,
+            n_inference_steps, n_inference_samples, n_calls)
+        rows.append(rval)
+
+    print tabulate([r.values() for r in rows], headers=rows[0].keys())
+    return rows
+
+def benchmark_deep_air(experiment, model_file=None, source=None,
+                       steps=[5, 10, 20, 40], batch_size=100, n_calls=5,
+                       schedules=['all', 'round_robin', 'largest_change']):
+    '''
+    Bound against wall-clock time for all-layer and block-coordinate DeepAIR.
+
+    Uses the model and test inference arguments of the `experiment` yaml,
+    with parameters from `model_file` if given (random otherwise).
+    '''
+    exp_dict = load_experiment(experiment)
+    dataset_args = exp_dict['dataset_args']
+    if source is not None:
+        dataset_args['source'] = source
+    _, _, test = load_data(test_batch_size=batch_size, **dataset_args)
+    x = test.next()[test.name]
+
+    dim_in = test.dims[test.name]
+    if model_file is not None:
+        models, _ = load_model(model_file, unpack_deepsbn,
+                               distributions=test.distributions,
+                               dims=test.dims)
+        model = models['sbn']
+    else:
+        model = DeepSBN(dim_in, exp_dict['dim_hs'])
+    model.set_tparams()
+
+    X = T.matrix('x', dtype=floatX)
+    if exp_dict.get('center_input', True):
+        X_i = X - test.mean_image.astype(floatX)
+    else:
+        X_i = X
+
+    inference_args = dict(exp_dict['inference_args_test'])
+    inference_args.pop('inference_method')
+    n_posterior_samples = exp_dict['learning_args'].get(
+        'n_posterior_samples_test', 100)
+
+    rows = []
+    for schedule in schedules:
+        for n_inference_steps in steps:
+            inference_args.update(
+                n_inference_steps=n_inference_steps,
+                block_schedule=None if schedule == 'all' else schedule)
+            inference = resolve_inference(model, inference_method='air',
+                                          deep=True, **inference_args)
+            results, _, _, updates = inference(
+                X_i, X, n_posterior_samples=n_posterior_samples)
+            f = theano.function([X], results['lower_bound'], updates=updates)
+
+            f(x)
+            bounds = []
+            t0 = time.time()
+            for _ in xrange(n_calls):
+                bounds.append(f(x))
+            dt = (time.time() - t0) / float(n_calls)
+            rows.append([schedule, n_inference_steps, np.mean(bounds), dt])
+
+    print tabulate(rows, headers=['schedule', 'steps', 'lower bound',
+                                  's / call'])
+    return rows
+
+def benchmark_darn(dim_h=200, n_samples=99, block_sizes=[8, 16, 32],
+                   n_calls=5):
+    '''
+    Compares per-dimension and block autoregressive prior sampling.
+
+    Reports compile time and time per call of the Theano samplers, and the
+    time of the NumPy sampler.
+    '''
+    prior = AutoRegressor(dim_h)
+    prior.set_tparams()
+
+    rows = []
+    for block_size in [None] + block_sizes:
+        t0 = time.time()
+        x, updates = prior.sample(n_samples, block_size=block_size)
+        f = theano.function([], x, updates=updates)
+        dt_compile = time.time() - t0
+        rows.append(['scan' if block_size is None else 'block',
+                     block_size or 1, dt_compile, _time(f, [], n_calls)])
+
+    for block_size in block_sizes:
+        t0 = time.time()
+        for _ in xrange(n_calls):
+            prior.sample_numpy(n_samples, block_size=block_size)
+        rows.append(['numpy', block_size, 0.,
+                     (time.time() - t0) / float(n_calls)])
+
+    print ('Autoregressive prior sampling: %d samples of %d units'
+           % (n_samples, dim_h))
+    print tabulate(rows, headers=['sampler', 'block size', 'compile s',
+                                  's / call'])
+    return rows
+
+def _step_call_3d(mlp, x):
+    '''
+    Output of `mlp` from `T.dot` on 3d inputs, without flattening.
+    '''
+    params = mlp.get_params()
+    for l in xrange(mlp.n_layers):
+        W, b = params[2 * l:2 * l + 2]
+        preact = T.dot(x, W) + b
+        if l < mlp.n_layers - 1:
+            x = eval(mlp.h_act)(preact)
+        else:
+            x = mlp.distribution(preact)
+    return x
+
+def benchmark_mlp(shapes=[(200, 784), (200, 200)], samples=[20, 100],
+                  batch_size=100, n_calls=10):
+    '''
+    Compares 3d `T.dot` and flattened GEMMs for MLPs on
+    (n_samples, batch, dim) inputs, forward and backward.
+
+    Default shapes are the conditionals of the `exps/mnist` models.
+    '''
+    rows = []
+    for dim_in, dim_out in shapes:
+        mlp = MLP(dim_in, dim_out, distribution='binomial')
+        mlp.set_tparams()
+        X = T.tensor3('x', dtype=floatX)
+
+        for n_samples in samples:
+            x = np.random.randint(
+                0, 2, size=(n_samples, batch_size, dim_in)).astype(floatX)
+            dts = []
+            for y in [_step_call_3d(mlp, X), mlp.feed(X)]:
+                grads = T.grad(y.sum(), wrt=mlp.get_params())
+                f = theano.function([X], [y] + grads)
+                dts.append(_time(f, [x], n_calls))
+            rows.append(['%dx%dx%d -> %d' % (n_samples, batch_size, dim_in,
+                                             dim_out)]
+                        + dts + [dts[0] / dts[1]])
+
+    print tabulate(rows, headers=['shape', '3d dot s / call',
+                                  'flattened s / call', 'speedup'])
+    return rows
+
+def benchmark_mmmlp(dim_in=200, dim_out=784, n_modalities=[1, 4, 16],
+                    n_samples=20, batch_size=100, n_calls=10):
+    '''
+    Compares multimodal conditionals with binomial outputs split over
+    `n_modalities` against an MLP of the same total width, forward and
+    backward through the negative log probability.
+    '''
+    X = T.tensor3('x', dtype=floatX)
+    Y = T.matrix('y', dtype=floatX)
+    x = np.random.randint(
+        0, 2, size=(n_samples, batch_size, dim_in)).astype(floatX)
+    y = _data(batch_size, dim_out)
+
+    def time_mlp(mlp):
+        mlp.set_tparams()
+        cost = mlp.neg_log_prob(Y[None, :, :], mlp.feed(X)).mean()
+        grads = T.grad(cost, wrt=mlp.get_params())
+        f = theano.function([X, Y], [cost] + grads)
+        return _time(f, [x, y], n_calls)
+
+    dt = time_mlp(MLP(dim_in, dim_out, distribution='binomial'))
+    rows = [['MLP', dt, 1.]]
+    for n in n_modalities:
+        dims = [dim_out // n] * n
+        dims[-1] += dim_out - sum(dims)
+        outs = ['o%d' % i for i in xrange(n)]
+        graph = dict(
+            layers=dict(),
+            outs=dict((o, dict(dim=d, distribution='binomial'))
+                      for o, d in zip(outs, dims)),
+            edges=[('i', o) for o in outs])
+        dt_m = time_mlp(MultiModalMLP(dim_in, graph))
+        rows.append(['%d modalities' % n, dt_m, dt_m / dt])
+
+    print ('%d samples, batch of %d, %d -> %d units'
+           % (n_samples, batch_size, dim_in, dim_out))
+    print tabulate(rows, headers=['conditional', 's / call', 'vs MLP'])
+    return rows
+
+def benchmark_lfmlp(prototype_shape=[28, 28], filter_shape=[5, 5], stride=2,
+                    dim_f=4, dim_out=200, n_samples=20, batch_size=100,
+                    n_calls=10):
+    '''
+    Compares the local filter layer of LFMLP against a dense product with
+    the same weights scattered into a masked matrix, forward and backward.
+    '''
+    prototype = np.ones(prototype_shape).astype(floatX)
+    dim_in = int(prototype.sum())
+    t0 = time.time()
+    mlp = LFMLP(dim_in, dim_out, dim_f=dim_f, prototype=prototype,
+                shape=filter_shape, stride=stride)
+    dt_build = time.time() - t0
+    mlp.set_tparams()
+
+    n_filters, filter_size = mlp.filter_idx.shape
+    W = mlp.params['W0']
+    W_d = np.zeros((dim_in + 1, n_filters * dim_f)).astype(floatX)
+    for k, idx in enumerate(mlp.filter_idx):
+        W_d[idx, k * dim_f:(k + 1) * dim_f] = W[k]
+    W_d = theano.shared(W_d[:-1])
+
+    X = T.matrix('x', dtype=floatX)
+    x = _data(n_samples * batch_size, dim_in)
+    rows = []
+    for name, W_, y in [
+        ('dense', W_d, T.dot(X, W_d) + mlp.b0),
+        ('local', mlp.W0, mlp.layer_preact(0, X, mlp.W0, mlp.b0))]:
+        f = theano.function([X], [y, T.grad(y.sum(), wrt=W_)])
+        rows.append([name, W_.get_value().size, _time(f, [x], n_calls)])
+
+    print ('%d filters of up to %d units (%.2f s to build), %d samples, '
+           'batch of %d' % (n_filters, filter_size, dt_build, n_samples,
+                            batch_size))
+    print tabulate(rows, headers=['layer', 'weights', 's / call'])
+    return rows
+
+def _precision(method, precision, dim_in, dim_h, batch_size,
+               n_inference_steps, n_inference_samples, n_posterior_samples,
+               n_calls):
+    model = build_sbn(dim_in, dim_h)
+    model.precision = precision
+    X = T.matrix('x', dtype=floatX)
+    inference = resolve_inference(
+        model, inference_method=method, inference_rate=0.1,
+        n_inference_steps=n_inference_steps,
+        n_inference_samples=n_inference_samples)
+    if method == 'air':
+        results, _, _, updates = inference(
+            X, X, n_posterior_samples=n_posterior_samples)
+        constants = []
+    else:
+        results, _, constants, updates = inference(
+            X, X, n_posterior_samples=n_posterior_samples)
+    params = model.get_params()
+    grads = T.grad(results['cost'], wrt=params, consider_constant=constants)
+    f = theano.function([X], [results['lower_bound']] + grads,
+                        updates=updates)
+
+    x = _data(batch_size, dim_in)
+    dt = _time(f, [x], n_calls)
+    return OrderedDict([('method', method), ('precision', precision),
+                        ('lower bound', float(f(x)[0])), ('s / call', dt)])
+
+def benchmark_precision(methods=['air', 'rws'], dim_in=784, dim_h=200,
+                        batch_size=100, n_inference_steps=20,
+                        n_inference_samples=20, n_posterior_samples=100,
+                        n_calls=5, precisions=['float32', 'float16',
+                                               'bfloat16']):
+    '''
+    Peak memory and time of training updates (bound and gradients) at each
+    storage precision, with random SBN weights.
+
+    On the CPU, float16 elementwise ops run in Python, so float16 is only
+    practical with small settings there. bfloat16 only emulates the rounding
+    and should match float32 in memory.
+    '''
+    print ('%d posterior samples, AIR with %d steps of %d samples, batch of '
+           '%d, %d -> %d units' % (n_posterior_samples, n_inference_steps,
+                                  n_inference_samples, batch_size, dim_in,
+                                  dim_h))
+
+    rows = []
+    for method in methods:
+        for precision in precisions:
+            rows.append(_run_in_process(
+                _precision, method, precision, dim_in, dim_h, batch_size,
+                n_inference_steps, n_inference_samples, n_posterior_samples,
+                n_calls))
+
+    print tabulate([r.values() for r in rows], headers=rows[0].keys())
+    return rows
+
+def benchmark_dedup(dim_in=784, dim_h=200, batch_size=100,
+                    n_posterior_samples=1000, biases=[0, 2, 4, 8],
+                    n_calls=3):
+    '''
+    Test bound with and without deduplicated posterior samples.
+
+    Posterior biases of +/- `bias` saturate the posterior, so that samples
+    repeat. Reports the distinct samples per example and the time of each
+    bound.
+    '''
+    print ('%d posterior samples, batch of %d, %d -> %d units'
+           % (n_posterior_samples, batch_size, dim_in, dim_h))
+
+    X = T.matrix('x', dtype=floatX)
+    x = _data(batch_size, dim_in)
+    rows = []
+    for bias in biases:
+        model = build_sbn(dim_in, dim_h)
+        model.posterior.b0.set_value(np.random.choice(
+            [-bias, bias], size=(dim_h,)).astype(floatX))
+
+        q = model.posterior.feed(X)
+        h = binary_samples(model.init_inference_samples(
+            (n_posterior_samples, X.shape[0], dim_h)), q[None, :, :])
+        f_unique = theano.function([X], unique_samples(h)[0].shape[0])
+        n_unique = f_unique(x) / float(batch_size)
+
+        row = [bias, n_unique]
+        for dedup in [False, True]:
+            results, _, updates = model(
+                X, X, n_posterior_samples=n_posterior_samples, dedup=dedup)
+            f = theano.function([X], results['-log p(x)'], updates=updates)
+            row.append(_time(f, [x], n_calls))
+        rows.append(row + [row[2] / row[3]])
+
+    print tabulate(rows, headers=['bias', 'unique / example', 's / call',
+                                  's / call (dedup)', 'speedup'])
+    return rows
+
+def _next(data):
+    try:
+        return data.next()[data.name]
+    except StopIteration:
+        return data.next()[data.name]
+
+def _grad_variance(f_grads, x, n_grads):
+    '''
+    Total variance of the gradient estimates of `f_grads` on batch `x`.
+    '''
+    grads = [f_grads(x) for _ in xrange(n_grads)]
+    return sum(np.var(np.array(gs), axis=0).sum() for gs in zip(*grads))
+
+def benchmark_vimco(experiment, source=None, methods=['rws', 'vimco'],
+                    samples=[2, 5, 20], n_updates=2000, eval_every=500,
+                    n_grads=20, batch_size=100):
+    '''
+    Test bound and posterior gradient variance against wall-clock training
+    time, for each estimator and number of posterior samples.
+
+    Uses the model, optimizer and test samples of the `experiment` yaml.
+    Bounds are importance-sampled on a test batch, and the variance is the
+    total variance of the posterior gradients over `n_grads` estimates on a
+    training batch.
+    '''
+    exp_dict = load_experiment(experiment)
+    dataset_args = exp_dict['dataset_args']
+    if source is not None:
+        dataset_args['source'] = source
+    learning_args = exp_dict['learning_args']
+    train, _, test = load_data(train_batch_size=batch_size,
+                               test_batch_size=batch_size, **dataset_args)
+    x_t = _next(test)
+    x_v = _next(train)
+
+    dim_in = train.dims[train.name]
+    dim_h = exp_dict['dim_h']
+    X = T.matrix('x', dtype=floatX)
+    if exp_dict.get('center_input', True):
+        X_i = X - train.mean_image.astype(floatX)
+    else:
+        X_i = X
+
+    rows = []
+    for method in methods:
+        for n_posterior_samples in samples:
+            mlps = SBN.mlp_factory(
+                dim_h, train.dims, train.distributions,
+                recognition_net=exp_dict.get('recognition_net', None),
+                generation_net=exp_dict.get('generation_net', None))
+            model = SBN(dim_in, dim_h, prior=Binomial(dim_h), **mlps)
+            tparams = model.set_tparams()
+
+            inference = resolve_inference(model, inference_method=method)
+            results, _, constants, updates = inference(
+                X_i, X, n_posterior_samples=n_posterior_samples)
+            grads = T.grad(results['cost'], wrt=tparams.values(),
+                           consider_constant=constants)
+            lr = T.scalar('lr')
+            f_grad_shared, f_update = getattr(
+                op, learning_args.get('optimizer', 'rmsprop'))(
+                lr, tparams, grads, [X], results['cost'], extra_ups=updates)
+            f_grads = theano.function(
+                [X], T.grad(results['cost'], wrt=model.posterior.get_params(),
+                            consider_constant=constants),
+                updates=updates)
+
+            results_t, _, _, updates_t = resolve_inference(
+                model, inference_method='rws')(
+                X_i, X, n_posterior_samples=learning_args.get(
+                    'n_posterior_samples_test', 100))
+            f_test = theano.function([X], results_t['-log p(x)'],
+                                     updates=updates_t)
+
+            learning_rate = learning_args.get('learning_rate', 0.0001)
+            dt = 0.
+            for update in xrange(n_updates + 1):
+                if update % eval_every == 0:
+                    rows.append([method, n_posterior_samples, update, dt,
+                                 float(f_test(x_t)),
+                                 _grad_variance(f_grads, x_v, n_grads)])
+                if update == n_updates:
+                    break
+                x = _next(train)
+                t0 = time.time()
+                f_grad_shared(x)
+                f_update(learning_rate)
+                dt += time.time() - t0
+
+    print tabulate(rows, headers=['method', 'samples', 'updates', 's',
+                                  '-log p(x)', 'posterior grad variance'])
+    return rows
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    noise = subparsers.add_parser(
+        'noise', help='Preallocated vs per-step AIR inference noise')
+    noise.add_argument('-d', '--dim_in', default=784, type=int)
+    noise.add_argument('-H', '--dim_h', default=200, type=int)
+    noise.add_argument('-b', '--batch_size', default=100, type=int)
+    noise.add_argument('-s', '--n_inference_steps', default=20, type=int)
+    noise.add_argument('-i', '--n_inference_samples', default=100, type=int)
+    noise.add_argument('-n', '--n_calls', default=5, type=int)
+
+    deep_air = subparsers.add_parser(
+        'deep_air', help='All-layer vs block-coordinate DeepAIR')
+    deep_air.add_argument('experiment',
+                          help='Experiment yaml, e.g. sbn_air_200x3.yaml')
+    deep_air.add_argument('-l', '--model_file', default=None)
+    deep_air.add_argument('-S', '--source', default=None,
+                          help='Override the dataset source file')
+    deep_air.add_argument('-s', '--steps', nargs='+', type=int,
+                          default=[5, 10, 20, 40])
+    deep_air.add_argument('-b', '--batch_size', default=100, type=int)
+    deep_air.add_argument('-n', '--n_calls', default=5, type=int)
+
+    darn = subparsers.add_parser(
+        'darn', help='Per-dimension vs block autoregressive sampling')
+    darn.add_argument('-H', '--dim_h', default=200, type=int)
+    darn.add_argument('-n', '--n_samples', default=99, type=int)
+    darn.add_argument('-B', '--block_sizes', nargs='+', type=int,
+                      default=[8, 16, 32])
+    darn.add_argument('-c', '--n_calls', default=5, type=int)
+
+    mlp = subparsers.add_parser(
+        'mlp', help='3d dot vs flattened GEMMs in MLPs')
+    mlp.add_argument('-S', '--samples', nargs='+', type=int,
+                     default=[20, 100])
+    mlp.add_argument('-b', '--batch_size', default=100, type=int)
+    mlp.add_argument('-n', '--n_calls', default=10, type=int)
+
+    mmmlp = subparsers.add_parser(
+        'mmmlp', help='multimodal vs plain MLP conditionals')
+    mmmlp.add_argument('-d', '--dim_in', default=200, type=int)
+    mmmlp.add_argument('-D', '--dim_out', default=784, type=int)
+    mmmlp.add_argument('-M', '--n_modalities', nargs='+', default=[1, 4, 16],
+                       type=int)
+    mmmlp.add_argument('-S', '--n_samples', default=20, type=int)
+    mmmlp.add_argument('-b', '--batch_size', default=100, type=int)
+    mmmlp.add_argument('-n', '--n_calls', default=10, type=int)
+
+    lfmlp = subparsers.add_parser(
+        'lfmlp', help='local filters vs dense masked layer')
+    lfmlp.add_argument('-P', '--prototype_shape', nargs='+', default=[28, 28],
+                       type=int)
+    lfmlp.add_argument('-F', '--filter_shape', nargs='+', default=[5, 5],
+                       type=int)
+    lfmlp.add_argument('-s', '--stride', default=2, type=int)
+    lfmlp.add_argument('-f', '--dim_f', default=4, type=int)
+    lfmlp.add_argument('-S', '--n_samples', default=20, type=int)
+    lfmlp.add_argument('-b', '--batch_size', default=100, type=int)
+    lfmlp.add_argument('-n', '--n_calls', default=10, type=int)
+
+    precision = subparsers.add_parser(
+        'precision', help='float32 vs reduced precision storage')
+    precision.add_argument('-m', '--methods', nargs='+', default=['air', 'rws'])
+    precision.add_argument('-d', '--dim_in', default=784, type=int)
+    precision.add_argument('-H', '--dim_h', default=200, type=int)
+    precision.add_argument('-b', '--batch_size', default=100, type=int)
+    precision.add_argument('-s', '--n_inference_steps', default=20, type=int)
+    precision.add_argument('-i', '--n_inference_samples', default=20, type=int)
+    precision.add_argument('-p', '--n_posterior_samples', default=100,
+                           type=int)
+    precision.add_argument('-n', '--n_calls', default=5, type=int)
+    precision.add_argument('-P', '--precisions', nargs='+',
+                           default=['float32', 'float16', 'bfloat16'])
+
+    dedup = subparsers.add_parser(
+        'dedup', help='test bound with and without sample deduplication')
+    dedup.add_argument('-d', '--dim_in', default=784, type=int)
+    dedup.add_argument('-H', '--dim_h', default=200, type=int)
+    dedup.add_argument('-b', '--batch_size', default=100, type=int)
+    dedup.add_argument('-p', '--n_posterior_samples', default=1000, type=int)
+    dedup.add_argument('-B', '--biases', nargs='+', default=[0, 2, 4, 8],
+                       type=float)
+    dedup.add_argument('-n', '--n_calls', default=3, type=int)
+
+    vimco = subparsers.add_parser(
+        'vimco', help='RWS vs VIMCO bound and gradient variance over time')
+    vimco.add_argument('experiment',
+                       help='Experiment yaml, e.g. sbn_rws_200.yaml')
+    vimco.add_argument('-S', '--source', default=None,
+                       help='Override the dataset source file')
+    vimco.add_argument('-m', '--methods', nargs='+',
+                       default=['rws', 'vimco'])
+    vimco.add_argument('-s', '--samples', nargs='+', type=int,
+                       default=[2, 5, 20])
+    vimco.add_argument('-u', '--n_updates', default=2000, type=int)
+    vimco.add_argument('-e', '--eval_every', default=500, type=int)
+    vimco.add_argument('-g', '--n_grads', default=20, type=int)
+    vimco.add_argument('-b', '--batch_size', default=100, type=int)
+
+    return parser
+
+if __name__ == '__main__':
+    parser = make_argument_parser()
+    args = vars(parser.parse_args())
+    benchmark = args.pop('benchmark')
+
+    if benchmark == 'noise':
+        benchmark_noise(**args)
+    elif benchmark == 'deep_air':
+        benchmark_deep_air(**args)
+    elif benchmark == 'darn':
+        benchmark_darn(**args)
+    elif benchmark == 'mlp':
+        benchmark_mlp(**args)
+    elif benchmark == 'mmmlp':
+        benchmark_mmmlp(**args)
+    elif benchmark == 'lfmlp':
+        benchmark_lfmlp(**args)
+    elif benchmark == 'precision':
+        benchmark_precision(**args)
+    elif benchmark == 'dedup':
+        benchmark_dedup(**args)
+    elif benchmark == 'vimco':
+        benchmark_vimco(**args)
+    else:
+        raise ValueError(benchmark)
@@ -23,18 +23,33 @@ import time
 from datasets.caltech import CALTECH
 from datasets.mnist import MNIST
 from datasets.uci import UCI
+from exact import log_likelihood as exact_log_likelihood
 from inference import resolve as resolve_inference
+from models.distributions import (
+    Binomial,
+    CenteredBinomial
+)
 from models.dsbn import unpack as unpack_dsbn
 from models.gbn import unpack as unpack_gbn
 from models.mlp import MLP
 from models.sbn import unpack as unpack_sbn
+from numpy_inference import (
+    NumpyMLP,
+    NumpySBN
+)
 from utils import floatX
+from utils.function_cache import (
+    cached_functions,
+    get_key as function_cache_key,
+    model_signature
+)
 from utils.tools import (
     check_bad_nums,
     itemlist,
     load_model,
     load_experiment,
     log_sum_exp,
+    steps_histogram,
     update_dict_of_lists,
     _slice
 )
@@ -105,53 +120,67 @@ def sample_from_prior(models, data_iter, name, out_dir):
     model = models['main']
     tparams = model.set_tparams()
 
-    py_p, updates = model.sample_from_prior()
-    f_prior = theano.function([], py_p, updates=updates)
-    samples = f_prior()
+    if hasattr(model.prior, 'sample_numpy'):
+        # Autoregressive priors are faster to sample without a graph.
+        H = T.matrix('H', dtype=floatX)
+        f_prior = theano.function([H], model.conditional.feed(H))
+        samples = f_prior(model.prior.sample_numpy(99))
+    else:
+        py_p, updates = model.sample_from_prior()
+        f_prior = theano.function([], py_p, updates=updates)
+        samples = f_prior()
     data_iter.save_images(
         samples[:, None],
         path.join(out_dir, name + '_samples_from_prior.png'),
         x_limit=10)
 
-def calculate_true_likelihood(models, data_iter):
+def calculate_true_likelihood(models, data_iter, name, dx=100,
+                              chunk_size=4096, n_workers=1):
+    '''
+    Exact log p(x) by enumerating latent states in Gray-code order.
+
+    Only single-layer SBNs with a binomial prior and an MLP conditional with
+    a binomial distribution are supported.
+    '''
     model = models['main']
-    H = T.matrix('H', dtype=floatX)
-    Y = T.matrix('Y', dtype=floatX)
-    log_ph = -model.prior.neg_log_prob(H)
-    py = model.conditional(H)
-    log_py_h = -model.conditional.neg_log_prob(Y, py)
-    log_p = log_ph + log_py_h
-    log_px = log_sum_exp(log_p, axis=0)
-
-    f_test = theano.function([Y, H], log_px)
-
-    dim = model.dim_h
-    h_i = np.array([[i] for i in range(2 ** dim)], dtype=np.uint8)
-    h = np.unpackbits(h_i, axis=1)[:, -dim:].astype(floatX)
-
-    vals = []
-    widgets = ['Calculating LL %s:' % name, Timer(), Bar()]
-    pbar = ProgressBar(maxval=data_iter.n).start()
+
+    def is_binomial(distribution):
+        # Centered binomials are tanh units, not the sigmoid units of NumpySBN.
+        return (isinstance(distribution, Binomial)
+                and not isinstance(distribution, CenteredBinomial))
+
+    if (not is_binomial(model.prior)
+        or model.conditional.__class__ is not MLP
+        or not is_binomial(model.conditional.distribution)):
+        raise NotImplementedError('Exact likelihood needs a binomial prior '
+                                  'and MLP conditional with a binomial '
+                                  'distribution')
+
+    params = dict((k, v.get_value()) for k, v in model.set_tparams().items())
+    conditional = NumpyMLP.from_params(
+        params, model.conditional.name, h_act=model.conditional.h_act)
+    numpy_model = NumpySBN(None, conditional, params['binomial_z'])
+
+    # The codes are enumerated once for all examples.
+    ys = []
     while True:
         try:
-            y, _ = data_iter.next(batch_size=dx)
+            ys.append(data_iter.next(batch_size=dx)[data_iter.name])
         except StopIteration:
             break
-        r = f_test(y, h)
-        vals.append(r)
-
-        if data_iter.pos == -1:
-            pbar.update(data_iter.n)
-        else:
-            pbar.update(data_iter.pos)
-    print
-    print 'LL: ', np.mean(vals)
+    print 'Calculating LL %s over %d examples' % (name, sum(map(len, ys)))
+    vals = exact_log_likelihood(numpy_model, np.concatenate(ys),
+                                chunk_size=chunk_size, n_workers=n_workers)
+    nll = -vals.mean()
+    print 'Exact -log p(x): ', nll
+    return nll
 
 def test(models, data_iter, name, mean_image, deep=False,
          data_samples=10000, n_posterior_samples=1000,
          inference_args=None, inference_method=None,
-         dx=100, calculate_true_likelihood=False,
-         center_input=True, **extra_kwargs):
+         dx=100, exact_likelihood=False, n_exact_workers=1,
+         center_input=True, chunk_size=None, function_cache=None,
+         **extra_kwargs):
 
     model = models['main']
     tparams = model.set_tparams()
@@ -166,27 +195,53 @@ def test(models, data_iter, name, mean_image, deep=False,
     else:
         X_i = X.copy()
 
-    inference = resolve_inference(model, deep=deep,
-                                  inference_method=inference_method,
-                                  **inference_args)
-
-    if inference_method == 'momentum':
-        if prior == 'binomial':
-            raise NotImplementedError()
-        results, samples, full_results, updates = inference(
-            X_i, X,
-            n_posterior_samples=n_posterior_samples)
-    elif inference_method == 'air':
-        results, samples, full_results, updates = inference(
-            X_i, X, n_posterior_samples=n_posterior_samples)
+    def build():
+        inference = resolve_inference(model, deep=deep,
+                                      inference_method=inference_method,
+                                      **inference_args)
+
+        if inference_method == 'momentum':
+            if prior == 'binomial':
+                raise NotImplementedError()
+            results, samples, full_results, updates = inference(
+                X_i, X,
+                n_posterior_samples=n_posterior_samples)
+        elif inference_method == 'air':
+            model_args = dict()
+            if chunk_size is not None:
+                model_args['chunk_size'] = chunk_size
+            results, samples, full_results, updates = inference(
+                X_i, X, n_posterior_samples=n_posterior_samples, **model_args)
+        else:
+            raise ValueError(inference_method)
+
+        return OrderedDict(
+            f_test=theano.function([X], results.values(), updates=updates),
+            f_test_keys=results.keys()
+        )
+
+    shared = OrderedDict(tparams)
+    if center_input:
+        shared['X_mean'] = X_mean
+
+    if function_cache is not None:
+        cache_key = function_cache_key(
+            model=model_signature(model), deep=deep,
+            center_input=center_input, inference_method=inference_method,
+            inference_args=inference_args,
+            n_posterior_samples=n_posterior_samples, chunk_size=chunk_size)
     else:
-        raise ValueError(inference_method)
+        cache_key = None
+
+    functions, _ = cached_functions(function_cache, cache_key, shared, build,
+                                    model=model)
+    f_test_keys = functions['f_test_keys']
+    f_test = functions['f_test']
 
-    f_test_keys  = results.keys()
-    f_test       = theano.function([X], results.values(), updates=updates)
     widgets = ['Testing %s:' % name, Timer(), Bar()]
     pbar = ProgressBar(maxval=data_iter.n).start()
     rs = OrderedDict()
+    step_hists = []
     while True:
         try:
             y = data_iter.next(batch_size=dx)[data_iter.name]
@@ -194,6 +249,9 @@ def test(models, data_iter, name, mean_image, deep=False,
             break
         r = f_test(y)
         rs_i = dict((k, v) for k, v in zip(f_test_keys, r))
+        if 'n_steps' in rs_i.keys():
+            step_hists.append(steps_histogram(
+                rs_i['n_steps'], max_steps=inference_args['n_inference_steps']))
         update_dict_of_lists(rs, **rs_i)
 
         if data_iter.pos == -1:
@@ -202,12 +260,24 @@ def test(models, data_iter, name, mean_image, deep=False,
             pbar.update(data_iter.pos)
     print
 
+    if len(step_hists) > 0:
+        print 'Inference steps used per batch (steps: examples):'
+        for i, hist in enumerate(step_hists):
+            print 'Batch %d: %s' % (i, ', '.join(
+                '%d: %d' % (s, c) for s, c in enumerate(hist) if c > 0))
+        print 'Total: %s' % np.sum(step_hists, axis=0).tolist()
+
     def summarize(d):
         for k, v in d.iteritems():
             d[k] = np.mean(v)
 
     summarize(rs)
 
+    if exact_likelihood:
+        data_iter.reset()
+        rs['exact -log p(x)'] = calculate_true_likelihood(
+            models, data_iter, name, dx=dx, n_workers=n_exact_workers)
+
     return rs
 
 def compare(model_dirs,
@@ -319,6 +389,18 @@ def make_argument_parser():
     parser.add_argument('-s', '--n_inference_steps', default=100, type=int)
     parser.add_argument('-b', '--batch_size', default=100, type=int)
     parser.add_argument('-r', '--inference_rate', default=0.1, type=float)
+    parser.add_argument('-c', '--chunk_size', default=None, type=int,
+                        help='Stream posterior samples in chunks of this size')
+    parser.add_argument('-T', '--inference_tol', default=None, type=float,
+                        help='Freeze examples whose refinement changes less '
+                        'than this and stop once all have converged')
+    parser.add_argument('-C', '--function_cache', default=None,
+                        help='Directory for caching compiled functions')
+    parser.add_argument('-e', '--exact', action='store_true',
+                        help='Also compute the exact likelihood by '
+                        'enumerating latent states (small dim_h only)')
+    parser.add_argument('-w', '--n_exact_workers', default=1, type=int,
+                        help='Worker processes for the exact likelihood')
     return parser
 
 if __name__ == '__main__':
@@ -336,6 +418,7 @@ if __name__ == '__main__':
         inference_rate=args.inference_rate,
         n_inference_samples=args.n_inference_samples,
         n_inference_steps=args.n_inference_steps,
+        inference_tol=args.inference_tol
     )
 
     compare(models, args.out_path, name=name,
@@ -343,4 +426,8 @@ if __name__ == '__main__':
             n_posterior_samples=args.n_posterior_samples,
             inference_args=inference_args,
             dx=args.batch_size,
+            chunk_size=args.chunk_size,
+            function_cache=args.function_cache,
+            exact_likelihood=args.exact,
+            n_exact_workers=args.n_exact_workers,
             by_training_time=args.by_time)
@@ -32,6 +32,11 @@ from utils import (
     floatX,
     op
 )
+from utils.function_cache import (
+    cached_functions,
+    get_key as function_cache_key,
+    model_signature
+)
 from utils.tools import (
     check_bad_nums,
     itemlist,
@@ -60,6 +65,7 @@ def eval_model(
     mode='valid',
     prior='binomial',
     dataset_args=None,
+    function_cache=None,
     **kwargs):
 
     if dim_h is None:
@@ -120,53 +126,74 @@ def eval_model(
         X_i = X
 
     x = data_iter.next()[data_iter.name]
-    if drop_units:
-        print 'Dropping %.2f%% of units' % (100 * drop_units)
-        q0 = model.posterior(X_i)
-        r = model.trng.binomial(p=1-drop_units, size=q0.shape, dtype=floatX)
-        q0 = q0 * r + 0.5 * (1. - r)
-    else:
-        q0 = None
-
-    inference = resolve_inference(model, **inference_args)
-
-    if inference_method == 'momentum':
-        if prior == 'binomial':
-            raise NotImplementedError()
-        results, samples, full_results, updates_s = inference(
-            X_i, X,
-            n_posterior_samples=n_posterior_samples)
-    elif inference_method == 'air':
-        results, samples, full_results, updates_s = inference(
-            X_i, X, n_posterior_samples=n_posterior_samples)
+
+    def build():
+        if drop_units:
+            print 'Dropping %.2f%% of units' % (100 * drop_units)
+            q0 = model.posterior(X_i)
+            r = model.trng.binomial(p=1-drop_units, size=q0.shape, dtype=floatX)
+            q0 = q0 * r + 0.5 * (1. - r)
+        else:
+            q0 = None
+
+        inference = resolve_inference(model, **inference_args)
+
+        if inference_method == 'momentum':
+            if prior == 'binomial':
+                raise NotImplementedError()
+            results, samples, full_results, updates_s = inference(
+                X_i, X,
+                n_posterior_samples=n_posterior_samples)
+        elif inference_method == 'air':
+            results, samples, full_results, updates_s = inference(
+                X_i, X, n_posterior_samples=n_posterior_samples)
+        else:
+            raise ValueError(inference_method)
+
+        b_py = samples['py'][0]
+        py = samples['py'][-1]
+
+        if metric == 'likelihood':
+            energies0 = samples['batch_energies'][0]
+            energiesk = samples['batch_energies'][-1]
+            distance = energiesk - energies0
+        elif metric == 'cosine':
+            q0 = samples['q'][0]
+            qk = samples['q'][-1]
+            distance = (q0 * qk).sum(axis=1) / (q0.norm(L=2) * qk.norm(L=2))
+        elif metric == 'manhattan':
+            q0 = samples['q'][0]
+            qk = samples['q'][-1]
+            distance = -(abs(q0 - qk)).sum(axis=1)
+        else:
+            raise ValueError(metric)
+
+        best_idx = distance.argsort()[:1000].astype('int64')
+        p_best = T.concatenate([X[best_idx][None, :, :],
+                                b_py[:, best_idx].mean(axis=0)[None, :, :],
+                                py[:, best_idx].mean(axis=0)[None, :, :]])
+        return OrderedDict(
+            f_best=theano.function([X], p_best, updates=updates_s))
+
+    shared = OrderedDict(tparams)
+    if center_input:
+        shared['X_mean'] = X_mean
+
+    if function_cache is not None:
+        cache_key = function_cache_key(
+            model=model_signature(model), center_input=center_input,
+            inference_args=inference_args,
+            n_posterior_samples=n_posterior_samples, metric=metric,
+            drop_units=drop_units)
     else:
-        raise ValueError(inference_method)
+        cache_key = None
+
+    functions, _ = cached_functions(function_cache, cache_key, shared, build,
+                                    model=model)
+    f_best = functions['f_best']
 
     print 'Saving sampling from posterior'
     x_test = x
-    b_py = samples['py'][0]
-    py = samples['py'][-1]
-
-    if metric == 'likelihood':
-        energies0 = samples['batch_energies'][0]
-        energiesk = samples['batch_energies'][-1]
-        distance = energiesk - energies0
-    elif metric == 'cosine':
-        q0 = samples['q'][0]
-        qk = samples['q'][-1]
-        distance = (q0 * qk).sum(axis=1) / (q0.norm(L=2) * qk.norm(L=2))
-    elif metric == 'manhattan':
-        q0 = samples['q'][0]
-        qk = samples['q'][-1]
-        distance = -(abs(q0 - qk)).sum(axis=1)
-    else:
-        raise ValueError(metric)
-
-    best_idx = distance.argsort()[:1000].astype('int64')
-    p_best = T.concatenate([X[best_idx][None, :, :],
-                            b_py[:, best_idx].mean(axis=0)[None, :, :],
-                            py[:, best_idx].mean(axis=0)[None, :, :]])
-    f_best = theano.function([X], p_best, updates=updates_s)
     py_best = f_best(x_test)
 
     data_iter.save_images(
@@ -198,6 +225,11 @@ def make_argument_parser():
                         help='Drop latent units before refinement')
     parser.add_argument('-t', '--transpose', action='store_true',
                         help='Transpose the reconstruction images')
+    parser.add_argument('-T', '--inference_tol', default=None, type=float,
+                        help='Freeze examples whose refinement changes less '
+                        'than this and stop once all have converged')
+    parser.add_argument('-C', '--function_cache', default=None,
+                        help='Directory for caching compiled functions')
     return parser
 
 if __name__ == '__main__':
@@ -229,7 +261,8 @@ if __name__ == '__main__':
     inference_args = OrderedDict(
         inference_rate=args.inference_rate,
         n_inference_samples=args.n_inference_samples,
-        n_inference_steps=args.n_inference_steps
+        n_inference_steps=args.n_inference_steps,
+        inference_tol=args.inference_tol
     )
 
     exp_dict.pop('inference_args')
@@ -240,4 +273,5 @@ if __name__ == '__main__':
                n_posterior_samples=args.n_posterior_samples,
                data_samples=args.data_samples,
                drop_units=args.drop_units,
+               function_cache=args.function_cache,
                **exp_dict)
@@ -0,0 +1,166 @@
+'''
+Exact log likelihood of small binomial SBNs by enumerating latent states.
+
+The 2 ** dim_h latent configurations are walked in Gray-code order, so each
+configuration differs from the previous one in a single unit. The
+first-layer preactivation of the conditional and log p(h) are then updated
+by adding or subtracting one row of weights instead of recomputing a
+product. Configurations are processed in chunks, each started exactly from
+its first code so rounding errors do not build up. Each chunk's conditional is
+computed once and applied to all examples, and log p(x) is accumulated with
+a running log-sum-exp. Ranges of codes can be split across
+worker processes, whose partial sums are then combined.
+
+Usage:
+
+    python exact.py <model_file> <data.npy> -c 4096 -w 8
+'''
+
+import argparse
+import multiprocessing as mp
+import numpy as np
+import time
+
+from numpy_inference import (
+    floatX,
+    load_model
+)
+
+
+def gray_code(i):
+    return i ^ (i >> 1)
+
+def gray_chunk(start, stop, dim):
+    '''
+    Gray codes `start` to `stop` as the first code and single-unit flips.
+
+    Returns:
+        h0: np.array. (dim,) 0/1 units of the code `start` (unit k is bit k).
+        units: np.array. (stop - start - 1,) unit flipped at each next code.
+        signs: np.array. +1 where the flipped unit turns on, -1 otherwise.
+
+    '''
+    h0 = (gray_code(start) >> np.arange(dim)) & 1
+    i = np.arange(start + 1, stop, dtype=np.int64)
+    # Code i flips the lowest set bit of i.
+    units = np.log2(i & -i).astype(np.int64)
+    signs = 2 * ((gray_code(i) >> units) & 1) - 1
+    return h0, units, signs
+
+def chunk_terms(model, start, stop):
+    '''
+    Terms of log p(y, h) that do not depend on y, for the Gray codes `start`
+    to `stop` of h.
+
+    Returns:
+        log_odds: np.array. (stop - start, dim_in) log p(y_i=1|h) -
+            log p(y_i=0|h).
+        log_p0: np.array. (stop - start,) log p(y=0|h) + log p(h).
+
+    '''
+    conditional = model.conditional
+    W = conditional.Ws[0].astype('float64')
+    h0, units, signs = gray_chunk(start, stop, model.dim_h)
+
+    deltas = np.zeros((stop - start, W.shape[1]))
+    deltas[0] = np.dot(h0, W) + conditional.bs[0]
+    deltas[1:] = signs[:, None] * W[units]
+    preact = np.cumsum(deltas, axis=0).astype(floatX)
+
+    p_prior = model.prior_p.astype('float64')
+    logit_prior = np.log(p_prior) - np.log(1. - p_prior)
+    deltas = np.zeros((stop - start,))
+    deltas[0] = np.dot(h0, logit_prior) + np.log(1. - p_prior).sum()
+    deltas[1:] = signs * logit_prior[units]
+    log_ph = np.cumsum(deltas)
+
+    py = conditional.feed_preact(preact)
+    log_1mp = np.log(1. - py)
+    return np.log(py) - log_1mp, log_1mp.sum(axis=1) + log_ph
+
+def combine(a, b):
+    '''
+    Combines running log-sum-exps (max, sum of exp(x - max)).
+    '''
+    (m_a, s_a), (m_b, s_b) = a, b
+    m = np.maximum(m_a, m_b)
+    return m, s_a * np.exp(m_a - m) + s_b * np.exp(m_b - m)
+
+def accumulate(model, y, start, stop, chunk_size=4096, block_size=1000):
+    '''
+    Running log-sum-exp of log p(y, h) over the Gray codes `start` to `stop`.
+
+    The conditional is evaluated once per chunk of codes and applied to the
+    examples `y` in blocks of `block_size`.
+    '''
+    y = y.astype(floatX)
+    m = np.zeros((y.shape[0],)) - np.inf
+    s = np.zeros((y.shape[0],))
+    for i in xrange(start, stop, chunk_size):
+        log_odds, log_p0 = chunk_terms(model, i, min(i + chunk_size, stop))
+        for j in xrange(0, y.shape[0], block_size):
+            log_p = np.dot(y[j:j+block_size], log_odds.T) + log_p0[None, :]
+            m_b = log_p.max(axis=1)
+            m[j:j+block_size], s[j:j+block_size] = combine(
+                (m[j:j+block_size], s[j:j+block_size]),
+                (m_b, np.exp(log_p - m_b[:, None]).sum(axis=1)))
+    return m, s
+
+def _accumulate(args):
+    return accumulate(*args)
+
+def log_likelihood(model, y, chunk_size=4096, n_workers=1, block_size=1000):
+    '''
+    Exact log p(y) of a binomial `NumpySBN`, splitting the codes over
+    `n_workers` processes.
+
+    The codes are enumerated once for all of `y`, so pass every example in
+    one call rather than batch by batch.
+    '''
+    n_codes = 2 ** model.dim_h
+    n_workers = max(1, min(n_workers, n_codes // chunk_size))
+    bounds = [n_codes * w // n_workers for w in xrange(n_workers + 1)]
+    tasks = [(model, y, start, stop, chunk_size, block_size)
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    if n_workers == 1:
+        partials = map(_accumulate, tasks)
+    else:
+        pool = mp.Pool(n_workers)
+        try:
+            partials = pool.map(_accumulate, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    m, s = reduce(combine, partials)
+    return m + np.log(s)
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_file', help='Checkpoint (.npz) from training')
+    parser.add_argument('data', help='Data to score (.npy)')
+    parser.add_argument('-c', '--chunk_size', default=4096, type=int,
+                        help='Latent configurations per chunk')
+    parser.add_argument('-w', '--n_workers', default=1, type=int,
+                        help='Worker processes to split the codes across')
+    parser.add_argument('-b', '--block_size', default=1000, type=int,
+                        help='Examples scored per product with a chunk')
+    return parser
+
+if __name__ == '__main__':
+    t0 = time.time()
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    # Only the conditional and prior are used, so centering does not matter.
+    model, _ = load_model(args.model_file, mean_image=np.float32(0.))
+    data = np.load(args.data)
+    print 'Enumerating %d latent configurations' % (2 ** model.dim_h)
+
+    log_px = log_likelihood(model, data, chunk_size=args.chunk_size,
+                            n_workers=args.n_workers,
+                            block_size=args.block_size)
+
+    print '-log p(x): %.4f' % -log_px.mean()
+    print 'Done in %.2f seconds' % (time.time() - t0)
@@ -18,6 +18,7 @@ import sys
 import theano
 from theano import tensor as T
 import time
+import warnings
 
 from datasets import load_data
 from inference import resolve as resolve_inference
@@ -39,8 +40,15 @@ from models.sbn import (
     unpack as unpack_sbn
 )
 from utils.monitor import SimpleMonitor
+from utils.flat_params import FlatParams
+from utils.posterior_cache import PosteriorCache
+from utils.precision import check_precision
 from utils import floatX
 from utils import op
+from utils.function_cache import (
+    cached_functions,
+    get_key as function_cache_key
+)
 from utils.tools import (
     check_bad_nums,
     get_trng,
@@ -75,8 +83,16 @@ def init_learning_args(
     epochs=100,
     n_posterior_samples=20,
     n_posterior_samples_test=20,
+    posterior_chunk_size_test=None,
+    dedup_samples_test=False,
     valid_key='lower_bound',
     valid_sign='-',
+    warm_start=False,
+    warm_start_dtype='float16',
+    fused_bound=False,
+    diagnostics='endpoints',
+    precision='float32',
+    flat_params=False,
     excludes=['gaussian_log_sigma', 'gaussian_mu']):
     return locals()
 
@@ -86,9 +102,203 @@ def init_inference_args(
     inference_rate=0.01,
     n_inference_steps=0,
     n_inference_samples=0,
-    pass_gradients=True):
-    return locals()
+    pass_gradients=True,
+    **extra_args):
+    '''
+    Extra arguments (e.g., `inference_tol` or `ess_target`) are passed on to
+    the inference method.
+    '''
+    inference_args = locals()
+    inference_args.update(inference_args.pop('extra_args'))
+    return inference_args
+
+
+def build_functions(model, X, X_i, tparams, prior, deep, learning_args,
+                    inference_args, inference_args_test, flat_params=None):
+    '''
+    Forms the training and test graphs and compiles their functions.
+
+    With `flat_params`, `tparams` are views of its buffer, and the optimizer
+    updates the buffer with the concatenated gradients.
+    '''
+
+    # ==========================================================================
+    print_section('Getting cost')
+
+    inference_method = inference_args['inference_method']
+    inps = [X]
+
+    if inference_method is not None:
+        inference = resolve_inference(model, deep=deep, **inference_args)
+    else:
+        inference = None
+
+    if learning_args['warm_start'] and inference_method != 'air':
+        raise NotImplementedError('Warm starts are only supported for AIR')
+
+    if inference_method == 'momentum':
+        if prior == 'binomial':
+            raise NotImplementedError()
+        i_results, constants, updates = inference.inference(X_i, X)
+        qk = i_results['qk']
+        results, samples, constants_m = model(
+            X_i, X, qk, pass_gradients=inference_args['pass_gradients'],
+            n_posterior_samples=learning_args['n_posterior_samples'])
+        constants += constants_m
+    elif inference_method in ['rws', 'vimco']:
+        results, _, constants, updates = inference(
+            X_i, X, n_posterior_samples=learning_args['n_posterior_samples'])
+    elif inference_method == 'air':
+        if prior == 'gaussian':
+            raise NotImplementedError()
+        if learning_args['warm_start']:
+            if deep:
+                raise NotImplementedError()
+            Q_c = T.matrix('q_c', dtype=floatX)
+            inps.append(Q_c)
+            q0 = inference.init_warm_start(X_i, Q_c)
+        else:
+            q0 = None
+        fused_bound = learning_args['fused_bound']
+        if fused_bound and (
+                deep or inference_args['n_inference_steps'] < 1
+                or inference_args.get('ess_target', None) is not None
+                or (learning_args['n_posterior_samples']
+                    != inference_args['n_inference_samples'])):
+            print ('Fused bound needs a single-layer model, a fixed number of '
+                   'inference samples equal to the posterior samples and at '
+                   'least one inference step. Resampling instead.')
+            fused_bound = False
+
+        if fused_bound:
+            i_results, constants, updates, state = inference.inference_fused(
+                X_i, X, q0=q0)
+            qk = i_results['qk']
+            results, _, _ = model(X_i, X, state=state)
+        else:
+            i_results, constants, updates = inference.inference(X_i, X, q0=q0)
+            qk = i_results['qk']
+            results, _, _ = model(
+                X_i, X, qk,
+                n_posterior_samples=learning_args['n_posterior_samples'])
+    elif inference_method is None:
+        if prior != 'gaussian':
+            raise NotImplementedError()
+        qk = None
+        constants = []
+        updates = theano.OrderedUpdates()
+        results, samples, constants_m = model(
+            X_i, X, qk, pass_gradients=inference_args['pass_gradients'],
+            n_posterior_samples=learning_args['n_posterior_samples'])
+        constants += constants_m
+    else:
+        raise ValueError(inference_method)
+
+    cost = results.pop('cost')
+    extra_outs = []
+    extra_outs_keys = ['cost']
+
+    l2_decay = learning_args['l2_decay']
+    if l2_decay > 0.:
+        print 'Adding %.5f L2 weight decay' % l2_decay
+        l2_rval = model.l2_decay(l2_decay)
+        cost += l2_rval.pop('cost')
+        extra_outs += l2_rval.values()
+        extra_outs_keys += l2_rval.keys()
+
+    if learning_args['warm_start']:
+        # Refined posteriors are returned last to update the cache.
+        extra_outs.append(qk)
+        extra_outs_keys.append('qk')
+
+    # ==========================================================================
+    print_section('Test functions')
+    # Test function with sampling
+    inference_method_test = inference_args_test['inference_method']
+    if inference_method_test == 'vimco':
+        # VIMCO only changes the posterior gradient. Its bound is the RWS
+        # bound, which can be chunked.
+        inference_method_test = 'rws'
+        inference_args_test = dict(inference_args_test,
+                                   inference_method=inference_method_test)
+    if inference_method_test is not None:
+        inference = resolve_inference(model, deep=deep, **inference_args_test)
+    else:
+        inference = None
+
+    if inference_method_test == 'momentum':
+        if prior == 'binomial':
+            raise NotImplementedError()
+        results, samples, full_results, updates_s = inference(
+            X_i, X,
+            n_posterior_samples=learning_args['n_posterior_samples_test'],
+            diagnostics=learning_args['diagnostics'])
+        py = samples['py'][-1]
+    elif inference_method_test == 'rws':
+        results, samples, _, updates_s = inference(
+            X_i, X, n_posterior_samples=learning_args['n_posterior_samples_test'],
+            chunk_size=learning_args['posterior_chunk_size_test'],
+            dedup=learning_args['dedup_samples_test'])
+        py = samples['py']
+    elif inference_method_test == 'air':
+        model_args = dict(diagnostics=learning_args['diagnostics'])
+        if learning_args['posterior_chunk_size_test'] is not None:
+            model_args['chunk_size'] = learning_args['posterior_chunk_size_test']
+        if learning_args['dedup_samples_test']:
+            model_args['dedup'] = True
+        results, samples, full_results, updates_s = inference(
+            X_i, X, n_posterior_samples=learning_args['n_posterior_samples_test'],
+            **model_args)
+        py = samples['py'][-1]
+    elif inference_method_test is None:
+        updates_s = theano.OrderedUpdates()
+        py = samples['py']
+    else:
+        raise ValueError(inference_method_test)
+
+    f_test_keys = results.keys()
+    f_test = theano.function([X], results.values(), updates=updates_s)
+    f_icost = theano.function([X], full_results['i_cost'], updates=updates_s)
+
+    # ========================================================================
+    print_section('Setting final tparams')
+
+    tparams = OrderedDict((k, v)
+        for k, v in tparams.iteritems()
+        if (v not in updates.keys()
+            or v not in learning_args['excludes']))
+
+    print 'Learned model params: %s' % tparams.keys()
+
+    # ========================================================================
+    print_section('Getting gradients.')
+    grads = T.grad(cost, wrt=itemlist(tparams),
+                   consider_constant=constants)
+    if flat_params is not None:
+        assert tparams.keys() == flat_params.views.keys()
+        grads = [flat_params.flatten(grads)]
+        tparams = OrderedDict(params=flat_params.buffer)
+
+    # ========================================================================
+    print_section('Building optimizer')
+    lr = T.scalar(name='lr')
+    optimizer = learning_args['optimizer']
+    optimizer_args = learning_args['optimizer_args']
+    if flat_params is not None and optimizer in ['adam', 'rmsprop2']:
+        warnings.warn('Column norms of weights are not clipped with flat '
+                      'params.', RuntimeWarning)
+    f_grad_shared, f_grad_updates = eval('op.' + optimizer)(
+        lr, tparams, grads, inps, cost, extra_ups=updates,
+        extra_outs=extra_outs, **optimizer_args)
 
+    return OrderedDict(
+        f_grad_shared=f_grad_shared,
+        f_grad_updates=f_grad_updates,
+        f_test=f_test,
+        f_icost=f_icost,
+        f_test_keys=f_test_keys,
+        extra_outs_keys=extra_outs_keys
+    )
 
 def train(
     out_path='', name='', model_to_load=None, save_images=True,
@@ -98,7 +308,8 @@ def train(
     learning_args=dict(),
     inference_args=dict(),
     inference_args_test=dict(),
-    dataset_args=None):
+    dataset_args=None,
+    function_cache=None):
 
     if dim_h is None:
         assert dim_hs is not None
@@ -188,113 +399,83 @@ def train(
         models[model.name] = model
 
     model = models[model_name]
+    check_precision(learning_args['precision'])
+    if learning_args['precision'] != 'float32':
+        if deep or prior == 'gaussian':
+            raise NotImplementedError('Reduced precision is only supported '
+                                      'for single layer SBNs')
+        print 'Using %s sample and activation storage' % learning_args['precision']
+        if learning_args['precision'] == 'float16' and theano.config.device == 'cpu':
+            warnings.warn('float16 elementwise ops have no C implementation '
+                          'on the CPU and run in Python. Use `bfloat16` to '
+                          'check accuracy on the CPU.', RuntimeWarning)
+        if learning_args['precision'] == 'bfloat16':
+            print ('bfloat16 is emulated by rounding %s tensors and saves no '
+                   'memory' % floatX)
+        model.precision = learning_args['precision']
+    if learning_args['dedup_samples_test'] and (deep or prior == 'gaussian'):
+        raise NotImplementedError('Sample deduplication is only supported '
+                                  'for single layer SBNs')
     tparams = model.set_tparams(excludes=[])
     print_profile(tparams)
 
-    # ==========================================================================
-    print_section('Getting cost')
-
-    inference_method = inference_args['inference_method']
-
-    if inference_method is not None:
-        inference = resolve_inference(model, deep=deep, **inference_args)
-    else:
-        inference = None
-
-    if inference_method == 'momentum':
-        if prior == 'binomial':
-            raise NotImplementedError()
-        i_results, constants, updates = inference.inference(X_i, X)
-        qk = i_results['qk']
-        results, samples, constants_m = model(
-            X_i, X, qk, pass_gradients=inference_args['pass_gradients'],
-            n_posterior_samples=learning_args['n_posterior_samples'])
-        constants += constants_m
-    elif inference_method == 'rws':
-        results, _, constants = inference(
-            X_i, X, n_posterior_samples=learning_args['n_posterior_samples'])
-        updates = theano.OrderedUpdates()
-    elif inference_method == 'air':
-        if prior == 'gaussian':
-            raise NotImplementedError()
-        i_results, constants, updates = inference.inference(X_i, X)
-        qk = i_results['qk']
-        results, _, _ = model(
-            X_i, X, qk, n_posterior_samples=learning_args['n_posterior_samples'])
-    elif inference_method is None:
-        if prior != 'gaussian':
-            raise NotImplementedError()
-        qk = None
-        constants = []
-        updates = theano.OrderedUpdates()
-        results, samples, constants_m = model(
-            X_i, X, qk, pass_gradients=inference_args['pass_gradients'],
-            n_posterior_samples=learning_args['n_posterior_samples'])
-        constants += constants_m
-    else:
-        raise ValueError(inference_method)
-
-    cost = results.pop('cost')
-    extra_outs = []
-    extra_outs_keys = ['cost']
-
-    l2_decay = learning_args['l2_decay']
-    if l2_decay > 0.:
-        print 'Adding %.5f L2 weight decay' % l2_decay
-        l2_rval = model.l2_decay(l2_decay)
-        cost += l2_rval.pop('cost')
-        extra_outs += l2_rval.values()
-        extra_outs_keys += l2_rval.keys()
-
-    # ==========================================================================
-    print_section('Test functions')
-    # Test function with sampling
-    inference_method_test = inference_args_test['inference_method']
-    if inference_method_test is not None:
-        inference = resolve_inference(model, deep=deep, **inference_args_test)
-    else:
-        inference = None
-
-    if inference_method_test == 'momentum':
-        if prior == 'binomial':
-            raise NotImplementedError()
-        results, samples, full_results, updates_s = inference(
-            X_i, X,
-            n_posterior_samples=learning_args['n_posterior_samples_test'])
-        py = samples['py'][-1]
-    elif inference_method_test == 'rws':
-        results, samples,  = inference(
-            X_i, X, n_posterior_samples=learning_args['n_posterior_samples_test'])
-        updates_s = theano.OrderedUpdates()
-        py = samples['py']
-    elif inference_method_test == 'air':
-        results, samples, full_results, updates_s = inference(
-            X_i, X, n_posterior_samples=learning_args['n_posterior_samples_test'])
-        py = samples['py'][-1]
-    elif inference_method_test is None:
-        updates_s = theano.OrderedUpdates()
-        py = samples['py']
-    else:
-        raise ValueError(inference_method_test)
-
-    f_test_keys = results.keys()
-    f_test = theano.function([X], results.values(), updates=updates_s)
-    f_icost = theano.function([X], full_results['i_cost'], updates=updates_s)
-
     # ========================================================================
     print_section('Setting final tparams and save function')
 
-    all_params = OrderedDict((k, v) for k, v in tparams.iteritems())
+    if learning_args['flat_params']:
+        flat_params = FlatParams(model, tparams)
+        tparams = flat_params.views
+        print 'Packed %d params into one buffer of %d values' % (
+            len(tparams), flat_params.offsets[-1])
+        all_params = OrderedDict(params=flat_params.buffer)
+    else:
+        flat_params = None
+        all_params = OrderedDict((k, v) for k, v in tparams.iteritems())
+    shared = OrderedDict(all_params)
+    if center_input:
+        shared['X_mean'] = X_mean
 
-    tparams = OrderedDict((k, v)
-        for k, v in tparams.iteritems()
-        if (v not in updates.keys() or v not in excludes))
+    if function_cache is not None:
+        cache_key = function_cache_key(
+            dim_in=dim_in, dim_h=dim_h, dim_hs=dim_hs, prior=prior,
+            center_input=center_input, recognition_net=recognition_net,
+            generation_net=generation_net,
+            distributions=train.distributions, dims=train.dims,
+            learning_args=dict((k, learning_args[k]) for k in [
+                'l2_decay', 'optimizer', 'optimizer_args',
+                'n_posterior_samples', 'n_posterior_samples_test',
+                'posterior_chunk_size_test', 'dedup_samples_test',
+                'warm_start', 'fused_bound',
+                'diagnostics', 'precision', 'flat_params']),
+            inference_args=inference_args,
+            inference_args_test=inference_args_test)
+    else:
+        cache_key = None
+
+    functions, shared = cached_functions(
+        function_cache, cache_key, shared,
+        lambda: build_functions(model, X, X_i, tparams, prior, deep,
+                                learning_args, inference_args,
+                                inference_args_test, flat_params=flat_params),
+        model=model)
+    all_params = OrderedDict((k, shared[k]) for k in all_params.keys())
+    if flat_params is not None and flat_params.buffer is not all_params['params']:
+        flat_params.rebind(model, all_params['params'])
+
+    f_grad_shared = functions['f_grad_shared']
+    f_grad_updates = functions['f_grad_updates']
+    f_test = functions['f_test']
+    f_icost = functions['f_icost']
+    f_test_keys = functions['f_test_keys']
+    extra_outs_keys = functions['extra_outs_keys']
 
-    print 'Learned model params: %s' % tparams.keys()
     print 'Saved params: %s' % all_params.keys()
 
     def save(tparams, outfile):
-        d = dict((k, v.get_value()) for k, v in all_params.items())
+        if flat_params is not None:
+            d = dict(flat_params.get_values())
+        else:
+            d = dict((k, v.get_value()) for k, v in all_params.items())
         d.update(
             dim_in=dim_in,
             dim_h=dim_h,
@@ -307,20 +488,6 @@ def train(
         )
         np.savez(outfile, **d)
 
-    # ========================================================================
-    print_section('Getting gradients.')
-    grads = T.grad(cost, wrt=itemlist(tparams),
-                   consider_constant=constants)
-
-    # ========================================================================
-    print_section('Building optimizer')
-    lr = T.scalar(name='lr')
-    optimizer = learning_args['optimizer']
-    optimizer_args = learning_args['optimizer_args']
-    f_grad_shared, f_grad_updates = eval('op.' + optimizer)(
-        lr, tparams, grads, [X], cost, extra_ups=updates,
-        extra_outs=extra_outs, **optimizer_args)
-
     monitor = SimpleMonitor()
 
     # ========================================================================
@@ -337,6 +504,19 @@ def train(
     learning_rate_schedule = learning_args['learning_rate_schedule']
     valid_key = learning_args['valid_key']
     valid_sign = learning_args['valid_sign']
+
+    if learning_args['warm_start']:
+        if not hasattr(train, 'idx'):
+            raise NotImplementedError('Warm starts need a dataset that emits '
+                                      'example indices')
+        # Refined posteriors are only reused when resuming the same model.
+        posterior_cache = PosteriorCache(
+            path.join(out_path, '{name}_posterior_cache.npy'.format(name=name)),
+            train.n, model.dim_h, dtype=learning_args['warm_start_dtype'],
+            reset=model_to_load is None)
+    else:
+        posterior_cache = None
+
     try:
         epoch_t0 = time.time()
         s = 0
@@ -348,7 +528,8 @@ def train(
         training_time = 0
         while True:
             try:
-                x = train.next()[train.name]
+                batch = train.next()
+                x = batch[train.name]
                 if train.pos == -1:
                     epoch_pbar.update(train.n)
                 else:
@@ -416,6 +597,11 @@ def train(
                 monitor.update_valid(**results_valid)
                 monitor.display()
 
+                if posterior_cache is not None:
+                    posterior_cache.flush()
+                    print ('Cached posteriors for %d / %d examples'
+                           % (posterior_cache.n_filled(), train.n))
+
                 monitor.save(path.join(
                     out_path, '{name}_monitor.png').format(name=name))
                 monitor.save_stats(path.join(
@@ -447,7 +633,12 @@ def train(
             if e > epochs:
                 break
 
-            rval = f_grad_shared(x)
+            if posterior_cache is not None:
+                idx = batch['index']
+                rval = f_grad_shared(x, posterior_cache.get(idx))
+                posterior_cache.set(idx, rval[-1])
+            else:
+                rval = f_grad_shared(x)
             check_bad_nums(rval, extra_outs_keys)
             if check_bad_nums(rval[:1], extra_outs_keys[:1]):
                 print zip(extra_outs_keys, rval)
@@ -479,6 +670,8 @@ def make_argument_parser():
     parser.add_argument('-l', '--load_model', default=None)
     parser.add_argument('-i', '--save_images', action='store_true')
     parser.add_argument('-n', '--name', default=None)
+    parser.add_argument('-c', '--function_cache', default=None,
+                        help='Directory for caching compiled functions')
     return parser
 
 if __name__ == '__main__':
@@ -513,4 +706,5 @@ if __name__ == '__main__':
     train(out_path=out_path,
           model_to_load=model_to_load,
           save_images=args.save_images,
+          function_cache=args.function_cache,
           **exp_dict)
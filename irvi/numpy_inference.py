@@ -0,0 +1,373 @@
+'''
+Pure NumPy forward pass for binomial SBNs and AIR.
+
+Loads checkpoints written by `main.train` and scores data without building
+or compiling a Theano graph. Only the binomial prior with MLP recognition and
+generation networks (binomial outputs) is supported.
+'''
+
+import argparse
+from collections import OrderedDict
+import numpy as np
+import time
+
+
+floatX = 'float32'
+
+
+def _sigmoid(x):
+    return 0.5 * (1. + np.tanh(0.5 * x))
+
+def _softplus(x):
+    return np.logaddexp(0., x)
+
+_activations = {
+    'T.nnet.sigmoid': _sigmoid,
+    'T.tanh': np.tanh,
+    'T.nnet.softplus': _softplus,
+    'lambda x: x': lambda x: x
+}
+
+def _binomial_prob(z):
+    return _sigmoid(z) * 0.9999 + 0.000005
+
+def _cross_entropy(x, p):
+    energy = -x * np.log(p) - (1 - x) * np.log(1 - p)
+    return energy.sum(axis=energy.ndim-1)
+
+def _binary_entropy(p):
+    entropy = -p * np.log(p) - (1 - p) * np.log(1 - p)
+    return entropy.sum(axis=entropy.ndim-1)
+
+def log_sum_exp(x, axis=None):
+    '''
+    Numerically stable log( sum( exp(A) ) ).
+    '''
+    x_max = np.max(x, axis=axis, keepdims=True)
+    y = np.log(np.sum(np.exp(x - x_max), axis=axis, keepdims=True)) + x_max
+    return np.sum(y, axis=axis)
+
+
+class NumpyMLP(object):
+    '''
+    NumPy version of `models.mlp.MLP` with a binomial output.
+    '''
+    def __init__(self, Ws, bs, h_act='T.nnet.sigmoid', name='MLP'):
+        if h_act not in _activations.keys():
+            raise NotImplementedError(h_act)
+        self.Ws = [W.astype(floatX) for W in Ws]
+        self.bs = [b.astype(floatX) for b in bs]
+        self.h_act = h_act
+        self.n_layers = len(self.Ws)
+        self.name = name
+
+    @staticmethod
+    def from_params(params, name, h_act='T.nnet.sigmoid'):
+        Ws = []
+        bs = []
+        l = 0
+        while '%s_W%d' % (name, l) in params.keys():
+            Ws.append(params['%s_W%d' % (name, l)])
+            bs.append(params['%s_b%d' % (name, l)])
+            l += 1
+
+        if l == 0:
+            raise ValueError('No parameters found for %s' % name)
+
+        return NumpyMLP(Ws, bs, h_act=h_act, name=name)
+
+    def feed(self, x):
+        return self.feed_preact(np.dot(x, self.Ws[0]) + self.bs[0])
+
+    def feed_preact(self, preact):
+        '''
+        Feeds from the preactivation of the first layer.
+        '''
+        f_act = _activations[self.h_act]
+        for l in xrange(self.n_layers):
+            if l > 0:
+                preact = np.dot(x, self.Ws[l]) + self.bs[l]
+            if l < self.n_layers - 1:
+                x = f_act(preact)
+            else:
+                x = _binomial_prob(preact)
+        return x
+
+    def neg_log_prob(self, x, p):
+        return _cross_entropy(x, p)
+
+    def entropy(self, p):
+        return _binary_entropy(p)
+
+
+class NumpySBN(object):
+    '''
+    NumPy version of `models.sbn.SBN` with a `Binomial` prior.
+    '''
+    def __init__(self, posterior, conditional, prior_z, mean_image=None,
+                 rng=None):
+        self.posterior = posterior
+        self.conditional = conditional
+        self.prior_p = _binomial_prob(prior_z.astype(floatX))
+        self.dim_h = self.prior_p.shape[0]
+        self.mean_image = mean_image
+
+        if rng is None:
+            rng = np.random.RandomState()
+        self.rng = rng
+
+    def center(self, x):
+        if self.mean_image is None:
+            return x
+        return (x - self.mean_image).astype(floatX)
+
+    def init_inference_samples(self, size):
+        return self.rng.uniform(size=size).astype(floatX)
+
+    def prior_neg_log_prob(self, h):
+        return _cross_entropy(h, self.prior_p)
+
+    def __call__(self, x, y, qk=None, n_posterior_samples=10, r=None):
+        q0 = self.posterior.feed(x)
+
+        if qk is None:
+            qk = q0
+
+        if r is None:
+            r = self.init_inference_samples(
+                (n_posterior_samples, y.shape[0], self.dim_h))
+        h  = (r <= qk[None, :, :]).astype(floatX)
+        py = self.conditional.feed(h)
+
+        log_ph   = -self.prior_neg_log_prob(h)
+        log_qh   = -self.posterior.neg_log_prob(h, q0[None, :, :])
+        log_qkh  = -self.posterior.neg_log_prob(h, qk[None, :, :])
+        log_py_h = -self.conditional.neg_log_prob(y[None, :, :], py)
+
+        log_p = (log_sum_exp(log_py_h + log_ph - log_qkh, axis=0)
+                 - np.log(r.shape[0]))
+
+        y_energy      = -log_py_h.mean(axis=0)
+        prior_energy  = -log_ph.mean(axis=0)
+        h_energy      = -log_qh.mean(axis=0)
+
+        nll           = -log_p
+        prior_entropy = _binary_entropy(self.prior_p)
+        q_entropy     = self.posterior.entropy(qk)
+
+        cost = (y_energy + prior_energy + h_energy).sum(0)
+        lower_bound = -(y_energy + prior_energy - q_entropy).mean()
+
+        results = OrderedDict({
+            '-log p(x|h)': y_energy.mean(0),
+            '-log p(h)': prior_energy.mean(0),
+            '-log q(h)': h_energy.mean(0),
+            '-log p(x)': nll.mean(0),
+            'H(p)': prior_entropy,
+            'H(q)': q_entropy.mean(0),
+            'lower_bound': lower_bound,
+            'cost': cost
+        })
+
+        return results
+
+
+class NumpyAIR(object):
+    '''
+    NumPy version of `inference.air.AIR`.
+
+    Inference noise is drawn one step at a time, so memory does not grow with
+    the number of inference steps.
+    '''
+    def __init__(self, model, inference_rate=0.1, n_inference_samples=20,
+                 n_inference_steps=20, init_inference='recognition_network'):
+        self.model = model
+        self.inference_rate = inference_rate
+        self.n_inference_samples = n_inference_samples
+        self.n_inference_steps = n_inference_steps
+        self.init_inference = init_inference
+
+    def init_variational_inference(self, x):
+        model = self.model
+
+        if self.init_inference == 'recognition_network':
+            q0 = model.posterior.feed(x)
+        elif self.init_inference == 'from_prior':
+            q0 = np.zeros((x.shape[0], model.dim_h), dtype=floatX)
+            q0 += model.prior_p[None, :]
+        else:
+            raise ValueError(self.init_inference)
+
+        return q0
+
+    def step_infer(self, r, q, y):
+        model = self.model
+
+        h        = (r <= q[None, :, :]).astype(floatX)
+        py       = model.conditional.feed(h)
+        log_py_h = -model.conditional.neg_log_prob(y[None, :, :], py)
+        log_ph   = -model.prior_neg_log_prob(h)
+        log_qh   = -model.posterior.neg_log_prob(h, q[None, :, :])
+
+        log_p     = log_py_h + log_ph - log_qh
+        log_p_max = np.max(log_p, axis=0, keepdims=True)
+
+        w       = np.exp(log_p - log_p_max)
+        w_tilde = w / w.sum(axis=0, keepdims=True)
+        cost    = log_p.mean()
+        q_ = (w_tilde[:, :, None] * h).sum(axis=0)
+        q  = self.inference_rate * q_ + (1 - self.inference_rate) * q
+        return q.astype(floatX), cost
+
+    def inference(self, x, y, q0=None, epsilons=None):
+        '''
+        Runs `n_inference_steps` of AIR.
+
+        `epsilons` of shape (n_inference_steps, n_inference_samples, batch,
+        dim_h) may be given for reproducibility; otherwise each step draws its
+        own noise.
+        '''
+        if q0 is None:
+            q0 = self.init_variational_inference(x)
+
+        qs = [q0]
+        i_costs = []
+        q = q0
+        for k in xrange(self.n_inference_steps):
+            if epsilons is None:
+                r = self.model.init_inference_samples(
+                    (self.n_inference_samples, x.shape[0], self.model.dim_h))
+            else:
+                r = epsilons[k]
+            q, i_cost = self.step_infer(r, q, y)
+            qs.append(q)
+            i_costs.append(i_cost)
+
+        rval = OrderedDict(
+            qk=qs[-1],
+            qs=np.array(qs),
+            i_costs=np.array(i_costs)
+        )
+
+        return rval
+
+    def __call__(self, x, y, n_posterior_samples=10):
+        inference_outs = self.inference(x, y)
+        qs = inference_outs['qs']
+
+        results_0 = self.model(x, y, qs[0],
+                               n_posterior_samples=n_posterior_samples)
+        results_k = self.model(x, y, qs[-1],
+                               n_posterior_samples=n_posterior_samples)
+
+        results = OrderedDict()
+        for k in results_k.keys():
+            results[k] = results_k[k]
+            results[k + '0'] = results_0[k]
+            results['d_' + k] = results_0[k] - results_k[k]
+
+        return results
+
+
+def load_model(model_file, mean_image=None, rng=None):
+    '''
+    Loads a binomial SBN checkpoint saved by `main.train`.
+
+    Returns the NumPy model and the remaining checkpoint configuration.
+    '''
+
+    print 'Loading model from %s' % model_file
+    params = np.load(model_file, allow_pickle=True)
+    d = dict()
+    for k in params.keys():
+        try:
+            d[k] = params[k].item()
+        except ValueError:
+            d[k] = params[k]
+
+    prior = d.get('prior', 'binomial')
+    if prior != 'binomial' or d.get('dim_h', None) is None:
+        raise NotImplementedError('Only single-layer binomial SBNs are '
+                                  'supported (got %s prior)' % prior)
+
+    recognition_net = d.get('recognition_net', None) or dict()
+    generation_net = d.get('generation_net', None) or dict()
+    for net in [recognition_net, generation_net]:
+        if net.get('type', None) is not None:
+            raise NotImplementedError(net['type'])
+        if net.get('distribution', 'binomial') != 'binomial':
+            raise NotImplementedError(net['distribution'])
+
+    if d.get('center_input', False) and mean_image is None:
+        raise ValueError('Model was trained with centered input, '
+                         '`mean_image` must be provided')
+    if not d.get('center_input', False):
+        mean_image = None
+    elif mean_image is not None:
+        mean_image = mean_image.astype(floatX)
+
+    posterior = NumpyMLP.from_params(
+        d, 'sbn_posterior',
+        h_act=recognition_net.get('h_act', 'T.nnet.sigmoid'))
+    conditional = NumpyMLP.from_params(
+        d, 'sbn_conditional',
+        h_act=generation_net.get('h_act', 'T.nnet.sigmoid'))
+    model = NumpySBN(posterior, conditional, d['binomial_z'],
+                     mean_image=mean_image, rng=rng)
+
+    return model, d
+
+def score(model, data, batch_size=100, n_posterior_samples=1000,
+          **inference_args):
+    '''
+    Averages the AIR results over `data` in minibatches.
+    '''
+    inference = NumpyAIR(model, **inference_args)
+
+    rs = OrderedDict()
+    for i in xrange(0, data.shape[0], batch_size):
+        y = data[i:i+batch_size].astype(floatX)
+        x = model.center(y)
+        results = inference(x, y, n_posterior_samples=n_posterior_samples)
+        for k, v in results.iteritems():
+            rs.setdefault(k, []).append(v * y.shape[0])
+
+    return OrderedDict((k, np.sum(v) / float(data.shape[0]))
+                       for k, v in rs.iteritems())
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_file', help='Checkpoint (.npz) from training')
+    parser.add_argument('data', help='Data to score (.npy)')
+    parser.add_argument('-M', '--mean_image', default=None,
+                        help='Train mean image (.npy) for centered models')
+    parser.add_argument('-p', '--n_posterior_samples', default=1000, type=int)
+    parser.add_argument('-i', '--n_inference_samples', default=20, type=int)
+    parser.add_argument('-s', '--n_inference_steps', default=20, type=int)
+    parser.add_argument('-r', '--inference_rate', default=0.1, type=float)
+    parser.add_argument('-b', '--batch_size', default=100, type=int)
+    return parser
+
+if __name__ == '__main__':
+    t0 = time.time()
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    if args.mean_image is not None:
+        mean_image = np.load(args.mean_image)
+    else:
+        mean_image = None
+
+    model, _ = load_model(args.model_file, mean_image=mean_image)
+    data = np.load(args.data)
+    print 'Model loaded in %.2f seconds' % (time.time() - t0)
+
+    results = score(model, data, batch_size=args.batch_size,
+                    n_posterior_samples=args.n_posterior_samples,
+                    inference_rate=args.inference_rate,
+                    n_inference_samples=args.n_inference_samples,
+                    n_inference_steps=args.n_inference_steps)
+
+    for k, v in results.iteritems():
+        print '%s: %.4f' % (k, v)
+    print 'Done in %.2f seconds' % (time.time() - t0)
@@ -0,0 +1,260 @@
+'''
+Sweeps inference configurations of a trained model in one compiled function.
+
+Every configuration refines the same recognition network output on the same
+batches, so comparing, e.g., inference rates and numbers of steps needs a
+single compilation and a single pass over the data. Time per configuration
+is taken from the Theano profile: nodes that only one configuration depends
+on are charged to it, and nodes shared between configurations (the
+recognition network, data centering) are reported separately.
+
+Usage:
+
+    python sweep.py <experiment_dir> -c air,0.1,20,20 -c air,0.01,20,20
+'''
+
+import argparse
+from collections import OrderedDict
+from glob import glob
+import numpy as np
+from os import path
+from tabulate import tabulate
+import theano
+from theano import tensor as T
+from theano.gof.graph import ancestors
+import time
+
+from datasets import load_data
+from inference import resolve as resolve_inference
+from inference.irvi import IRVI
+from models.gbn import unpack as unpack_gbn
+from models.sbn import unpack as unpack_sbn
+from utils import floatX
+from utils.tools import (
+    load_experiment,
+    load_model
+)
+
+
+def parse_config(s):
+    '''
+    Parses `method,rate,steps,samples`, e.g., `air,0.1,20,20`.
+    '''
+    try:
+        method, rate, steps, samples = s.split(',')
+        return (method, float(rate), int(steps), int(samples))
+    except ValueError:
+        raise ValueError('Expected `method,rate,steps,samples`, got %s' % s)
+
+def build_sweep(model, X, X_i, configs, n_posterior_samples=100,
+                **inference_args):
+    '''
+    Forms the bounds of every configuration with a shared recognition pass.
+
+    Args:
+        model: SBN or GBN.
+        X: T.matrix. Data.
+        X_i: T.tensor. Input to the recognition network (e.g., centered X).
+        configs: list of (method, rate, steps, samples) tuples.
+        n_posterior_samples: int. Samples for the bound of each
+            configuration.
+        **inference_args: passed to every inference method.
+
+    Returns:
+        outputs: list of (lower bound, -log p(x)) pairs, one per
+            configuration.
+        updates: theano.OrderedUpdates.
+
+    '''
+    q0 = model.posterior.feed(X_i)
+    updates = theano.OrderedUpdates()
+
+    outputs = []
+    for method, rate, steps, samples in configs:
+        inference = resolve_inference(
+            model, inference_method=method, inference_rate=rate,
+            n_inference_steps=steps, n_inference_samples=samples,
+            **inference_args)
+        if not isinstance(inference, IRVI):
+            raise NotImplementedError('Sweeps need iterative refinement, '
+                                      'got %s' % method)
+        i_results, _, updates_i = inference.inference(X_i, X, q0=q0)
+        updates.update(updates_i)
+
+        results, _, updates_m = model(
+            X_i, X, i_results['qk'], n_posterior_samples=n_posterior_samples)
+        if isinstance(updates_m, theano.OrderedUpdates):
+            updates.update(updates_m)
+        outputs.append((results['lower_bound'], results['-log p(x)']))
+
+    return outputs, updates
+
+def attribute_times(f, n_groups):
+    '''
+    Splits the profiled run time of `f` between groups of its outputs.
+
+    `f` must be compiled with `profile=True` and its outputs must be
+    `n_groups` groups of equal size, in order. Returns the time of the nodes
+    only each group depends on, and the time of all remaining nodes.
+    '''
+    fgraph = f.maker.fgraph
+    # Updates follow the outputs in the graph and are not attributed.
+    group_size = len(f.maker.outputs) // n_groups
+
+    owners = []
+    for g in xrange(n_groups):
+        outs = fgraph.outputs[g * group_size:(g + 1) * group_size]
+        owners.append(set(v.owner for v in ancestors(outs)
+                          if v.owner is not None))
+
+    apply_time = f.profile.apply_time
+    times = [0.] * n_groups
+    shared = 0.
+    for node, t in apply_time.iteritems():
+        groups = [g for g in xrange(n_groups) if node in owners[g]]
+        if len(groups) == 1:
+            times[groups[0]] += t
+        else:
+            shared += t
+
+    return times, shared
+
+def sweep_model(model_file, configs, prior='binomial', dim_h=None,
+                dim_hs=None, center_input=True, dataset_args=None,
+                mode='valid', batch_size=100, n_batches=10,
+                n_posterior_samples=100, **kwargs):
+    '''
+    Evaluates every configuration on the same `n_batches` of data.
+
+    Returns a list of table rows: method, rate, steps, samples, lower bound,
+    -log p(x) and seconds per batch (profiled, excluding shared nodes).
+    '''
+
+    if dim_h is None:
+        raise NotImplementedError('Sweeps do not cover deeper latent models '
+                                  'yet.')
+
+    # ========================================================================
+    print 'Loading Data'
+    train_iter, valid_iter, test_iter = load_data(
+        train_batch_size=batch_size, valid_batch_size=batch_size,
+        test_batch_size=batch_size, **dataset_args)
+
+    if mode == 'train':
+        data_iter = train_iter
+    elif mode == 'valid':
+        data_iter = valid_iter
+    elif mode == 'test':
+        data_iter = test_iter
+    else:
+        raise ValueError(mode)
+
+    # ========================================================================
+    print 'Loading Model'
+
+    if prior == 'gaussian':
+        unpack = unpack_gbn
+        model_name = 'gbn'
+    elif prior in ['binomial', 'darn']:
+        unpack = unpack_sbn
+        model_name = 'sbn'
+    else:
+        raise ValueError(prior)
+
+    models, _ = load_model(model_file, unpack,
+                           distributions=data_iter.distributions,
+                           dims=data_iter.dims)
+    model = models[model_name]
+    model.set_tparams()
+
+    # ========================================================================
+    print 'Compiling sweep over %d configurations' % len(configs)
+
+    X = T.matrix('x', dtype=floatX)
+    if center_input:
+        print 'Centering input with train dataset mean image'
+        X_i = X - train_iter.mean_image.astype(floatX)
+    else:
+        X_i = X
+
+    outputs, updates = build_sweep(model, X, X_i, configs,
+                                   n_posterior_samples=n_posterior_samples)
+    t0 = time.time()
+    f = theano.function([X], [o for output in outputs for o in output],
+                        updates=updates, profile=True)
+    print 'Compiled in %.2f seconds' % (time.time() - t0)
+
+    # ========================================================================
+    print 'Evaluating on %d batches of %s' % (n_batches, mode)
+
+    rvals = []
+    t0 = time.time()
+    for _ in xrange(n_batches):
+        try:
+            x = data_iter.next()[data_iter.name]
+        except StopIteration:
+            break
+        rvals.append(f(x))
+    if len(rvals) == 0:
+        raise ValueError('No batches of %s to evaluate' % mode)
+    n_evals = float(len(rvals))
+    wall = (time.time() - t0) / n_evals
+    rvals = np.mean(np.array(rvals), axis=0)
+
+    times, shared = attribute_times(f, len(configs))
+    times = [t / n_evals for t in times]
+
+    rows = []
+    for c, config in enumerate(configs):
+        lower_bound, nll = rvals[2 * c:2 * c + 2]
+        rows.append(list(config) + [lower_bound, nll, times[c]])
+
+    print tabulate(rows, headers=['method', 'rate', 'steps', 'samples',
+                                  'lower bound', '-log p(x)', 's / batch'])
+    print ('Shared: %.4f s / batch, total: %.4f s / batch'
+           % (shared / n_evals, wall))
+
+    return rows
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('experiment_dir',
+                        help='Location of the experiment (directory)')
+    parser.add_argument('-c', '--config', action='append', required=True,
+                        type=parse_config, dest='configs',
+                        help='Inference configuration `method,rate,steps,'
+                        'samples`, e.g. `air,0.1,20,20`. Can be repeated.')
+    parser.add_argument('-m', '--mode', default='valid',
+                        help='Dataset mode: valid, test, or train')
+    parser.add_argument('-p', '--n_posterior_samples', default=100, type=int,
+                        help='Number of posterior samples for the bounds')
+    parser.add_argument('-b', '--batch_size', default=100, type=int)
+    parser.add_argument('-n', '--n_batches', default=10, type=int,
+                        help='Number of batches to evaluate on')
+    return parser
+
+if __name__ == '__main__':
+    parser = make_argument_parser()
+    args = parser.parse_args()
+
+    exp_dir = path.abspath(args.experiment_dir)
+
+    try:
+        yaml = glob(path.join(exp_dir, '*.yaml'))[0]
+        print 'Found yaml %s' % yaml
+    except IndexError:
+        raise ValueError('Experiment yaml not found')
+
+    try:
+        model_file = glob(path.join(exp_dir, '*best*npz'))[0]
+        print 'Found best in %s' % model_file
+    except IndexError:
+        raise ValueError('Best file not found')
+
+    exp_dict = load_experiment(path.abspath(yaml))
+    exp_dict.pop('inference_args', None)
+    exp_dict.pop('inference_args_test', None)
+
+    sweep_model(model_file, args.configs, mode=args.mode,
+                batch_size=args.batch_size, n_batches=args.n_batches,
+                n_posterior_samples=args.n_posterior_samples, **exp_dict)
@@ -0,0 +1,46 @@
+'''
+Tests for the Gray-code exact likelihood.
+'''
+
+import numpy as np
+
+from irvi.exact import (
+    gray_chunk,
+    gray_code,
+    log_likelihood
+)
+from irvi.numpy_inference import (
+    floatX,
+    log_sum_exp,
+    NumpyMLP,
+    NumpySBN
+)
+
+
+def test_gray_chunk(dim=5):
+    h0, units, signs = gray_chunk(3, 2 ** dim, dim)
+    h = h0.copy()
+    for i, (u, s) in enumerate(zip(units, signs)):
+        h[u] += s
+        assert np.all((h == 0) | (h == 1)), h
+        assert np.all(h == (gray_code(i + 4) >> np.arange(dim)) & 1)
+
+def test_log_likelihood(dim_in=11, dim_h=7, batch_size=5):
+    Ws = [np.random.normal(size=(dim_h, 13)), np.random.normal(size=(13, dim_in))]
+    bs = [np.random.normal(size=(13,)), np.random.normal(size=(dim_in,))]
+    conditional = NumpyMLP(Ws, bs, h_act='T.nnet.softplus')
+    model = NumpySBN(None, conditional, np.random.normal(size=(dim_h,)))
+    y = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    # Dense enumeration
+    h = ((np.arange(2 ** dim_h)[:, None] >> np.arange(dim_h)) & 1).astype(floatX)
+    py = model.conditional.feed(h)
+    log_py_h = -model.conditional.neg_log_prob(y[:, None, :], py[None, :, :])
+    log_ph = -model.prior_neg_log_prob(h)
+    log_px = log_sum_exp(log_py_h + log_ph[None, :], axis=1)
+
+    for chunk_size, n_workers, block_size in [(2 ** dim_h, 1, 1000),
+                                              (5, 1, 2), (16, 3, 3)]:
+        log_px_g = log_likelihood(model, y, chunk_size=chunk_size,
+                                  n_workers=n_workers, block_size=block_size)
+        np.testing.assert_allclose(log_px_g, log_px, rtol=1e-4)
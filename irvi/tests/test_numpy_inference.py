@@ -0,0 +1,85 @@
+'''
+Parity tests for the NumPy inference engine against the Theano graph.
+'''
+
+import numpy as np
+from os import path
+import tempfile
+import theano
+from theano import tensor as T
+
+from inference import resolve as resolve_inference
+from irvi.numpy_inference import load_model as load_numpy_model
+from irvi.numpy_inference import NumpyAIR
+from models.distributions import Binomial
+from models.sbn import SBN
+from models.tests import test_sbn
+from utils import floatX
+
+
+def save_sbn(dim_in=11, dim_h=7, batch_size=5):
+    recognition_net = dict(input_layer='x', dim_hs=[9], h_act='T.tanh')
+    generation_net = dict(output='x', dim_hs=[13], h_act='T.nnet.softplus')
+    mlps = SBN.mlp_factory(dim_h, dict(x=dim_in), dict(x='binomial'),
+                           recognition_net=recognition_net,
+                           generation_net=generation_net)
+    model = SBN(dim_in, dim_h, prior=Binomial(dim_h), **mlps)
+    model.prior.params['z'] += np.random.normal(size=(dim_h,)).astype(floatX)
+    tparams = model.set_tparams()
+
+    mean_image = np.random.uniform(size=(dim_in,)).astype(floatX)
+    d = dict((k, v.get_value()) for k, v in tparams.items())
+    d.update(
+        dim_in=dim_in,
+        dim_h=dim_h,
+        dim_hs=None,
+        prior='binomial',
+        center_input=True,
+        generation_net=generation_net,
+        recognition_net=recognition_net,
+        dataset_args=dict()
+    )
+    model_file = path.join(tempfile.mkdtemp(), 'sbn_best.npz')
+    np.savez(model_file, **d)
+    return model, model_file, mean_image
+
+def test_parity(batch_size=5, n_inference_steps=3, n_inference_samples=17,
+                n_posterior_samples=19):
+    model, model_file, mean_image = save_sbn()
+    np_model, _ = load_numpy_model(model_file, mean_image=mean_image)
+
+    y = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+    x = np_model.center(y)
+    epsilons = np.random.uniform(
+        size=(n_inference_steps, n_inference_samples, batch_size,
+              model.dim_h)).astype(floatX)
+    r = np.random.uniform(
+        size=(n_posterior_samples, batch_size, model.dim_h)).astype(floatX)
+
+    X = T.matrix('x', dtype=floatX)
+    Y = T.matrix('y', dtype=floatX)
+
+    test_sbn.fix_samples(model, epsilons)
+    air = resolve_inference(model, inference_method='air', inference_rate=0.1,
+                            n_inference_steps=n_inference_steps,
+                            n_inference_samples=n_inference_samples)
+    rval, _, updates = air.inference(X, Y)
+    test_sbn.fix_samples(model, r)
+    results, _, _ = model(X, Y, rval['qk'],
+                          n_posterior_samples=n_posterior_samples)
+    f = theano.function([X, Y], [rval['qs']] + results.values(),
+                        updates=updates)
+    outs = f(x, y)
+    qs_t = outs[0]
+    results_t = dict(zip(results.keys(), outs[1:]))
+
+    np_air = NumpyAIR(np_model, inference_rate=0.1,
+                      n_inference_steps=n_inference_steps,
+                      n_inference_samples=n_inference_samples)
+    qs_np = np_air.inference(x, y, epsilons=epsilons)['qs']
+    assert np.allclose(qs_t, qs_np, atol=1e-5), np.abs(qs_t - qs_np).max()
+
+    results_np = np_model(x, y, qs_np[-1], r=r)
+    for k, v in results_t.iteritems():
+        assert np.allclose(v, results_np[k], rtol=1e-4, atol=1e-4), (
+            k, v, results_np[k])
@@ -0,0 +1,46 @@
+'''
+Tests for sweeping inference configurations in one function.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from irvi.sweep import (
+    attribute_times,
+    build_sweep,
+    parse_config
+)
+from models.distributions import Binomial
+from models.sbn import SBN
+from utils import floatX
+
+
+def test_sweep(dim_in=11, dim_h=7, batch_size=5):
+    model = SBN(dim_in, dim_h, prior=Binomial(dim_h))
+    tparams = model.set_tparams()
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    configs = [parse_config('air,0.1,0,5'), parse_config('air,0.1,3,5'),
+               parse_config('air,0.5,8,13')]
+    assert configs[1] == ('air', 0.1, 3, 5)
+
+    outputs, updates = build_sweep(model, X, X, configs, n_posterior_samples=7)
+    f = theano.function([X], [o for output in outputs for o in output],
+                        updates=updates, profile=True)
+    rvals = f(x)
+    assert len(rvals) == 2 * len(configs)
+    assert np.all(np.isfinite(rvals))
+
+    # The recognition network is computed once and shared.
+    W = [v for v, i in zip(f.maker.fgraph.inputs, f.maker.inputs)
+         if i.variable is tparams['sbn_posterior_W0']][0]
+    feeds = [node for node in f.maker.fgraph.toposort()
+             if W in node.inputs and 'Dot' in str(node.op)]
+    assert len(feeds) == 1, feeds
+
+    times, shared = attribute_times(f, len(configs))
+    assert len(times) == len(configs)
+    assert all(t >= 0. for t in times) and shared >= 0.
+    assert times[2] > 0.
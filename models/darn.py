@@ -19,6 +19,7 @@ from distributions import (
     _normal_prob
 )
 from layers import Layer
+from utils.binary import dot
 from utils.tools import (
     concatenate,
     floatX,
@@ -29,6 +30,191 @@ from utils.tools import (
 )
 
 
+def pack_tril(W):
+    '''
+    Strictly lower triangle of a square NumPy matrix, row by row.
+    '''
+    rows, cols = np.tril_indices(W.shape[0], k=-1)
+    return W[rows, cols]
+
+def unpack_tril_numpy(w, dim):
+    '''
+    (dim, dim) NumPy matrix from its packed strictly lower triangle.
+    '''
+    rows, cols = np.tril_indices(dim, k=-1)
+    W = np.zeros((dim, dim), dtype=w.dtype)
+    W[rows, cols] = w
+    return W
+
+def unpack_tril(w, dim):
+    '''
+    (dim, dim) matrix from its packed strictly lower triangle.
+
+    Entries are set through flat indices into a vector, which is a single
+    C `AdvancedIncSubtensor1` with an `AdvancedSubtensor1` gradient.
+    '''
+    rows, cols = np.tril_indices(dim, k=-1)
+    idx = (rows * dim + cols).astype('int64')
+    W = T.set_subtensor(T.zeros((dim * dim,), dtype=w.dtype)[idx], w)
+    return W.reshape((dim, dim))
+
+def convert_checkpoint(params):
+    '''
+    Packs dense autoregressive weights of checkpoints saved before they were
+    stored as strictly lower triangles.
+
+    Converts 2d `War` (DARN) and `autoregressor_W` (AutoRegressor prior)
+    entries and leaves everything else as is.
+    '''
+    params = dict(params)
+    for k, v in params.items():
+        if ((k.endswith('_War') or k == 'autoregressor_W')
+            and isinstance(v, np.ndarray) and v.ndim == 2):
+            print 'Packing lower triangle of %s %s' % (k, v.shape)
+            params[k] = pack_tril(v)
+    return params
+
+def _pad_blocks(W, rs, block_size):
+    '''
+    Pads autoregressive weights and uniform noise to a multiple of
+    `block_size` dimensions.
+
+    Padded dimensions come last and get noise of 1, so they are never on and
+    do not change the other dimensions.
+    '''
+    dim = W.shape[0]
+    n_blocks = (dim + block_size - 1) // block_size
+    pad = n_blocks * block_size - dim
+    W = T.concatenate([W, T.zeros((pad, dim), dtype=W.dtype)], axis=0)
+    W = T.concatenate([W, T.zeros((W.shape[0], pad), dtype=W.dtype)], axis=1)
+    rs = T.concatenate([rs, T.ones((pad, rs.shape[1]), dtype=rs.dtype)],
+                       axis=0)
+    return W, rs, n_blocks
+
+def block_sample(z, W, rs, block_size, f_prob=T.nnet.sigmoid, name='sample'):
+    '''
+    Exact autoregressive binary samples, `block_size` dimensions at a time.
+
+    Dimension i is on with probability f_prob(z_i), where z_i includes
+    W[k, i] for every earlier dimension k that is on. Within a block, steps
+    are unrolled and only update the preactivations of that block. Each
+    block then updates all preactivations with one product, so `scan` takes
+    dim / block_size steps instead of dim.
+
+    Args:
+        z: T.matrix. (n, dim) initial preactivations.
+        W: T.matrix. (dim, dim) autoregressive weights.
+        rs: T.matrix. (dim, n) uniform noise.
+        block_size: int.
+        f_prob: function. Maps preactivations to probabilities.
+
+    Returns:
+        x: T.matrix. (dim, n) samples.
+        p: T.matrix. (dim, n) probabilities.
+        updates: theano.OrderedUpdates.
+
+    '''
+    dim = z.shape[1]
+    W_p, rs, n_blocks = _pad_blocks(W, rs, block_size)
+    z = T.concatenate(
+        [z, T.zeros((z.shape[0], W_p.shape[0] - dim), dtype=z.dtype)], axis=1)
+
+    W_blocks = W_p.reshape((n_blocks, block_size, W_p.shape[1]))
+    r_blocks = rs.reshape((n_blocks, block_size, rs.shape[1]))
+
+    def _step_block(i, W_b, r_b, z):
+        start = i * block_size
+        z_b = z[:, start:start + block_size]
+        W_bb = W_b[:, start:start + block_size]
+
+        xs = []
+        ps = []
+        for j in xrange(block_size):
+            p_j = f_prob(z_b[:, j])
+            x_j = (r_b[j] <= p_j).astype(floatX)
+            z_b = z_b + T.outer(x_j, W_bb[j])
+            xs.append(x_j)
+            ps.append(p_j)
+
+        x_b = T.stack(xs)
+        z = z + T.dot(x_b.T, W_b)
+        return z, x_b, T.stack(ps)
+
+    seqs = [T.arange(n_blocks), W_blocks, r_blocks]
+    outputs_info = [z, None, None]
+    non_seqs = []
+
+    (zs, x, p), updates = scan(_step_block, seqs, outputs_info, non_seqs,
+                               n_blocks, name=name)
+
+    x = x.reshape((n_blocks * block_size, x.shape[2]))[:dim]
+    p = p.reshape((n_blocks * block_size, p.shape[2]))[:dim]
+    return x, p, updates
+
+def block_sample_numpy(z, W, rs, block_size, f_prob):
+    '''
+    NumPy version of `block_sample`, returning (n, dim) samples.
+    '''
+    z = z.copy()
+    dim = z.shape[1]
+    x = np.zeros_like(z)
+    for start in xrange(0, dim, block_size):
+        stop = min(start + block_size, dim)
+        for i in xrange(start, stop):
+            x[:, i] = rs[i] <= f_prob(z[:, i])
+            z[:, i+1:stop] += np.outer(x[:, i], W[i, i+1:stop])
+        z[:, stop:] += np.dot(x[:, start:stop], W[start:stop, stop:])
+    return x
+
+
+def autoregressive_sample(z, w, rs, dim, block_size=16,
+                          f_prob=T.nnet.sigmoid, name='sample'):
+    '''
+    Exact samples from the lower triangular autoregressive model.
+
+    Dimension i is on with probability f_prob(z_i + sum_{j > i} x_j W[j, i]),
+    as in `neg_log_prob`, so the last dimension is sampled first. Dimensions
+    are reversed to sample with `block_sample`, or with a `scan` step per
+    dimension if `block_size` is None.
+
+    Args:
+        z: T.matrix. (n, dim) initial preactivations.
+        w: T.vector. Packed strictly lower triangle of W (see `pack_tril`).
+        rs: T.matrix. (dim, n) uniform noise.
+        dim: int.
+        block_size: int or None.
+        f_prob: function. Maps preactivations to probabilities.
+
+    Returns:
+        x: T.matrix. (dim, n) samples.
+        p: T.matrix. (dim, n) probabilities.
+        updates: theano.OrderedUpdates.
+
+    '''
+    W = unpack_tril(w, dim)[::-1, ::-1]
+    z = z[:, ::-1]
+    rs = rs[::-1]
+
+    if block_size is not None:
+        x, p, updates = block_sample(z, W, rs, block_size, f_prob=f_prob,
+                                     name=name)
+    else:
+        def _step_sample(i, W_i, r_i, z):
+            p_i = f_prob(z[:, i])
+            x_i = (r_i <= p_i).astype(floatX)
+            z = z + T.outer(x_i, W_i)
+            return z, x_i, p_i
+
+        seqs = [T.arange(dim), W, rs]
+        outputs_info = [z, None, None]
+        non_seqs = []
+
+        (zs, x, p), updates = scan(_step_sample, seqs, outputs_info, non_seqs,
+                                   dim, name=name)
+
+    return x[::-1], p[::-1], updates
+
+
 class AutoRegressor(Distribution):
     def __init__(self, dim, name='autoregressor', **kwargs):
         self.f_neg_log_prob = _cross_entropy
@@ -40,41 +226,37 @@ class AutoRegressor(Distribution):
         b = np.zeros((self.dim,)).astype(floatX)
         W = norm_weight(self.dim, self.dim, scale=0.001,
                         ortho=False)
-        self.params = OrderedDict(W=W, b=b)
+        # Only the strictly lower triangle is used.
+        self.params = OrderedDict(W=pack_tril(W), b=b)
 
     def get_params(self):
         return [self.W, self.b]
 
     def get_prob(self, x, W, b):
-        W = T.tril(W, k=-1)
-        p = T.nnet.sigmoid(T.dot(x, W) + b) * 0.9999 + 0.000005
+        W = unpack_tril(W, self.dim)
+        p = T.nnet.sigmoid(dot(x, W) + b) * 0.9999 + 0.000005
         return p
 
     def get_L2_weight_cost(self, gamma):
         cost = gamma * (self.W ** 2).sum()
         return cost
 
-    def sample(self, n_samples):
+    def sample(self, n_samples, block_size=16):
         '''
         Inspired by jbornschein's implementation.
+
+        Samples `block_size` dimensions per `scan` step (see
+        `autoregressive_sample`). With `block_size` of None, takes one step
+        per dimension.
         '''
 
         z0 = T.zeros((n_samples, self.dim,)).astype(floatX) + T.shape_padleft(self.b)
         rs = self.trng.uniform((self.dim, n_samples), dtype=floatX)
+        f_prob = lambda z: T.nnet.sigmoid(z) * 0.9999 + 0.000005
 
-        def _step_sample(i, W_i, r_i, z):
-            p_i = T.nnet.sigmoid(z[:, i]) * 0.9999 + 0.000005
-            x_i = (r_i <= p_i).astype(floatX)
-            z   = z + T.outer(x_i, W_i)
-            return z, x_i
-
-        seqs = [T.arange(self.dim), self.W, rs]
-        outputs_info = [z0, None]
-        non_seqs = []
-
-        (zs, x), updates = scan(_step_sample, seqs, outputs_info, non_seqs,
-                                self.dim)
-
+        x, _, updates = autoregressive_sample(
+            z0, self.W, rs, self.dim, block_size=block_size, f_prob=f_prob,
+            name=self.name + '_sample')
         return x.T, updates
 
     def step_neg_log_prob(self, x, *params):
@@ -85,6 +267,22 @@ class AutoRegressor(Distribution):
     def neg_log_prob(self, x):
         return self.step_neg_log_prob(x, *self.get_params())
 
+    def sample_numpy(self, n_samples, block_size=16, rng=None):
+        '''
+        Draws prior samples with NumPy, without compiling a graph.
+        '''
+        if rng is None:
+            rng = np.random.RandomState()
+        W = unpack_tril_numpy(self.W.get_value(), self.dim)
+        b = self.b.get_value()
+        z = np.zeros((n_samples, self.dim), dtype=W.dtype) + b[None, :]
+        rs = rng.uniform(size=(self.dim, n_samples)).astype(W.dtype)
+        f_prob = lambda z: 0.5 * (1. + np.tanh(0.5 * z)) * 0.9999 + 0.000005
+        # Last dimension first, as in `autoregressive_sample`.
+        x = block_sample_numpy(z[:, ::-1], W[::-1, ::-1], rs[::-1],
+                               block_size, f_prob)
+        return x[:, ::-1]
+
     def entropy(self):
         return T.constant(0.).astype(floatX)
 
@@ -124,7 +322,12 @@ class DARN(Layer):
 
         super(DARN, self).__init__(name=name)
 
-    def sample(self, c, n_samples=1, return_probs=False):
+    def sample(self, c, n_samples=1, return_probs=False, block_size=16):
+        '''
+        Samples `block_size` dimensions per `scan` step (see
+        `autoregressive_sample`). With `block_size` of None, takes one step
+        per dimension.
+        '''
         if c.ndim == 1:
             c = c[None, :]
         elif c.ndim > 2:
@@ -136,18 +339,9 @@ class DARN(Layer):
         z = z.reshape((z.shape[0] * z.shape[1], z.shape[2]))
         rs = self.trng.uniform((self.dim_out, z.shape[0]), dtype=floatX)
 
-        def _step_sample(i, W_i, r_i, z):
-            p_i = T.nnet.sigmoid(z[:, i])
-            x_i = (r_i <= p_i).astype(floatX)
-            z += T.outer(x_i, W_i)
-            return z, x_i, p_i
-
-        seqs = [T.arange(self.dim_out), self.War, rs]
-        outputs_info = [z, None, None]
-        non_seqs = []
-
-        (zs, x, p), updates = scan(_step_sample, seqs, outputs_info, non_seqs,
-                                self.dim_out, name='darn_sample')
+        x, p, updates = autoregressive_sample(
+            z, self.War, rs, self.dim_out, block_size=block_size,
+            name='darn_sample')
 
         if c.ndim == 1:
             x = x.T[None, :, :]
@@ -164,13 +358,13 @@ class DARN(Layer):
             return x, updates
 
     def step_neg_log_prob(self, x, c, War, bar):
-        W = T.tril(War, k=-1)
-        p = T.nnet.sigmoid(T.dot(x, W) + bar + c)
+        W = unpack_tril(War, self.dim_out)
+        p = T.nnet.sigmoid(dot(x, W) + bar + c)
         return self.f_neg_log_prob(x, p)
 
     def neg_log_prob(self, x, c):
-        W = T.tril(self.War, k=-1)
-        p = T.nnet.sigmoid(T.dot(x, W) + self.bar + c)
+        W = unpack_tril(self.War, self.dim_out)
+        p = T.nnet.sigmoid(dot(x, W) + self.bar + c)
         return self.f_neg_log_prob(x, p)
 
     def entropy(self, p):
@@ -218,7 +412,8 @@ class DARN(Layer):
         W = norm_weight(self.dim_out, self.dim_out, scale=self.weight_scale,
                                 ortho=False)
 
-        self.params['War'] = W
+        # Only the strictly lower triangle is used.
+        self.params['War'] = pack_tril(W)
         self.params['bar'] = b
 
     def get_params(self):
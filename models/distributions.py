@@ -22,6 +22,93 @@ from utils.tools import (
 _clip = 1e-7
 
 
+class GaussianParams(object):
+    '''
+    Gaussian parameters with `mu` and `log_sigma` as separate tensors.
+
+    Stands in for the (..., 2 * dim) tensor with both concatenated on the
+    last axis, so neither is copied in or sliced out again. Indexing applies
+    to both, e.g. `q[None, :, :]` or `qs[-1]`, and `shape` and `ndim` are
+    those of `mu`.
+    '''
+    def __init__(self, mu, log_sigma):
+        self.mu = mu
+        self.log_sigma = log_sigma
+
+    def __iter__(self):
+        return iter([self.mu, self.log_sigma])
+
+    def __getitem__(self, idx):
+        return GaussianParams(self.mu[idx], self.log_sigma[idx])
+
+    @property
+    def ndim(self):
+        return self.mu.ndim
+
+    @property
+    def shape(self):
+        return self.mu.shape
+
+    @property
+    def dtype(self):
+        return self.mu.dtype
+
+    def copy(self):
+        return GaussianParams(self.mu.copy(), self.log_sigma.copy())
+
+    def pack(self):
+        '''
+        Concatenated (..., 2 * dim) tensor, e.g. for function outputs.
+        '''
+        return concatenate([self.mu, self.log_sigma], axis=self.mu.ndim-1)
+
+
+def gaussian_params(p):
+    '''
+    `p` as GaussianParams. Concatenated tensors are split into views.
+    '''
+    if isinstance(p, GaussianParams):
+        return p
+    dim = p.shape[p.ndim-1] // 2
+    return GaussianParams(_slice(p, 0, dim), _slice(p, 1, dim))
+
+def map_params(f, *ps):
+    '''
+    Applies `f` to each component of GaussianParams `ps`, or to `ps` if they
+    are tensors.
+    '''
+    if isinstance(ps[0], GaussianParams):
+        return GaussianParams(
+            *[f(*xs) for xs in zip(*[gaussian_params(p) for p in ps])])
+    return f(*ps)
+
+def flatten_params(xs):
+    '''
+    Tensors of `xs`, with GaussianParams replaced by their components.
+    '''
+    flat = []
+    for x in xs:
+        if isinstance(x, GaussianParams):
+            flat += list(x)
+        else:
+            flat.append(x)
+    return flat
+
+def unflatten_params(flat, like):
+    '''
+    Inverse of `flatten_params`, with the structure of `like`.
+    '''
+    flat = list(flat)
+    xs = []
+    for x in like:
+        if isinstance(x, GaussianParams):
+            xs.append(GaussianParams(flat.pop(0), flat.pop(0)))
+        else:
+            xs.append(flat.pop(0))
+    assert len(flat) == 0, flat
+    return xs
+
+
 def resolve(c, conditional=False):
     if not conditional:
         if c == 'binomial':
@@ -134,6 +221,30 @@ class Binomial(Distribution):
     def __call__(self, z):
         return T.nnet.sigmoid(z) * 0.9999 + 0.000005
 
+    def logit(self, p):
+        return T.log(p) - T.log1p(-p)
+
+    def step_neg_log_prob(self, x, *params):
+        return self.neg_log_prob(x, self.get_prob(*params))
+
+    def neg_log_prob(self, x, p=None):
+        '''
+        Negative log probability of `x`.
+
+        When `p` is broadcast over leading (sample) dimensions of `x`, e.g.
+        q[None, :, :] for (n_samples, batch, dim) samples, the cross-entropy
+        is taken from the logits of `p` (see `_logit_cross_entropy`), so no
+        logs are taken per sample.
+        '''
+        if p is None:
+            p = self.get_prob(*self.get_params())
+        z = p
+        while z.ndim > 1 and z.broadcastable[0]:
+            z = z.dimshuffle(range(1, z.ndim))
+        if (z.ndim == 1 and x.ndim > 1) or (z.ndim == 2 and x.ndim == 3):
+            return _logit_cross_entropy(x, self.logit(z))
+        return self.f_neg_log_prob(x, p)
+
     def prototype_samples(self, size):
         return self.trng.uniform(size, dtype=floatX)
 
@@ -209,23 +320,27 @@ class Gaussian(Distribution):
         return [self.mu, self.log_sigma]
 
     def get_prob(self, mu, log_sigma):
-        return concatenate([mu, log_sigma], axis=mu.ndim-1)
+        return GaussianParams(mu, log_sigma)
 
     def __call__(self, z):
-        return z
+        return gaussian_params(z)
 
     def get_center(self, p):
-        mu = _slice(p, 0, p.shape[p.ndim-1] // self.scale)
-        return mu
+        return gaussian_params(p).mu
 
     def split_prob(self, p):
-        mu        = _slice(p, 0, p.shape[p.ndim-1] // self.scale)
-        log_sigma = _slice(p, 1, p.shape[p.ndim-1] // self.scale)
+        mu, log_sigma = gaussian_params(p)
         return mu, log_sigma
 
+    def sample(self, n_samples, p=None):
+        if p is None:
+            p = self.get_prob(*self.get_params())
+        p = gaussian_params(p)
+        size = (n_samples,) + tuple(p.shape[i] for i in xrange(p.ndim))
+        return self.f_sample(self.trng, p, size=size), theano.OrderedUpdates()
+
     def step_kl_divergence(self, q, mu, log_sigma):
-        mu_q = _slice(q, 0, self.dim)
-        log_sigma_q = _slice(q, 1, self.dim)
+        mu_q, log_sigma_q = gaussian_params(q)
         log_sigma_q = T.maximum(log_sigma_q, self.clip)
         log_sigma = T.maximum(log_sigma, self.clip)
 
@@ -239,9 +354,7 @@ class Gaussian(Distribution):
         return self.step_kl_divergence(q, *self.get_params())
 
     def step_sample(self, epsilon, p):
-        dim = p.shape[p.ndim-1] // self.scale
-        mu = _slice(p, 0, dim)
-        log_sigma = _slice(p, 1, dim)
+        mu, log_sigma = gaussian_params(p)
         return mu + epsilon * T.exp(log_sigma)
 
     def prototype_samples(self, size):
@@ -280,10 +393,8 @@ class TruncatedGaussian(Gaussian):
         return [T.clip(self.mu, self.min, self.max), self.log_sigma]
 
     def __call__(self, p):
-        mu = _slice(p, 0, p.shape[p.ndim-1] // 2)
-        log_sigma = _slice(p, 1, p.shape[p.ndim-1] // 2)
-        mu = T.clip(mu, self.min, self.max)
-        return concatenate([mu, log_sigma], axis=mu.ndim-1)
+        mu, log_sigma = gaussian_params(p)
+        return GaussianParams(T.clip(mu, self.min, self.max), log_sigma)
 
     def sample(self, n_samples, p=None):
         samples, updates = super(TruncatedGaussian, self).sample(n_samples, p=p)
@@ -294,10 +405,9 @@ class TruncatedGaussian(Gaussian):
                       self.min, self.max)
 
     def step_kl_divergence(self, q, mu, log_sigma):
-        mu_q = _slice(q, 0, self.dim)
+        mu_q, log_sigma_q = gaussian_params(q)
         mu = T.clip(mu, self.min, self.max)
         mu_q = T.clip(mu_q, self.min, self.max)
-        log_sigma_q = _slice(q, 1, self.dim)
 
         kl = log_sigma - log_sigma_q + 0.5 * (
             (T.exp(2 * log_sigma_q) + (mu - mu_q) ** 2) /
@@ -306,20 +416,12 @@ class TruncatedGaussian(Gaussian):
         return kl.sum(axis=kl.ndim-1)
 
     def step_neg_log_prob(self, x, p):
-        mu = _slice(p, 0, p.shape[p.ndim-1] // 2)
-        log_sigma = _slice(p, 1, p.shape[p.ndim-1] // 2)
-        mu = T.clip(mu, self.min, self.max)
-        p = concatenate([mu, log_sigma], axis=mu.ndim-1)
-        return self.f_neg_log_prob(x, p)
+        return self.f_neg_log_prob(x, self(p))
 
     def neg_log_prob(self, x, p=None):
         if p is None:
             p = self.get_prob(*self.get_params())
-        mu = _slice(p, 0, p.shape[p.ndim-1] // 2)
-        log_sigma = _slice(p, 1, p.shape[p.ndim-1] // 2)
-        mu = T.clip(mu, self.min, self.max)
-        p = concatenate([mu, log_sigma], axis=mu.ndim-1)
-        return self.f_neg_log_prob(x, p)
+        return self.f_neg_log_prob(x, self(p))
 
 
 class ConditionalGaussian(Gaussian):
@@ -349,6 +451,27 @@ def _cross_entropy(x, p):
     #energy = T.nnet.binary_crossentropy(p, x)
     return energy.sum(axis=energy.ndim-1)
 
+def _logit_cross_entropy(x, z):
+    '''
+    Bernoulli cross-entropy from logits, sum(softplus(z)) - x . z.
+
+    Equals `_cross_entropy(x, sigmoid(z))`, and is linear in `x`. `z` may
+    have fewer leading dimensions than `x`: (dim,) or (batch, dim) logits for
+    (..., dim) or (n_samples, batch, dim) samples. The softplus is then taken
+    once per logit and `x` enters through a (batched) matrix-vector product.
+    '''
+    x = x.astype(z.dtype)
+    if z.ndim == x.ndim:
+        xz = (x * z).sum(axis=x.ndim-1)
+    elif z.ndim == 1:
+        xz = T.dot(x, z)
+    elif z.ndim == 2 and x.ndim == 3:
+        xz = T.batched_dot(x.dimshuffle(1, 0, 2), z).T
+    else:
+        raise ValueError('Logits of %d dims for samples of %d dims'
+                         % (z.ndim, x.ndim))
+    return T.nnet.softplus(z).sum(axis=z.ndim-1) - xz
+
 def _binary_entropy(p):
     #p_c = T.clip(p, _clip, 1.0 - _clip)
     entropy = -p * T.log(p) - (1 - p) * T.log(1 - p)
@@ -380,23 +503,17 @@ def _categorical_entropy(p):
 # GAUSSIAN ---------------------------------------------------------------------
 
 def _normal(trng, p, size=None):
-    dim = p.shape[p.ndim-1] // 2
-    mu = _slice(p, 0, dim)
-    log_sigma = _slice(p, 1, dim)
+    mu, log_sigma = gaussian_params(p)
 
     if size is None:
         size = mu.shape
     return trng.normal(avg=mu, std=T.exp(log_sigma), size=size, dtype=floatX)
 
 def _normal_prob(p):
-    dim = p.shape[p.ndim-1] // 2
-    mu = _slice(p, 0, dim)
-    return mu
+    return gaussian_params(p).mu
 
 def _neg_normal_log_prob(x, p, clip=None):
-    dim = p.shape[p.ndim-1] // 2
-    mu = _slice(p, 0, dim)
-    log_sigma = _slice(p, 1, dim)
+    mu, log_sigma = gaussian_params(p)
     if clip is not None:
         log_sigma = T.maximum(log_sigma, clip)
     energy = 0.5 * (
@@ -404,8 +521,7 @@ def _neg_normal_log_prob(x, p, clip=None):
     return energy.sum(axis=energy.ndim-1)
 
 def _normal_entropy(p, clip=None):
-    dim = p.shape[p.ndim-1] // 2
-    log_sigma = _slice(p, 1, dim)
+    log_sigma = gaussian_params(p).log_sigma
     if clip is not None:
         log_sigma = T.maximum(log_sigma, clip)
     entropy = 0.5 * T.log(2 * pi * e) + log_sigma
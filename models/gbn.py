@@ -8,18 +8,21 @@ import theano
 from theano import tensor as T
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
-from distributions import Gaussian
+from distributions import (
+    Gaussian,
+    GaussianParams,
+    flatten_params,
+    gaussian_params
+)
 from layers import Layer
 from mlp import resolve as resolve_mlp
 from utils import floatX, intX, pi
 from utils import tools
 from utils.tools import (
-    concatenate,
     init_rngs,
     init_weights,
     log_mean_exp,
-    log_sum_exp,
-    _slice
+    log_sum_exp
 )
 
 
@@ -188,11 +191,8 @@ class GBN(Layer):
         return self.conditional.step_feed(h, *params)
 
     def kl_divergence(self, p, q):
-        dim = self.dim_h
-        mu_p = _slice(p, 0, dim)
-        log_sigma_p = _slice(p, 1, dim)
-        mu_q = _slice(q, 0, dim)
-        log_sigma_q = _slice(q, 1, dim)
+        mu_p, log_sigma_p = gaussian_params(p)
+        mu_q, log_sigma_q = gaussian_params(q)
 
         kl = log_sigma_q - log_sigma_p + 0.5 * (
             (T.exp(2 * log_sigma_p) + (mu_p - mu_q) ** 2) /
@@ -271,7 +271,7 @@ class GBN(Layer):
             batch_energies=y_energy
         )
 
-        constants = [qk_c]
+        constants = flatten_params([qk_c])
         return results, samples, constants
 
 
@@ -381,7 +381,7 @@ class DeepGBN(Layer):
         return self.conditionals[level].step_call(h, *params)
 
     def sample_from_prior(self, n_samples=100):
-        p = T.concatenate([self.mu, self.log_sigma])
+        p = GaussianParams(self.mu, self.log_sigma)
         h, updates = self.posteriors[-1].sample(p=p, size=(n_samples, self.dim_h))
 
         for conditional in self.conditionals[::-1]:
@@ -392,11 +392,8 @@ class DeepGBN(Layer):
 
     def kl_divergence(self, p, q,
                       entropy_scale=1.0):
-        dim = self.dim_h
-        mu_p = _slice(p, 0, dim)
-        log_sigma_p = _slice(p, 1, dim)
-        mu_q = _slice(q, 0, dim)
-        log_sigma_q = _slice(q, 1, dim)
+        mu_p, log_sigma_p = gaussian_params(p)
+        mu_q, log_sigma_q = gaussian_params(q)
 
         kl = log_sigma_q - log_sigma_p + 0.5 * (
             (T.exp(2 * log_sigma_p) + (mu_p - mu_q) ** 2) /
@@ -412,8 +409,7 @@ class DeepGBN(Layer):
         h_energy = T.constant(0.).astype(floatX)
 
         mu = self.mu[None, None, :]
-        log_sigma = self.log_sigma[None, None, :]
-        p_y = concatenate([mu, log_sigma], axis=2)
+        p_y = GaussianParams(mu, self.log_sigma[None, None, :])
 
         for l in xrange(self.n_layers - 1, -1, -1):
             q = qs[l]
@@ -436,14 +432,13 @@ class DeepGBN(Layer):
         return (prior_energy, h_energy, y_energy), constants
 
     def e_step(self, y, qs, *params):
-        prior = concatenate(params[:1], axis=0)
-        consider_constant = [y, prior]
+        prior = GaussianParams(*params[:2])
+        consider_constant = [y] + list(prior)
         cost = T.constant(0.).astype(floatX)
 
         for l in xrange(self.n_layers):
             q = qs[l]
-            mu_q = _slice(q, 0, self.dim_h)
-            log_sigma_q = _slice(q, 1, self.dim_h)
+            mu_q, log_sigma_q = gaussian_params(q)
 
             kl_term = self.kl_divergence(q, prior).mean(axis=0)
 
@@ -580,7 +575,7 @@ class DeepGBN(Layer):
 
         q0s = []
 
-        prior = T.concatenate([self.mu[None, :], self.log_sigma[None, :]], axis=1)
+        prior = GaussianParams(self.mu[None, :], self.log_sigma[None, :])
 
         if end_with_inference:
             (_, xs, ys, qss), updates_i = self.infer_q(
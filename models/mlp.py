@@ -3,6 +3,7 @@ Module for MLP model.
 '''
 
 from collections import OrderedDict
+import copy
 import numpy as np
 import theano
 from theano import tensor as T
@@ -11,15 +12,19 @@ import warnings
 import distributions
 from distributions import (
     Distribution,
+    GaussianParams,
+    map_params,
     resolve as resolve_distribution
 )
 from layers import Layer
+from utils.binary import dot
 from utils.tools import (
     concatenate,
     floatX,
     init_rngs,
     init_weights,
-    norm_weight
+    norm_weight,
+    _slice2
 )
 
 
@@ -29,10 +34,104 @@ def resolve(c):
     elif c == 'lfmlp':
         return LFMLP
     elif c == 'mmmlp':
-        return MultimodalMLP
+        return MultiModalMLP
     else:
         raise ValueError(c)
 
+def flatten_call(f, x, *params):
+    '''
+    Applies `f` to `x` with its leading dimensions flattened.
+
+    `T.dot` of a 3d (or higher) tensor and a matrix is not always a single
+    GEMM, so (n_samples, batch, dim) inputs are reshaped to
+    (n_samples * batch, dim), `f` runs on matrices, and every output is
+    reshaped back. Broadcastable leading dimensions of `x` are kept.
+
+    Args:
+        f: function. Maps a matrix and `params` to an OrderedDict of
+            matrices or GaussianParams of matrices (e.g. `MLP.step_call`).
+        x: T.tensor. Input with 3 or more dimensions.
+        *params: passed to `f`.
+
+    Returns:
+        OrderedDict: outputs of `f` with the leading dimensions of `x`.
+
+    '''
+    lead = x.shape[:-1]
+    x2 = x.reshape((T.prod(lead), x.shape[x.ndim-1]), ndim=2)
+    outs = f(x2, *params)
+
+    def unflatten(v):
+        v = v.reshape(T.concatenate([lead, v.shape[1:]]), ndim=x.ndim)
+        return T.patternbroadcast(v, x.broadcastable[:-1] + (False,))
+
+    rval = OrderedDict(x=x)
+    for k, v in outs.iteritems():
+        if k == 'x':
+            continue
+        rval[k] = map_params(unflatten, v)
+    return rval
+
+
+def block_filter_idx(shape):
+    '''
+    Indices of filters over contiguous blocks of units.
+
+    Args:
+        shape: list of int. Block sizes.
+
+    Returns:
+        np.array: (n_filters, filter_size) indices, padded with the number
+            of units.
+
+    '''
+    sizes = np.array(shape)
+    starts = np.cumsum(sizes) - sizes
+    offsets = np.arange(sizes.max())
+    idx = starts[:, None] + offsets[None, :]
+    idx[offsets[None, :] >= sizes[:, None]] = sizes.sum()
+    return idx
+
+def local_filter_idx(prototype, shape, stride=1):
+    '''
+    Indices of local filters tiled over the units of a prototype array.
+
+    Filters of `shape` are tiled over `prototype` with `stride`. Units are
+    the nonzero entries of `prototype` in C order. Filters with no units are
+    dropped.
+
+    Args:
+        prototype: np.array. Mask of units.
+        shape: tuple of int. Filter shape, same length as `prototype.shape`.
+        stride: int.
+
+    Returns:
+        np.array: (n_filters, filter_size) indices, padded with the number
+            of units. `filter_size` is the largest number of units in a
+            filter.
+
+    '''
+    mask = (np.asarray(prototype) != 0).flatten()
+    dim = mask.sum()
+
+    starts = np.meshgrid(*[np.arange(0, s - f_s + 1, stride)
+                           for s, f_s in zip(prototype.shape, shape)],
+                         indexing='ij')
+    starts = np.array([s.flatten() for s in starts]).T
+    offsets = np.indices(shape).reshape((len(shape), -1)).T
+    coords = starts[:, None, :] + offsets[None, :, :]
+    flat = np.ravel_multi_index(tuple(coords.transpose(2, 0, 1)),
+                                prototype.shape)
+
+    units = np.where(mask, np.cumsum(mask) - 1, dim)
+    idx = units[flat]
+
+    # Units first, then padding, trimmed to the largest filter.
+    order = np.argsort(idx == dim, axis=1, kind='mergesort')
+    idx = idx[np.arange(idx.shape[0])[:, None], order]
+    sizes = (idx < dim).sum(axis=1)
+    return idx[sizes > 0, :sizes.max()]
+
 
 class MLP(Layer):
     must_sample = False
@@ -40,10 +139,12 @@ class MLP(Layer):
                  f_sample=None, f_neg_log_prob=None, f_entropy=None,
                  h_act='T.nnet.sigmoid', distribution='binomial', out_act=None,
                  distribution_args=dict(),
+                 sparse_first_layer=False,
                  name='MLP',
                  **kwargs):
 
         self.dim_in = dim_in
+        self.sparse_first_layer = sparse_first_layer
 
         if out_act is not None:
             warnings.warn('out_act option going away. Use `distribution`.', FutureWarning)
@@ -156,6 +257,9 @@ class MLP(Layer):
         return params
 
     def step_call(self, x, *params):
+        if x.ndim > 2:
+            return flatten_call(self.step_call, x, *params)
+
         params = list(params)
         outs = OrderedDict(x=x)
         for l in xrange(self.n_layers):
@@ -166,17 +270,14 @@ class MLP(Layer):
                 print 'Using weight noise in layer %d for MLP %s' % (l, self.name)
                 W += self.trng.normal(avg=0., std=self.weight_noise, size=W.shape)
 
-            preact = T.dot(x, W) + b
+            preact = self.layer_preact(l, x, W, b)
 
             if l < self.n_layers - 1:
                 x = eval(self.h_act)(preact)
                 outs['preact_%d' % l] = preact
                 outs[l] = x
             else:
-                if self.distribution is not None:
-                    x = self.distribution(preact)
-                else:
-                    x = eval(self.h_act)(preact)
+                x = self.prob_from_preact(preact)
                 outs['z'] = preact
                 outs['p'] = x
 
@@ -195,6 +296,17 @@ class MLP(Layer):
         assert len(params) == 0, params
         return outs
 
+    def layer_preact(self, l, x, W, b):
+        return dot(x, W, sparse=self.sparse_first_layer and l == 0) + b
+
+    def prob_from_preact(self, z):
+        '''
+        Output of the last layer from its preactivation `z`.
+        '''
+        if self.distribution is not None:
+            return self.distribution(z)
+        return eval(self.h_act)(z)
+
     def __call__(self, x):
         params = self.get_params()
         outs = self.step_call(x, *params)
@@ -215,59 +327,40 @@ class MLP(Layer):
 
 class LFMLP(MLP):
     '''
-    Local filters MLP (In progress)
+    Local filters MLP.
+
+    With `filter_in`, the first layer is local: filter k maps the input units
+    `filter_idx[k]` to its own `dim_f` hidden units. Otherwise the last layer
+    is, and filter k maps its `dim_f` hidden units to the output units
+    `filter_idx[k]`, summed where filters overlap. Filters are either
+    contiguous blocks of sizes `shape`, or a filter `shape` tiled with
+    `stride` over the nonzero units of a `prototype` array.
+
+    Local weights are stored per filter, (n_filters, filter_size, dim_f) in
+    or (n_filters, dim_f, filter_size) out, and units are gathered (or
+    scattered) by index, so the local layer costs about as much as its
+    number of weights.
     '''
     def __init__(self, dim_in, dim_out, dim_h=None, dim_hs=None, n_layers=None,
                  dim_f=None, filter_in=True, prototype=None, stride=1, shape=None,
                  name='LFMLP', **kwargs):
 
         self.filter_in = filter_in
+        dim_local = dim_in if self.filter_in else dim_out
 
         if prototype is None:
             assert isinstance(shape, list)
-            if self.filter_in:
-                assert reduce(lambda x, y: x + y, shape) == dim_in
-            else:
-                assert reduce(lambda x, y: x + y, shape) == dim_out
-            accum = 0
-            filter_idx = []
-            for s in shape:
-                filter_idx.append(range(accum, accum + s))
-                accum += s
+            assert sum(shape) == dim_local
+            filter_idx = block_filter_idx(shape)
         else:
-            if self.filter_in:
-                assert prototype.sum() == dim_in
-            else:
-                assert prototype.sum() == dim_out
-
+            assert prototype.sum() == dim_local
             assert len(prototype.shape) == len(shape)
+            filter_idx = local_filter_idx(prototype, shape, stride=stride)
 
-            def make_filter_idx(f_shape, shape, start):
-                idx = range(start[0], f_shape[0] + start[0])
-                for st, f_s, s in zip(start[:-1][::-1], f_shape[:-1][::-1], shape[:-1][::-1]):
-                    idx_new = []
-                    for i in idx:
-                        idx_new += [s * i + j for j in range(st, f_s + st)]
-                    idx = idx_new
-                return idx
-
-            incs = [range(0, s - f_s + 1, stride) for s, f_s in zip(prototype.shape, shape)]
-            starts = [[i] for i in incs[0]]
-            for inc in incs[1:]:
-                new_starts = []
-                for i in inc:
-                    new_starts += [s + [i] for s in starts]
-                starts = new_starts
-            filter_idx = [make_filter_idx(shape, prototype.shape, start) for start in starts]
-
-            mask_idx = [i for i, j in enumerate(prototype.flatten()) if j == 1]
-            idx_mask = dict((j, i) for i, j in enumerate(mask_idx))
-
-            filter_idx = [[idx_mask[i] for i in f_idx if i in mask_idx] for f_idx in filter_idx]
-
-        print 'Formed %d filters' % len(filter_idx)
+        print 'Formed %d filters of up to %d units' % filter_idx.shape
 
         self.filter_idx = filter_idx
+        self.dim_local = dim_local
 
         assert dim_f is not None
 
@@ -288,7 +381,7 @@ class LFMLP(MLP):
         else:
             dim_hs.append(dim_f)
 
-        super(LFMLP, self).__init__(dim_in, dim_out, name=name, excludes=['f'],
+        super(LFMLP, self).__init__(dim_in, dim_out, name=name,
                                     dim_h=None, n_layers=None, dim_hs=dim_hs,
                                     **kwargs)
 
@@ -297,8 +390,15 @@ class LFMLP(MLP):
                 **kwargs):
         return LFMLP(dim_in, dim_out, **kwargs)
 
+    def is_local(self, l):
+        if self.filter_in:
+            return l == 0
+        return l == self.n_layers - 1
+
     def set_params(self):
         self.params = OrderedDict()
+        n_filters, filter_size = self.filter_idx.shape
+        padding = self.filter_idx == self.dim_local
 
         for l in xrange(self.n_layers):
             if l == 0:
@@ -307,225 +407,263 @@ class LFMLP(MLP):
                 dim_in = self.dim_hs[l-1]
             dim_out = self.dim_hs[l]
 
-            if self.filter_in:
-                if l == 0:
-                    f = np.zeros((len(self.filter_idx), dim_in)).astype(floatX)
-
-                    for i, f_idx in enumerate(self.filter_idx):
-                        f[i, f_idx] = 1
-
-                    dim_out *= len(self.filter_idx)
-                    self.params['f'] = f
-                elif l == 1:
-                    dim_in *= len(self.filter_idx)
-            elif not self.filter_in:
-                if l == self.n_layers - 1:
-                    f = np.zeros((len(self.filter_idx), dim_out)).astype(floatX)
-                    for i, f_idx in enumerate(self.filter_idx):
-                        f[i, f_idx] = 1
-
-                    dim_in *= len(self.filter_idx)
-                    self.params['f'] = f
-                elif l == self.n_layers - 2:
-                    dim_out *= len(self.filter_idx)
-
-            W = norm_weight(dim_in, dim_out,
-                            scale=self.weight_scale, ortho=False)
+            if self.is_local(l):
+                dim_f = dim_out if self.filter_in else dim_in
+                W = norm_weight(n_filters * filter_size, dim_f,
+                                scale=self.weight_scale, ortho=False)
+                W = W.reshape((n_filters, filter_size, dim_f))
+                W[padding] = 0.
+                if self.filter_in:
+                    dim_out *= n_filters
+                else:
+                    W = W.transpose(0, 2, 1).copy()
+            else:
+                if self.filter_in and l == 1:
+                    dim_in *= n_filters
+                elif not self.filter_in and l == self.n_layers - 2:
+                    dim_out *= n_filters
+                W = norm_weight(dim_in, dim_out,
+                                scale=self.weight_scale, ortho=False)
             b = np.zeros((dim_out,)).astype(floatX)
             self.params['W%d' % l] = W
             self.params['b%d' % l] = b
 
-    def get_params(self):
-        params = [self.f] + super(LFMLP, self).get_params()
-        return params
+    def layer_preact(self, l, x, W, b):
+        if not self.is_local(l):
+            return dot(x, W, sparse=self.sparse_first_layer and l == 0) + b
 
-    def step_call(self, x, f, *params):
-        params = list(params)
-        outs = OrderedDict(x=x)
-        for l in xrange(self.n_layers):
-            W = params.pop(0)
-            b = params.pop(0)
+        n_filters, filter_size = self.filter_idx.shape
+        idx = T.constant(self.filter_idx.flatten())
+        if self.filter_in:
+            # Gathers the units of each filter, with a zero padding unit.
+            x = T.concatenate([x, T.zeros_like(x[:, :1])], axis=1).T
+            x = x[idx].astype(floatX).reshape(
+                (n_filters, filter_size, x.shape[1])).dimshuffle(0, 2, 1)
+            y = T.batched_dot(x, W)
+            y = y.dimshuffle(1, 0, 2).reshape(
+                (y.shape[1], n_filters * W.shape[2]))
+        else:
+            # Scatters each filter to its units, summing overlaps, and drops
+            # the padding unit.
+            x = x.reshape((x.shape[0], n_filters, W.shape[1]))
+            y = T.batched_dot(x.dimshuffle(1, 0, 2), W)
+            y = y.dimshuffle(0, 2, 1).reshape(
+                (n_filters * filter_size, y.shape[1]))
+            y = T.inc_subtensor(
+                T.zeros((self.dim_local + 1, y.shape[1]), dtype=y.dtype)[idx],
+                y)
+            y = y[:self.dim_local].T
+        return y + b
 
-            if self.weight_noise:
-                print 'Using weight noise in layer %d for MLP %s' % (l, self.name)
-                W += self.trng.normal(avg=0., std=self.weight_noise, size=W.shape)
 
-            if ((self.filter_in and l == 0)
-                or (not(self.filter_in) and l == self.n_layers - 1)):
-                W_ = W[None, :, :] * f[:, :, None]
-                W_ = W_.reshape((W_.shape[0] * W_.shape[1], W_.shape[2])).astype(floatX)
-                preact = T.dot(x, W) + b
-            else:
-                preact = T.dot(x, W) + b
+# MULTIMODAL MLP CLASS --------------------------------------------------------
 
-            if l < self.n_layers - 1:
-                x = eval(self.h_act)(preact)
-                outs['preact_%d' % l] = preact
-                outs[l] = x
-            else:
-                if self.distribution is not None:
-                    x = self.distribution(preact)
-                else:
-                    x = eval(self.h_act)(preact)
-                outs['z'] = preact
-                outs['p'] = x
+_out_acts = {
+    'T.nnet.sigmoid': 'binomial',
+    'T.tanh': 'centered_binomial',
+    'T.nnet.softmax': 'multinomial',
+    'lambda x: x': 'gaussian'
+}
 
-            if self.dropout and l != self.n_layers - 1:
-                print 'Adding dropout to layer {layer} for MLP {name}'.format(
-                    layer=l, name=self.name)
-                if activ == 'T.tanh':
-                    raise NotImplementedError('dropout for tanh units not implemented yet')
-                elif activ in ['T.nnet.sigmoid', 'T.nnet.softplus', 'lambda x: x']:
-                    x_d = self.trng.binomial(x.shape, p=1-self.dropout, n=1,
-                                             dtype=x.dtype)
-                    x = x * x_d / (1 - self.dropout)
-                else:
-                    raise NotImplementedError('No dropout for %s yet' % activ)
+def _join(xs):
+    if len(xs) == 1:
+        return xs[0]
+    # Gaussian parameters are only packed when joined with other outputs.
+    xs = [x.pack() if isinstance(x, GaussianParams) else x for x in xs]
+    return concatenate(xs, axis=(xs[0].ndim-1))
 
-        assert len(params) == 0, params
-        return outs
 
+class MultiModalMLP(Layer):
+    '''
+    MLP over a graph of layers with several output modalities.
 
-# MULTIMODAL MLP CLASS --------------------------------------------------------
+    `graph` has `layers`, hidden layers with a `dim` and `act`, `outs`, output
+    layers with a `dim` and `distribution` (or an `act`, going away), and
+    `edges`, (input, output) pairs where 'i' is the input. Every layer has a
+    single input. Parameters are concatenated over outputs in `edges` order.
 
-class MultiModalMLP(Layer):
-    def __init__(self, dim_in, graph, log_prob_scale=dict(), name='MLP',
-                 **kwargs):
+    The graph is compiled once into a static plan (see `compile_graph`), so
+    the conditional is formed with as many GEMMs as there are distinct layer
+    inputs.
+    '''
+    must_sample = False
+    def __init__(self, dim_in, graph, log_prob_scale=dict(),
+                 sparse_first_layer=False, name='MLP', **kwargs):
         graph = copy.deepcopy(graph)
 
-        self.layers = OrderedDict()
-        self.layers.update(**graph['layers'])
-        self.edges = graph['edges']
-        outs = graph['outs'].keys()
-        for k in outs:
-            assert not k in self.layers.keys()
-        self.layers.update(**graph['outs'])
-
-        for l in self.layers.keys():
-            if self.layers[l]['act'] == 'lambda x: x':
-                self.layers[l]['dim'] *= 2
+        self.dim_in = dim_in
+        self.sparse_first_layer = sparse_first_layer
+        self.layers = OrderedDict(graph.get('layers', dict()))
+        self.edges = [tuple(edge) for edge in graph['edges']]
 
         self.outs = OrderedDict()
-        for i, o in self.edges:
-            if o in outs:
-                assert not o in self.outs.keys()
-                o_dict = OrderedDict()
-                act = self.layers[o]['act']
-                if act == 'T.nnet.sigmoid':
-                    o_dict['f_sample'] = _binomial
-                    o_dict['f_neg_log_prob'] = _cross_entropy
-                    o_dict['f_entropy'] = _binary_entropy
-                    o_dict['f_prob'] = lambda x: x
-                elif act == 'T.nnet.softmax':
-                    o_dict['f_sample'] = _sample_softmax
-                    o_dict['f_neg_log_prob'] = _categorical_cross_entropy
-                    o_dict['f_entropy'] = _categorical_entropy
-                    o_dict['f_prob'] = lambda x: x
-                    self.layers[o]['act'] = '_softmax'
-                elif act == 'T.tanh':
-                    o_dict['f_sample'] = _centered_binomial
-                elif act == 'lambda x: x':
-                    o_dict['f_sample'] = _normal
-                    o_dict['f_neg_log_prob'] = _neg_normal_log_prob
-                    o_dict['f_entropy'] = _normal_entropy
-                    o_dict['f_prob'] = _normal_prob
-                else:
-                    raise ValueError(act)
-
-                if log_prob_scale.get(o, None) is not None:
-                    o_dict['log_prob_scale'] = log_prob_scale[o]
-
-                self.outs[o] = o_dict
+        for _, o in self.edges:
+            if not o in graph['outs']:
+                continue
+            assert not o in self.layers.keys()
+            assert not o in self.outs.keys()
+            out = graph['outs'][o]
+            distribution = out.get('distribution', None)
+            if distribution is None:
+                warnings.warn('`act` of outputs going away. Use '
+                              '`distribution`.', FutureWarning)
+                distribution = _out_acts[out['act']]
+            self.outs[o] = resolve_distribution(
+                distribution, conditional=True)(out['dim'])
+            self.layers[o] = dict(dim=out['dim'] * self.outs[o].scale)
+        self.log_prob_scale = log_prob_scale
 
         assert not 'i' in self.layers.keys()
         self.layers['i'] = dict(dim=dim_in)
+        self.dim_out = sum(self.layers[o]['dim'] for o in self.outs.keys())
+
+        self.compile_graph()
 
         kwargs = init_weights(self, **kwargs)
         kwargs = init_rngs(self, **kwargs)
-
-        #assert len(kwargs) == 0, 'Got extra args: %r' % kwargs.keys()
-        super(MultiModalMLP, self).__init__(name=name)
+        super(MultiModalMLP, self).__init__(name=name, **kwargs)
 
     @staticmethod
     def factory(dim_in=None, graph=None, **kwargs):
         return MultiModalMLP(dim_in, graph, **kwargs)
 
-    def sample(self, p, size=None, split=False):
-        if size is None:
-            size = p.shape
+    def compile_graph(self):
+        '''
+        Compiles the graph into a static plan.
+
+        Layers are ordered breadth first from the input, and the layers that
+        share an input are fused into one GEMM on their concatenated weights.
+        `self.plan` has one entry per GEMM, with its input, the column range
+        of each of its layers, and the runs of hidden columns that share an
+        activation.
+
+        Output offsets in the parameters and samples are fixed here, and
+        neighbouring outputs with the same elementwise distribution are
+        merged into single runs (`self.out_runs`). `self.z_runs` are the
+        column ranges of the GEMMs that form the concatenated output
+        preactivations.
+        '''
+        inputs = OrderedDict()
+        children = OrderedDict((l, []) for l in self.layers.keys())
+        for i, o in self.edges:
+            assert not o == 'i'
+            assert not i in self.outs, 'Output %s has outgoing edges' % i
+            assert not o in inputs, 'Layer %s has more than one input' % o
+            inputs[o] = i
+            children[i].append(o)
+
+        self.plan = []
+        columns = dict()
+        queue = ['i']
+        while len(queue) > 0:
+            i = queue.pop(0)
+            # Outputs go first so that their columns are contiguous.
+            os = ([o for o in self.outs.keys() if o in children[i]]
+                  + [o for o in children[i] if not o in self.outs])
+            if len(os) == 0:
+                continue
+
+            step = OrderedDict(input=i, layers=OrderedDict(), runs=[])
+            start = 0
+            for o in os:
+                dim = self.layers[o]['dim']
+                step['layers'][o] = (start, start + dim)
+                columns[o] = (len(self.plan), start, start + dim)
+                if not o in self.outs:
+                    act = self.layers[o]['act']
+                    if len(step['runs']) > 0 and step['runs'][-1][2] == act:
+                        step['runs'][-1] = (step['runs'][-1][0], start + dim,
+                                            act)
+                    else:
+                        step['runs'].append((start, start + dim, act))
+                    queue.append(o)
+                start += dim
+            step['dim'] = start
+            self.plan.append(step)
+
+        missing = [l for l in self.layers.keys()
+                   if l != 'i' and not l in columns]
+        if len(missing) > 0:
+            raise ValueError('Layers %s are not connected to the input'
+                             % missing)
+
+        self.z_runs = []
+        self.out_runs = []
         start = 0
-        x = []
-        for o, v in self.outs.iteritems():
+        start_x = 0
+        for o, distribution in self.outs.iteritems():
             dim = self.layers[o]['dim']
-            f_sample = v['f_sample']
-            p_ = _slice2(p, start, start+dim)
-            if self.layers[o]['act'] == 'lambda x: x':
-                scale = 2
-            else:
-                scale = 1
+            dim_x = dim // distribution.scale
+            scale = self.log_prob_scale.get(o, None)
 
-            if size is None:
-                size_ = None
+            s, c_start, c_stop = columns[o]
+            if (len(self.z_runs) > 0 and self.z_runs[-1][0] == s
+                and self.z_runs[-1][2] == c_start):
+                self.z_runs[-1] = (s, self.z_runs[-1][1], c_stop)
             else:
-                if p.ndim == 1:
-                    size_ = (size[0], p_.shape[0] // scale)
-                elif p.ndim == 2:
-                    size_ = (size[0], p_.shape[0], p_.shape[1] // scale)
-                elif p.ndim == 3:
-                    size_ = (size[0], p_.shape[0], p_.shape[1], p_.shape[2] // scale)
-                else:
-                    raise ValueError()
-            x.append(f_sample(self.trng, p_, size=size_))
+                self.z_runs.append((s, c_start, c_stop))
+
+            run = self.out_runs[-1] if len(self.out_runs) > 0 else None
+            # Only elementwise distributions can share a run.
+            if (run is not None
+                and isinstance(distribution, distributions.Binomial)
+                and type(run['distribution']) == type(distribution)
+                and run['scale'] == scale):
+                run['stop'] += dim
+                run['stop_x'] += dim_x
+            else:
+                self.out_runs.append(dict(
+                    start=start, stop=start + dim,
+                    start_x=start_x, stop_x=start_x + dim_x,
+                    distribution=distribution, scale=scale))
             start += dim
+            start_x += dim_x
 
-        if split:
-            return x
-        else:
-            return concatenate(x, axis=(x[0].ndim-1))
+    def _runs(self, p):
+        if len(self.out_runs) == 1:
+            return [p]
+        return [_slice2(p, run['start'], run['stop'])
+                for run in self.out_runs]
+
+    def sample(self, p, n_samples=1):
+        x = []
+        updates = theano.OrderedUpdates()
+        for run, p_ in zip(self.out_runs, self._runs(p)):
+            x_, updates_ = run['distribution'].sample(n_samples, p=p_)
+            x.append(x_)
+            updates.update(updates_)
+        return _join(x), updates
 
     def neg_log_prob(self, x, p):
         neg_log_prob = T.constant(0.).astype(floatX)
-        start = 0
-        start_x = 0
-        for o, v in self.outs.iteritems():
-            dim = self.layers[o]['dim']
-            f_neg_log_prob = v['f_neg_log_prob']
-            log_prob_scale = v.get('log_prob_scale', 1.0)
-            if self.layers[o]['act'] == 'lambda x: x':
-                scale = 2
-            else:
-                scale = 1
-            p_ = _slice2(p, start, start + dim)
-            x_ = _slice2(x, start_x, start_x + dim // scale)
-            neg_log_prob += f_neg_log_prob(x_, p_, scale=log_prob_scale)
-            start += dim
-            start_x += dim // scale
-
+        for run, p_ in zip(self.out_runs, self._runs(p)):
+            x_ = _slice2(x, run['start_x'], run['stop_x'])
+            neg_log_prob_ = run['distribution'].neg_log_prob(x_, p_)
+            if run['scale'] is not None:
+                neg_log_prob_ *= run['scale']
+            neg_log_prob += neg_log_prob_
         return neg_log_prob
 
     def entropy(self, p):
-        start = 0
         entropy = T.constant(0.).astype(floatX)
-        for o, v in self.outs.iteritems():
-            dim = self.layers[o]['dim']
-            f_entropy = v['f_entropy']
-            p_ = _slice2(p, start, start + dim)
-            entropy += f_entropy(p_)
-            start += dim
-
+        for run, p_ in zip(self.out_runs, self._runs(p)):
+            entropy += run['distribution'].entropy(p_)
         return entropy
 
-    def prob(self, p):
+    def get_center(self, p):
+        return _join([run['distribution'].get_center(p_)
+                      for run, p_ in zip(self.out_runs, self._runs(p))])
+
+    def split(self, p):
+        if len(self.outs) == 1:
+            return [p]
+        ps = []
         start = 0
-        x = []
-        for o, v in self.outs.iteritems():
+        for o in self.outs.keys():
             dim = self.layers[o]['dim']
-            f_prob = v['f_prob']
-            p_ = _slice2(p, start, start + dim)
-            x.append(f_prob(p_))
+            ps.append(_slice2(p, start, start + dim))
             start += dim
-
-        return x
+        return ps
 
     def get_L2_weight_cost(self, gamma, layers=None):
         if layers is None:
@@ -539,29 +677,15 @@ class MultiModalMLP(Layer):
 
         return cost
 
-    def split(self, p):
-        start = 0
-        ps = []
-        for o, v in self.outs.iteritems():
-            dim = self.layers[o]['dim']
-            p_ = _slice2(p, start, start + dim)
-            ps.append(p_)
-            start += dim
-
-        return ps
-
     def set_params(self):
         self.params = OrderedDict()
 
         for i, o in self.edges:
-            assert not o == 'i'
-            assert not i in self.outs
-
             dim_in = self.layers[i]['dim']
             dim_out = self.layers[o]['dim']
 
-            W = tools.norm_weight(dim_in, dim_out,
-                                  scale=self.weight_scale, ortho=False)
+            W = norm_weight(dim_in, dim_out,
+                            scale=self.weight_scale, ortho=False)
             b = np.zeros((dim_out,)).astype(floatX)
 
             self.params['W_%s' % o] = W
@@ -576,48 +700,77 @@ class MultiModalMLP(Layer):
 
         return params
 
-    def preact(self, x, *params):
-        # Used within scan with `get_params`
-        params = list(params)
-        outs = dict(i=x)
+    def step_call(self, x, *params):
+        if x.ndim > 2:
+            return flatten_call(self.step_call, x, *params)
 
-        for i, o in self.edges:
-            x = outs[i]
-            assert not o in outs.keys()
-            W = params.pop(0)
-            b = params.pop(0)
+        params = list(params)
+        Wbs = OrderedDict()
+        for _, o in self.edges:
+            Wbs[o] = (params.pop(0), params.pop(0))
+        assert len(params) == 0, params
 
-            if o in self.outs:
-                x = T.dot(x, W) + b
+        outs = OrderedDict(x=x)
+        hs = dict(i=x)
+        preacts = []
+        for step in self.plan:
+            layers = step['layers'].keys()
+            if len(layers) == 1:
+                W, b = Wbs[layers[0]]
+            else:
+                W = T.concatenate([Wbs[l][0] for l in layers], axis=1)
+                b = T.concatenate([Wbs[l][1] for l in layers])
+            preact = dot(hs[step['input']], W, sparse=(
+                self.sparse_first_layer and step['input'] == 'i')) + b
+            preacts.append(preact)
+
+            for start, stop, act in step['runs']:
+                if start == 0 and stop == step['dim']:
+                    h = eval(act)(preact)
+                else:
+                    h = eval(act)(preact[:, start:stop])
+                for l in layers:
+                    l_start, l_stop = step['layers'][l]
+                    if l_start < start or l_stop > stop:
+                        continue
+                    if l_start == start and l_stop == stop:
+                        hs[l] = h
+                    else:
+                        hs[l] = h[:, l_start-start:l_stop-start]
+                    outs['preact_%s' % l] = preact[:, l_start:l_stop]
+                    outs[l] = hs[l]
+
+        z = []
+        for s, start, stop in self.z_runs:
+            if start == 0 and stop == self.plan[s]['dim']:
+                z.append(preacts[s])
             else:
-                act = self.layers[o]['act']
-                x = eval(act)(T.dot(x, W) + b)
+                z.append(preacts[s][:, start:stop])
+        z = _join(z)
+        outs['z'] = z
+        outs['p'] = self.prob_from_preact(z)
+        return outs
 
-            outs[o] = x
+    def prob_from_preact(self, z):
+        '''
+        Outputs of every modality from the output preactivations `z`.
+        '''
+        return _join([run['distribution'](z_)
+                      for run, z_ in zip(self.out_runs, self._runs(z))])
 
-        x = []
-        for o in self.outs.keys():
-            x.append(outs[o])
+    def __call__(self, x):
+        params = self.get_params()
+        outs = self.step_call(x, *params)
+        return outs
 
-        return concatenate(x, axis=(x[0].ndim-1))
+    def feed(self, x):
+        return self.__call__(x)['p']
 
-    def step_call(self, x, *params):
-        x = self.preact(x, *params)
-        start = 0
-        y = []
-        for o in self.outs.keys():
-            dim = self.layers[o]['dim']
-            act = self.layers[o]['act']
-            z_ = _slice2(x, start, start + dim)
-            x_  = eval(act)(z_)
-            y.append(x_)
-            start += dim
-        return concatenate(y, axis=(y[0].ndim-1))
+    def step_feed(self, x, *params):
+        return self.step_call(x, *params)['p']
 
-    def __call__(self, x, return_preact=False):
-        params = self.get_params()
-        if return_preact:
-            x = self.preact(x, *params)
-        else:
-            x = self.step_call(x, *params)
-        return x
+    def preact(self, x):
+        return self.__call__(x)['z']
+
+    def step_preact(self, x, *params):
+        return self.step_call(x, *params)['z']
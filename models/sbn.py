@@ -9,13 +9,27 @@ from theano import tensor as T
 from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 from layers import Layer
-from darn import AutoRegressor, DARN
+from darn import (
+    AutoRegressor,
+    DARN,
+    convert_checkpoint
+)
 from distributions import resolve as resolve_prior
 from mlp import (
     MLP,
     MultiModalMLP
 )
 from utils import tools
+from utils.binary import (
+    binary_samples,
+    unique_samples
+)
+from utils.precision import (
+    check_precision,
+    reduce_precision,
+    storage_dtype,
+    upcast
+)
 from utils.tools import (
     concatenate,
     floatX,
@@ -23,6 +37,8 @@ from utils.tools import (
     init_weights,
     log_mean_exp,
     log_sum_exp,
+    online_log_sum_exp,
+    scan,
     update_dict_of_lists,
     _slice
 )
@@ -46,7 +62,10 @@ def unpack(dim_in=None,
     print 'Unpacking model with parameters %s' % model_args.keys()
 
     print 'Forming %s prior model' % prior
-    PC = resolve_prior(prior)
+    if prior == 'darn':
+        PC = AutoRegressor
+    else:
+        PC = resolve_prior(prior)
     prior_model = PC(dim_h)
     models = []
     kwargs = SBN.mlp_factory(dim_h, dims, distributions,
@@ -59,7 +78,7 @@ def unpack(dim_in=None,
     model = SBN(dim_in, dim_h, **kwargs)
     models.append(model)
     models += [model.posterior, model.conditional]
-    return models, model_args, extra_args
+    return models, convert_checkpoint(model_args), extra_args
 
 
 class SBN(Layer):
@@ -67,11 +86,16 @@ class SBN(Layer):
                  posterior=None, conditional=None,
                  prior=None,
                  name='sbn',
+                 precision='float32',
                  **kwargs):
 
         self.dim_in = dim_in
         self.dim_h = dim_h
 
+        # Storage of posterior sample noise and conditional activations.
+        check_precision(precision)
+        self.precision = precision
+
         self.posterior = posterior
         self.conditional = conditional
         self.prior = prior
@@ -234,32 +258,158 @@ class SBN(Layer):
         start  = self.prior.n_params
         stop   = start + self.conditional.n_params
         params = params[start:stop]
-        return self.conditional.step_feed(h, *params)
+        return self.conditional_feed(h, *params)
+
+    def conditional_feed(self, h, *params):
+        '''
+        p(y|h) for samples `h` from the conditional with `params`.
+
+        At reduced precision the conditional takes its input and weights at
+        that precision, so its (n_samples, batch, dim) preactivations come
+        out of the GEMM as float16 (or rounded to bfloat16). Probabilities
+        are taken from the upcast preactivations. They are the float32
+        function of the reduced preactivations with no clipping, and
+        elementwise fusion keeps them out of memory unless they are
+        outputs.
+        '''
+        if self.precision == 'float32':
+            return self.conditional.step_feed(h, *params)
+
+        params = [reduce_precision(p, self.precision) for p in params]
+        z = self.conditional.step_preact(
+            reduce_precision(h, self.precision), *params)
+        z = reduce_precision(z, self.precision)
+        return self.conditional.prob_from_preact(upcast(z))
 
     def init_inference_samples(self, size):
-        return self.posterior.distribution.prototype_samples(size)
-
-    def __call__(self, x, y, qk=None, n_posterior_samples=10):
-        q0  = self.posterior.feed(x)
-
-        if qk is None:
-            qk = q0
-
+        r = self.posterior.distribution.prototype_samples(size)
+        return r.astype(storage_dtype(self.precision))
+
+    def conditional_energies(self, y, h, dedup=False):
+        '''
+        log p(y|h) and p(y|h) for (n_samples, batch, dim_h) samples `h`.
+
+        With `dedup`, the conditional is evaluated once per distinct sample
+        of each example (see `utils.binary.unique_samples`) and log p(y|h)
+        is gathered back for every sample. The estimates are unchanged, and
+        with a saturated posterior most of the conditional pass is skipped.
+        '''
+        if dedup:
+            h_u, example, inverse = unique_samples(h)
+            py_u = self.conditional_feed(h_u, *self.conditional.get_params())
+            log_py_h = -self.conditional.neg_log_prob(y[example], py_u)[inverse]
+            py = py_u[inverse]
+        else:
+            py = self.conditional_feed(h, *self.conditional.get_params())
+            log_py_h = -self.conditional.neg_log_prob(y[None, :, :], py)
+        return log_py_h, py
+
+    def step_energies(self, y, q0, qk, n_samples, dedup=False):
         r   = self.init_inference_samples(
-            (n_posterior_samples, y.shape[0], self.dim_h))
-        h   = (r <= qk[None, :, :]).astype(floatX)
-        py  = self.conditional.feed(h)
+            (n_samples, y.shape[0], self.dim_h))
+        h   = binary_samples(r, qk[None, :, :])
 
         log_ph   = -self.prior.neg_log_prob(h)
         log_qh   = -self.posterior.neg_log_prob(h, q0[None, :, :])
         log_qkh  = -self.posterior.neg_log_prob(h, qk[None, :, :])
-        log_py_h = -self.conditional.neg_log_prob(y[None, :, :], py)
+        log_py_h, py = self.conditional_energies(y, h, dedup=dedup)
+
+        return log_py_h, log_ph, log_qh, log_qkh, py
+
+    def step_accumulate(self, w_max, w_sum, y_sum, prior_sum, h_sum,
+                        y, q0, qk, n_samples, dedup=False):
+        log_py_h, log_ph, log_qh, log_qkh, py = self.step_energies(
+            y, q0, qk, n_samples, dedup=dedup)
+
+        w_max, w_sum, _ = online_log_sum_exp(
+            log_py_h + log_ph - log_qkh, w_max, w_sum)
+
+        return (w_max, w_sum,
+                y_sum + log_py_h.sum(axis=0),
+                prior_sum + log_ph.sum(axis=0),
+                h_sum + log_qh.sum(axis=0),
+                py)
+
+    def chunked_energies(self, y, q0, qk, n_posterior_samples, chunk_size,
+                         dedup=False):
+        '''
+        Importance-sampled bound over chunks of `chunk_size` samples.
+
+        Peak memory scales with `chunk_size` rather than
+        `n_posterior_samples`. The returned `py` is from the last chunk.
+        '''
+        n_chunks  = (n_posterior_samples - 1) // chunk_size
+        last_size = n_posterior_samples - n_chunks * chunk_size
+
+        print ('Streaming %d posterior samples in chunks of %d'
+               % (n_posterior_samples, chunk_size))
+
+        # `qk` may be `q0`, so these are left to scan as implicit inputs.
+        def _step(w_max, w_sum, y_sum, prior_sum, h_sum):
+            return self.step_accumulate(w_max, w_sum, y_sum, prior_sum, h_sum,
+                                        y, q0, qk, chunk_size,
+                                        dedup=dedup)[:-1]
+
+        outputs_info = [T.alloc(T.constant(-np.inf, dtype=floatX), y.shape[0])] + [
+                        T.zeros((y.shape[0],), dtype=floatX) for _ in xrange(4)]
+        outs, updates = scan(_step, [], outputs_info, [], n_chunks,
+                             name=self.name + '_chunked_energies')
+        state = [out[-1] for out in outs]
+
+        w_max, w_sum, y_sum, prior_sum, h_sum, py = self.step_accumulate(
+            *(state + [y, q0, qk, last_size]), dedup=dedup)
+
+        log_p        = w_max + T.log(w_sum) - T.log(n_posterior_samples)
+        y_energy     = -y_sum / n_posterior_samples
+        prior_energy = -prior_sum / n_posterior_samples
+        h_energy     = -h_sum / n_posterior_samples
+
+        return log_p, y_energy, prior_energy, h_energy, py, updates
+
+    def __call__(self, x, y, qk=None, n_posterior_samples=10, chunk_size=None,
+                 state=None, dedup=False):
+        '''
+        Importance-sampled bound with posterior samples from `qk`.
+
+        If `state` (from `AIR.inference_fused`) is given, its samples and
+        log probabilities are used instead of drawing new ones, with
+        `state['q']` as `qk`. `dedup` evaluates the conditional once per
+        distinct sample (see `conditional_energies`).
+        '''
+        q0  = self.posterior.feed(x)
 
-        log_p         = log_sum_exp(log_py_h + log_ph - log_qkh, axis=0) - T.log(n_posterior_samples)
+        if state is not None:
+            qk = state['q']
+        elif qk is None:
+            qk = q0
 
-        y_energy      = -log_py_h.mean(axis=0)
-        prior_energy  = -log_ph.mean(axis=0)
-        h_energy      = -log_qh.mean(axis=0)
+        if state is not None:
+            log_py_h = state['log_py_h']
+            log_ph   = state['log_ph']
+            log_qkh  = state['log_qkh']
+            log_qh   = -self.posterior.neg_log_prob(state['h'], q0[None, :, :])
+            py       = state['py']
+
+            log_p         = log_sum_exp(log_py_h + log_ph - log_qkh, axis=0) - T.log(log_py_h.shape[0]).astype(floatX)
+
+            y_energy      = -log_py_h.mean(axis=0)
+            prior_energy  = -log_ph.mean(axis=0)
+            h_energy      = -log_qh.mean(axis=0)
+            updates       = theano.OrderedUpdates()
+        elif chunk_size is None or chunk_size >= n_posterior_samples:
+            log_py_h, log_ph, log_qh, log_qkh, py = self.step_energies(
+                y, q0, qk, n_posterior_samples, dedup=dedup)
+
+            log_p         = log_sum_exp(log_py_h + log_ph - log_qkh, axis=0) - T.log(n_posterior_samples)
+
+            y_energy      = -log_py_h.mean(axis=0)
+            prior_energy  = -log_ph.mean(axis=0)
+            h_energy      = -log_qh.mean(axis=0)
+            updates       = theano.OrderedUpdates()
+        else:
+            log_p, y_energy, prior_energy, h_energy, py, updates = (
+                self.chunked_energies(y, q0, qk, n_posterior_samples,
+                                      chunk_size, dedup=dedup))
 
         nll           = -log_p
         prior_entropy = self.prior.entropy()
@@ -284,4 +434,4 @@ class SBN(Layer):
             batch_energies=y_energy
         )
 
-        return results, samples, theano.OrderedUpdates()
+        return results, samples, updates
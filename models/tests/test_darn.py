@@ -8,9 +8,16 @@ from theano import tensor as T
 
 from models.darn import (
     AutoRegressor,
-    DARN
+    DARN,
+    autoregressive_sample,
+    block_sample,
+    block_sample_numpy,
+    convert_checkpoint,
+    pack_tril,
+    unpack_tril,
+    unpack_tril_numpy
 )
-from models.sbn import SigmoidBeliefNetwork as SBN
+from models.sbn import SBN
 from utils.tools import (
     floatX
 )
@@ -26,7 +33,7 @@ def test_autoregressor(dim=3, n_samples=5):
     X = T.matrix('X', dtype=floatX)
     nlp = ar.neg_log_prob(X)
     p = ar.get_prob(X, *ar.get_params())
-    W = T.tril(ar.W, k=-1)
+    W = unpack_tril(ar.W, dim)
     z = T.dot(X, W) + ar.b
 
     x = np.random.randint(0, 2, size=(n_samples, dim)).astype(floatX)
@@ -35,12 +42,13 @@ def test_autoregressor(dim=3, n_samples=5):
     nlp_t, p_t, z_t, W_t = f(x)
     print x.shape, nlp_t.shape
     z_np = np.zeros((n_samples, dim)).astype(floatX) + ar.params['b'][None, :]
+    W_np = unpack_tril_numpy(ar.params['W'], dim)
 
     for i in xrange(dim):
         print i
         for j in xrange(i + 1, dim):
             print i, j
-            z_np[:, i] += ar.params['W'][j, i] * x[:, j]
+            z_np[:, i] += W_np[j, i] * x[:, j]
 
     assert np.allclose(z_t, z_np), (z_t, z_np)
     p_np = sigmoid(z_np)
@@ -80,10 +88,11 @@ def test_darn(dim_in=5, dim_h=3, dim_out=7, n_samples=13):
     assert np.allclose(c_t, c_np), (c_t, c_np)
 
     z_np = np.zeros((n_samples, dim_out)).astype(floatX) + darn.params['bar'][None, :] + c_np
+    W_np = unpack_tril_numpy(darn.params['War'], dim_out)
 
     for i in xrange(dim_out):
         for j in xrange(i + 1, dim_out):
-            z_np[:, i] += darn.params['War'][j, i] * x[:, j]
+            z_np[:, i] += W_np[j, i] * x[:, j]
 
     p_np = sigmoid(z_np)
 
@@ -125,4 +134,89 @@ def test_air(dim_in=5, dim_h=3, dim_out=7, n_inference_steps=1,
 
     x = np.random.randint(0, 2, size=(n_samples, dim_in)).astype(floatX)
     print f(x)
-    assert False
\ No newline at end of file
+    assert False
+
+def test_block_sample(dim=13, n_samples=11):
+    Z = T.matrix('z', dtype=floatX)
+    W = T.matrix('W', dtype=floatX)
+    R = T.matrix('r', dtype=floatX)
+    z = np.random.normal(size=(n_samples, dim)).astype(floatX)
+    w = np.random.normal(size=(dim, dim)).astype(floatX)
+    r = np.random.uniform(size=(dim, n_samples)).astype(floatX)
+
+    # Reference: one dimension at a time.
+    x_ref = np.zeros((n_samples, dim), dtype=floatX)
+    z_ref = z.copy()
+    for i in xrange(dim):
+        x_ref[:, i] = r[i] <= sigmoid(z_ref[:, i])
+        z_ref += np.outer(x_ref[:, i], w[i])
+
+    for block_size in [1, 4, 5, dim, 16]:
+        x, p, updates = block_sample(Z, W, R, block_size)
+        f = theano.function([Z, W, R], x, updates=updates)
+        np.testing.assert_array_equal(f(z, w, r).T, x_ref)
+        np.testing.assert_array_equal(
+            block_sample_numpy(z, w, r, block_size, sigmoid), x_ref)
+
+def test_autoregressor_sample(dim=7, n_samples=5):
+    ar = AutoRegressor(dim)
+    ar.set_tparams()
+    x, updates = ar.sample(n_samples)
+    x = theano.function([], x, updates=updates)()
+    assert x.shape == (n_samples, dim)
+    assert ar.sample_numpy(n_samples).shape == (n_samples, dim)
+
+    darn = DARN(3, 4, dim, 1)
+    darn.set_tparams()
+    C = T.matrix('c', dtype=floatX)
+    x, updates = darn.sample(C, n_samples=n_samples)
+    x = theano.function([C], x, updates=updates)(
+        np.zeros((2, dim), dtype=floatX))
+    assert x.shape == (n_samples, 2, dim)
+
+def test_pack_tril(dim=6):
+    W = np.random.normal(size=(dim, dim)).astype(floatX)
+    w = pack_tril(W)
+    assert w.shape == (dim * (dim - 1) // 2,)
+
+    W_l = np.tril(W, k=-1)
+    np.testing.assert_array_equal(unpack_tril_numpy(w, dim), W_l)
+    w_t = T.vector('w', dtype=floatX)
+    np.testing.assert_array_equal(
+        theano.function([w_t], unpack_tril(w_t, dim))(w), W_l)
+
+    params = convert_checkpoint(dict(autoregressor_W=W, sbn_War=W,
+                                     autoregressor_b=W[0], other_W=W))
+    np.testing.assert_array_equal(params['autoregressor_W'], w)
+    np.testing.assert_array_equal(params['sbn_War'], w)
+    np.testing.assert_array_equal(params['autoregressor_b'], W[0])
+    np.testing.assert_array_equal(params['other_W'], W)
+    # Already packed parameters are left as is.
+    np.testing.assert_array_equal(
+        convert_checkpoint(params)['autoregressor_W'], w)
+
+def test_autoregressive_sample(dim=9, n_samples=7):
+    Z = T.matrix('z', dtype=floatX)
+    w_t = T.vector('w', dtype=floatX)
+    R = T.matrix('r', dtype=floatX)
+    z = np.random.normal(size=(n_samples, dim)).astype(floatX)
+    W = np.random.normal(size=(dim, dim)).astype(floatX)
+    w = pack_tril(W)
+    r = np.random.uniform(size=(dim, n_samples)).astype(floatX)
+
+    # Reference: the last dimension first, with the probabilities used by
+    # `neg_log_prob`.
+    W_l = np.tril(W, k=-1)
+    x_ref = np.zeros((n_samples, dim), dtype=floatX)
+    for i in xrange(dim - 1, -1, -1):
+        p_i = sigmoid(z[:, i] + np.dot(x_ref, W_l[:, i]))
+        x_ref[:, i] = r[i] <= p_i
+
+    for block_size in [None, 1, 4, 16]:
+        x, p, updates = autoregressive_sample(Z, w_t, R, dim,
+                                              block_size=block_size)
+        f = theano.function([Z, w_t, R], [x, p], updates=updates)
+        x_t, p_t = f(z, w, r)
+        np.testing.assert_array_equal(x_t.T, x_ref)
+        np.testing.assert_allclose(
+            p_t.T, sigmoid(z + np.dot(x_ref, W_l)), rtol=1e-5)
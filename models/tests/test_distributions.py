@@ -0,0 +1,101 @@
+'''
+Tests for distributions.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from models.distributions import (
+    Binomial,
+    Gaussian,
+    GaussianParams,
+    _cross_entropy
+)
+from models.mlp import MLP
+from utils import floatX
+from utils.binary import binary_samples
+
+
+def test_binomial_broadcast_neg_log_prob(n_samples=5, batch_size=7, dim=11):
+    prior = Binomial(dim)
+    prior.params['z'] = np.random.normal(size=(dim,)).astype(floatX)
+    prior.set_tparams()
+
+    R = T.tensor3('r', dtype=floatX)
+    Q = T.matrix('q', dtype=floatX)
+    H = binary_samples(R, Q[None, :, :])
+    assert H.dtype != floatX
+
+    # Logits over (batch, dim) and (dim,) against the elementwise kernel.
+    Hf = H.astype(floatX)
+    p = prior.get_prob(prior.z)
+    nlps = [prior.neg_log_prob(H, Q[None, :, :]),
+            prior.neg_log_prob(H),
+            prior.step_neg_log_prob(H, prior.z)]
+    nlps_ref = [_cross_entropy(Hf, Q[None, :, :]),
+                _cross_entropy(Hf, p[None, None, :]),
+                _cross_entropy(Hf, p[None, None, :])]
+    grads = [T.grad(nlps[0].sum(), Q), T.grad(nlps[1].sum(), prior.z)]
+    grads_ref = [T.grad(nlps_ref[0].sum(), Q),
+                 T.grad(nlps_ref[1].sum(), prior.z)]
+    f = theano.function([R, Q], nlps + grads)
+    f_ref = theano.function([R, Q], nlps_ref + grads_ref)
+
+    r = np.random.uniform(size=(n_samples, batch_size, dim)).astype(floatX)
+    q = np.random.uniform(0.01, 0.99, size=(batch_size, dim)).astype(floatX)
+    for v, v_ref in zip(f(r, q), f_ref(r, q)):
+        assert v.shape == v_ref.shape
+        np.testing.assert_allclose(v, v_ref, rtol=1e-4, atol=1e-4)
+
+    # No logs are taken over samples.
+    f = theano.function([R, Q], nlps[0])
+    for node in f.maker.fgraph.toposort():
+        if node.outputs[0].ndim == 3:
+            assert 'log' not in str(node.op).lower(), node.op
+
+def test_gaussian_params(n_samples=5, batch_size=7, dim_in=4, dim=11):
+    prior = Gaussian(dim)
+    prior.params['mu'] = np.random.normal(size=(dim,)).astype(floatX)
+    prior.params['log_sigma'] = np.random.normal(size=(dim,)).astype(floatX)
+    prior.set_tparams()
+
+    X = T.matrix('x', dtype=floatX)
+    E = T.tensor3('e', dtype=floatX)
+    Q = T.matrix('q', dtype=floatX)
+    q_s = GaussianParams(Q[:, :dim], Q[:, dim:])
+    assert prior.split_prob(q_s)[0] is q_s.mu
+
+    # Structured parameters against the concatenated tensor.
+    fs = []
+    for q in [q_s, Q]:
+        h = prior.step_sample(E, q[None, :, :])
+        fs.append(theano.function([E, Q], [
+            h,
+            prior.neg_log_prob(h),
+            prior.neg_log_prob(h, q[None, :, :]),
+            prior.kl_divergence(q),
+            prior.entropy(q),
+            prior.get_center(q)]))
+
+    e = np.random.normal(size=(n_samples, batch_size, dim)).astype(floatX)
+    q = np.random.normal(size=(batch_size, 2 * dim)).astype(floatX)
+    for v, v_ref in zip(fs[0](e, q), fs[1](e, q)):
+        np.testing.assert_allclose(v, v_ref, rtol=1e-5, atol=1e-5)
+
+    # The MLP output is split into views of the preactivation, not copied.
+    mlp = MLP(dim_in, dim, distribution='gaussian')
+    mlp.set_tparams()
+    x = np.random.normal(size=(batch_size, dim_in)).astype(floatX)
+    for X_, x_ in [(X, x), (T.tensor3('x3', dtype=floatX), x[None])]:
+        p = mlp.feed(X_)
+        assert isinstance(p, GaussianParams)
+        assert p.ndim == X_.ndim
+        f = theano.function([X_], list(p) + [mlp.preact(X_)])
+        mu, log_sigma, z = f(x_)
+        np.testing.assert_allclose(mu, z[..., :dim])
+        np.testing.assert_allclose(log_sigma, z[..., dim:])
+
+    f = theano.function([X], list(mlp.feed(X)))
+    for node in f.maker.fgraph.toposort():
+        assert not isinstance(node.op, (T.Join, T.IncSubtensor)), node.op
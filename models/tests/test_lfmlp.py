@@ -2,15 +2,69 @@
 Tests for Local filter MLP
 '''
 
+import itertools
 import numpy as np
 import theano
 from theano import tensor as T
 
-from models.mlp import LFMLP
+from models.mlp import (
+    LFMLP,
+    block_filter_idx,
+    local_filter_idx
+)
 from utils import floatX
 from utils.tools import print_profile
 
 
+softplus = lambda x: np.log(1.0 + np.exp(x))
+sigmoid = lambda x: 1.0 / (1.0 + np.exp(-x))
+
+
+def dense_local_weights(model, l):
+    '''
+    Dense (dim_in, dim_out) weights of the local layer `l`.
+    '''
+    W = model.params['W%d' % l]
+    n_filters = W.shape[0]
+    if model.filter_in:
+        dim_f = W.shape[2]
+        W_d = np.zeros((model.dim_local + 1, n_filters * dim_f))
+        for k, idx in enumerate(model.filter_idx):
+            W_d[idx, k * dim_f:(k + 1) * dim_f] = W[k]
+        return W_d[:-1]
+    else:
+        dim_f = W.shape[1]
+        W_d = np.zeros((n_filters * dim_f, model.dim_local + 1))
+        for k, idx in enumerate(model.filter_idx):
+            W_d[k * dim_f:(k + 1) * dim_f, idx] = W[k]
+        return W_d[:, :-1]
+
+def test_filter_idx(prototype_shape=(6, 7), shape=(3, 2), stride=2):
+    idx = block_filter_idx([2, 4, 1])
+    np.testing.assert_array_equal(idx, [[0, 1, 7, 7], [2, 3, 4, 5],
+                                        [6, 7, 7, 7]])
+
+    prototype = np.random.randint(0, 2, size=prototype_shape)
+    prototype[0, 0] = 1
+    dim = prototype.sum()
+    units = -np.ones(prototype.shape, dtype='int64')
+    units[prototype == 1] = np.arange(dim)
+
+    filters = []
+    for i in xrange(0, prototype_shape[0] - shape[0] + 1, stride):
+        for j in xrange(0, prototype_shape[1] - shape[1] + 1, stride):
+            f = [units[i + a, j + b]
+                 for a, b in itertools.product(*map(range, shape))]
+            f = [u for u in f if u >= 0]
+            if len(f) > 0:
+                filters.append(f)
+
+    idx = local_filter_idx(prototype, shape, stride=stride)
+    assert idx.shape == (len(filters), max(len(f) for f in filters))
+    for f, f_idx in zip(filters, idx):
+        assert list(f_idx[:len(f)]) == f
+        assert np.all(f_idx[len(f):] == dim)
+
 def test_build(dim_f=3, prototype_shape=(10, 10, 10), shape=(3, 4, 5), stride=2,
                batch_size=3):
     prototype = np.random.randint(0, 2, size=prototype_shape).astype(floatX)
@@ -42,6 +96,61 @@ def test_build(dim_f=3, prototype_shape=(10, 10, 10), shape=(3, 4, 5), stride=2,
     f = theano.function([X], outs.values())
 
     x = np.random.normal(size=(batch_size, 19)).astype(floatX)
-    f(x)
+    p = f(x)[outs.keys().index('p')]
+    assert p.shape == (batch_size, prototype.sum())
+
+    # Local weights are stored per filter.
+    n_filters, filter_size = model.filter_idx.shape
+    assert model.params['W0'].size == n_filters * filter_size * dim_f
 
-    assert False
\ No newline at end of file
+def test_parity(dim_f=2, dim_h=5, prototype_shape=(5, 6), shape=(3, 3),
+                stride=1, batch_size=7, n_samples=3):
+    prototype = np.random.randint(0, 2, size=prototype_shape).astype(floatX)
+    dim = int(prototype.sum())
+
+    X = T.matrix('X', dtype=floatX)
+    for filter_in in [True, False]:
+        if filter_in:
+            model = LFMLP(dim, dim_h, dim_f=dim_f, prototype=prototype,
+                          shape=shape, stride=stride, h_act='T.nnet.softplus')
+        else:
+            model = LFMLP(dim_h, dim, dim_f=dim_f, prototype=prototype,
+                          filter_in=False, shape=shape, stride=stride,
+                          h_act='T.nnet.softplus')
+        for k, v in model.params.iteritems():
+            model.params[k] = np.random.normal(size=v.shape).astype(floatX)
+        model.set_tparams()
+
+        x = np.random.normal(size=(batch_size, model.dim_in)).astype(floatX)
+        z = x
+        for l in xrange(model.n_layers):
+            if model.is_local(l):
+                W = dense_local_weights(model, l)
+            else:
+                W = model.params['W%d' % l]
+            z = np.dot(z, W) + model.params['b%d' % l]
+            if l < model.n_layers - 1:
+                z = softplus(z)
+        p = sigmoid(z) * 0.9999 + 0.000005
+
+        params = model.get_params()
+        P = model.feed(X)
+        f = theano.function([X], [P] + T.grad(P.sum(), wrt=params))
+        rvals = f(x)
+        np.testing.assert_allclose(rvals[0], p, rtol=1e-4, atol=1e-6)
+
+        # Gradients of padding weights are zero.
+        l = 0 if filter_in else model.n_layers - 1
+        grad = rvals[1 + 2 * l]
+        padding = model.filter_idx == dim
+        if filter_in:
+            assert np.all(grad[padding] == 0)
+        else:
+            assert np.all(grad.transpose(0, 2, 1)[padding] == 0)
+
+        X3 = T.tensor3('X3', dtype=floatX)
+        x3 = np.random.normal(
+            size=(n_samples, batch_size, model.dim_in)).astype(floatX)
+        p3 = theano.function([X3], model.feed(X3))(x3)
+        for s in xrange(n_samples):
+            np.testing.assert_allclose(p3[s], f(x3[s])[0], rtol=1e-4, atol=1e-6)
@@ -7,7 +7,10 @@ import numpy as np
 import theano
 from theano import tensor as T
 
-from models.mlp import MLP
+from models.mlp import (
+    MLP,
+    MultiModalMLP
+)
 from utils.tools import floatX
 
 
@@ -72,4 +75,108 @@ def test_feed_forward(mlp=None, X=T.matrix('X', dtype=floatX), x=None):
 
     assert np.allclose(y, y_test, atol=1e-6), (np.max(np.abs(y - y_test)))
 
-    return OrderedDict(y=y, preact=z, Y=Y, Preact=Z)
\ No newline at end of file
+    return OrderedDict(y=y, preact=z, Y=Y, Preact=Z)
+
+def test_feed_3d(dim_in=13, dim_h=17, dim_out=19, n_samples=5, batch_size=7):
+    mlp = MLP(dim_in, dim_out, dim_h=dim_h, n_layers=2,
+              h_act='T.nnet.softplus', distribution='binomial')
+    mlp.set_tparams()
+
+    X = T.tensor3('X', dtype=floatX)
+    X2 = T.matrix('X2', dtype=floatX)
+    outs = mlp(X)
+    f = theano.function([X], [outs['z'], outs['p'], outs[0]])
+    f2 = theano.function([X2], [mlp.preact(X2), mlp.feed(X2)])
+
+    x = np.random.randint(0, 2, size=(n_samples, batch_size, dim_in)).astype(floatX)
+    z, p, h = f(x)
+    assert z.shape == (n_samples, batch_size, dim_out)
+    assert h.shape == (n_samples, batch_size, dim_h)
+    for s in xrange(n_samples):
+        z_s, p_s = f2(x[s])
+        np.testing.assert_allclose(z[s], z_s, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(p[s], p_s, rtol=1e-5, atol=1e-6)
+
+    # Broadcastable leading dimensions are kept.
+    Y = mlp.feed(X2[None, :, :])
+    assert Y.broadcastable == (True, False, False)
+
+def test_multimodal(dim_in=13, batch_size=7, n_samples=3):
+    graph = dict(
+        layers=dict(h1=dict(dim=11, act='T.tanh'),
+                    h2=dict(dim=5, act='T.tanh'),
+                    h3=dict(dim=3, act='T.nnet.softplus')),
+        outs=dict(a=dict(dim=4, distribution='binomial'),
+                  b=dict(dim=6, distribution='gaussian'),
+                  c=dict(dim=2, distribution='binomial'),
+                  d=dict(dim=3, distribution='binomial')),
+        edges=[('i', 'h1'), ('i', 'h2'), ('h1', 'a'), ('h2', 'b'),
+               ('h1', 'c'), ('i', 'h3'), ('h3', 'd')])
+    mlp = MultiModalMLP(dim_in, graph)
+    mlp.set_tparams()
+
+    # One GEMM per distinct input, outputs first and hidden runs merged.
+    assert [step['input'] for step in mlp.plan] == ['i', 'h1', 'h2', 'h3']
+    assert mlp.plan[0]['runs'] == [(0, 16, 'T.tanh'), (16, 19, 'T.nnet.softplus')]
+    assert mlp.plan[1]['layers'].keys() == ['a', 'c']
+    assert mlp.dim_out == 4 + 12 + 2 + 3
+    assert [(r['start'], r['stop']) for r in mlp.out_runs] == [
+        (0, 4), (4, 16), (16, 21)]
+    assert mlp.out_runs[2]['start_x'] == 10
+
+    X = T.matrix('X', dtype=floatX)
+    X3 = T.tensor3('X3', dtype=floatX)
+    Y = T.matrix('Y', dtype=floatX)
+    p = mlp.feed(X)
+    f = theano.function([X, Y], [p, mlp.neg_log_prob(Y, p)])
+    f3 = theano.function([X3], mlp.feed(X3))
+
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+    y = np.random.randint(0, 2, size=(batch_size, 4 + 6 + 2 + 3)).astype(floatX)
+    y[:, 4:10] = np.random.normal(size=(batch_size, 6))
+
+    params = dict((k, v.get_value()) for k, v in zip(
+        mlp.params.keys(), mlp.get_params()))
+    def layer(x, o):
+        return np.dot(x, params['W_%s' % o]) + params['b_%s' % o]
+    h1 = np.tanh(layer(x, 'h1'))
+    h2 = np.tanh(layer(x, 'h2'))
+    h3 = eval(softplus)(layer(x, 'h3'))
+    binomial = lambda z: eval(sigmoid)(z) * 0.9999 + 0.000005
+    p_a = binomial(layer(h1, 'a'))
+    p_b = layer(h2, 'b')
+    p_c = binomial(layer(h1, 'c'))
+    p_d = binomial(layer(h3, 'd'))
+    p_np = np.concatenate([p_a, p_b, p_c, p_d], axis=1)
+
+    def cross_entropy(y, p):
+        return -(y * np.log(p) + (1 - y) * np.log(1 - p)).sum(axis=1)
+    mu, log_sigma = p_b[:, :6], np.maximum(p_b[:, 6:], -10)
+    nlp_np = (cross_entropy(y[:, :4], p_a)
+              + (0.5 * ((y[:, 4:10] - mu) ** 2 / np.exp(2 * log_sigma))
+                 + log_sigma + 0.5 * np.log(2 * np.pi)).sum(axis=1)
+              + cross_entropy(y[:, 10:12], p_c)
+              + cross_entropy(y[:, 12:], p_d))
+
+    p_t, nlp_t = f(x, y)
+    np.testing.assert_allclose(p_t, p_np, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(nlp_t, nlp_np, rtol=1e-4)
+
+    x3 = np.random.randint(0, 2, size=(n_samples, batch_size, dim_in)).astype(floatX)
+    p3 = f3(x3)
+    for s in xrange(n_samples):
+        np.testing.assert_allclose(p3[s], f(x3[s], y)[0], rtol=1e-5, atol=1e-6)
+
+def test_sparse_first_layer(dim_in=13, dim_h=17, dim_out=19, batch_size=7):
+    X = T.matrix('X', dtype='int8')
+    x = (np.random.uniform(size=(batch_size, dim_in)) < 0.1).astype('int8')
+
+    ps = []
+    for sparse_first_layer in [False, True]:
+        np.random.seed(0)
+        mlp = MLP(dim_in, dim_out, dim_h=dim_h, n_layers=2,
+                  sparse_first_layer=sparse_first_layer)
+        mlp.set_tparams()
+        ps.append(theano.function([X], mlp.feed(X))(x))
+
+    np.testing.assert_allclose(ps[0], ps[1], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,110 @@
+'''
+Tests for SBN
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from models.distributions import Binomial
+from models.sbn import SBN
+from utils import floatX
+
+
+def test_build_sbn(dim_in=11, dim_h=7):
+    model = SBN(dim_in, dim_h, prior=Binomial(dim_h))
+    model.set_tparams()
+    return model
+
+def fix_samples(model, r):
+    model.init_inference_samples = lambda size: theano.shared(r[:size[0]])
+
+def test_chunked_bound(batch_size=5, chunk_size=4, n_chunks=3):
+    model = test_build_sbn()
+    n_posterior_samples = chunk_size * n_chunks + 3
+    r = np.random.uniform(size=(chunk_size, batch_size, model.dim_h))
+    r = np.tile(r, (n_chunks + 1, 1, 1)).astype(floatX)
+    fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    results, _, updates = model(X, X, n_posterior_samples=n_posterior_samples)
+    results_c, _, updates_c = model(X, X, n_posterior_samples=n_posterior_samples,
+                                    chunk_size=chunk_size)
+    wrt = [model.conditional.W0, model.posterior.W0]
+    grads = [T.grad(results['cost'], wrt=model.conditional.W0)] + T.grad(
+        results['-log p(x)'], wrt=wrt)
+    grads_c = [T.grad(results_c['cost'], wrt=model.conditional.W0)] + T.grad(
+        results_c['-log p(x)'], wrt=wrt)
+
+    f = theano.function([X], results.values() + grads, updates=updates)
+    f_c = theano.function([X], results_c.values() + grads_c, updates=updates_c)
+
+    keys = results.keys() + ['grad', 'grad -log p(x) conditional',
+                             'grad -log p(x) posterior']
+    for k, v, v_c in zip(keys, f(x), f_c(x)):
+        assert np.allclose(v, v_c, atol=1e-5), (k, v, v_c)
+
+def test_precision_parity(batch_size=5, n_posterior_samples=13):
+    model = test_build_sbn()
+    r = np.random.uniform(
+        size=(n_posterior_samples, batch_size, model.dim_h)).astype(floatX)
+    fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    rvals = {}
+    for precision in ['float32', 'float16', 'bfloat16']:
+        model.precision = precision
+        results, samples, updates = model(
+            X, X, n_posterior_samples=n_posterior_samples)
+        grad = T.grad(results['cost'], wrt=model.conditional.W0)
+        f = theano.function([X], [results['lower_bound'], results['-log p(x)'],
+                                  grad, samples['py']], updates=updates)
+        rvals[precision] = f(x)
+
+    lb, nll, grad, py = rvals['float32']
+    for precision, atol in [('float16', 1e-2), ('bfloat16', 1e-1)]:
+        lb_r, nll_r, grad_r, py_r = rvals[precision]
+        assert py_r.dtype == floatX
+        assert np.allclose(py, py_r, atol=atol), precision
+        assert np.allclose(lb, lb_r, atol=atol), (precision, lb, lb_r)
+        assert np.allclose(nll, nll_r, atol=atol), (precision, nll, nll_r)
+        assert np.allclose(grad, grad_r, atol=atol), precision
+
+def test_dedup_bound(batch_size=5, n_posterior_samples=40, chunk_size=16):
+    model = test_build_sbn()
+    # A saturated posterior: samples repeat within each example.
+    model.posterior.params['b0'] = np.random.choice(
+        [-4., 4.], size=(model.dim_h,)).astype(floatX)
+    model.set_tparams()
+    r = np.random.uniform(
+        size=(n_posterior_samples, batch_size, model.dim_h)).astype(floatX)
+    fix_samples(model, r)
+
+    X = T.matrix('x', dtype=floatX)
+    x = np.random.randint(0, 2, size=(batch_size, model.dim_in)).astype(floatX)
+
+    for chunk_size_ in [None, chunk_size]:
+        rvals = []
+        for dedup in [False, True]:
+            results, _, updates = model(
+                X, X, n_posterior_samples=n_posterior_samples,
+                chunk_size=chunk_size_, dedup=dedup)
+            grad = T.grad(results['cost'], wrt=model.conditional.W0)
+            f = theano.function([X], results.values() + [grad],
+                                updates=updates)
+            rvals.append(f(x))
+
+        for k, v, v_d in zip(results.keys() + ['grad'], *rvals):
+            assert np.allclose(v, v_d, atol=1e-5), (chunk_size_, k, v, v_d)
+
+    # The conditional's GEMM runs in float16.
+    model.precision = 'float16'
+    H = T.tensor3('h', dtype='int8')
+    py = model.conditional_feed(H, *model.conditional.get_params())
+    assert any(v.owner is not None and isinstance(v.owner.op, T.basic.Dot)
+               and v.dtype == 'float16'
+               for v in theano.gof.graph.ancestors([py]))
@@ -0,0 +1,239 @@
+'''
+Compact binary samples and their products with weight matrices.
+
+Binary latent samples are kept as `int8` instead of floatX. Their product
+with the first weight matrix of a layer is a cast and a GEMM by default, or
+on request (`sparse=True`) sums the rows of the weight matrix for the active
+units when few units are on. Samples of a saturated
+posterior mostly repeat, and `unique_samples` finds the distinct ones.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+
+binary_dtype = 'int8'
+binary_dtypes = ['bool', 'int8', 'uint8']
+
+
+def binary_samples(r, p):
+    '''
+    Samples with `r <= p` as `int8` 0/1 values.
+    '''
+    return (r <= p).astype(binary_dtype)
+
+
+class BinaryDot(theano.Op):
+    '''
+    h.dot(W) for 0/1 `h` (2 or 3 dimensions) of an integer dtype.
+
+    When the fraction of active units is at most `max_density`, sums the rows
+    of `W` for the active units of each row of `h`. Otherwise casts `h` and
+    uses a dense product. This only pays off for very sparse samples (about
+    2% of units on for 200 units), so it is not the default of `dot`.
+    '''
+    __props__ = ('max_density',)
+
+    def __init__(self, max_density=0.02):
+        self.max_density = max_density
+
+    def make_node(self, h, W):
+        h = T.as_tensor_variable(h)
+        W = T.as_tensor_variable(W)
+        if h.dtype not in binary_dtypes:
+            raise TypeError('Expected binary samples, got %s' % h.dtype)
+        if h.ndim not in [2, 3] or W.ndim != 2:
+            raise TypeError('Expected 2 or 3d samples and a matrix, got %d and '
+                            '%d dimensions' % (h.ndim, W.ndim))
+        out = T.TensorType(W.dtype, h.broadcastable[:-1] + (False,))()
+        return theano.Apply(self, [h, W], [out])
+
+    def perform(self, node, inputs, output_storage):
+        h, W = inputs
+        h2 = h.reshape((-1, h.shape[-1]))
+
+        rows, cols = np.nonzero(h2)
+        if rows.shape[0] <= self.max_density * h2.size:
+            z = np.zeros((h2.shape[0], W.shape[1]), dtype=W.dtype)
+            if rows.shape[0] > 0:
+                # `nonzero` is row-major, so each row's units are contiguous.
+                active, starts = np.unique(rows, return_index=True)
+                z[active] = np.add.reduceat(W[cols], starts, axis=0)
+        else:
+            z = np.dot(h2.astype(W.dtype), W)
+
+        output_storage[0][0] = z.reshape(h.shape[:-1] + (W.shape[1],))
+
+    def infer_shape(self, node, shapes):
+        h_shape, W_shape = shapes
+        return [tuple(h_shape[:-1]) + (W_shape[1],)]
+
+    def grad(self, inputs, output_grads):
+        h, W = inputs
+        gz, = output_grads
+        h2 = h.reshape((-1, h.shape[h.ndim-1])).astype(W.dtype)
+        gz2 = gz.reshape((-1, gz.shape[gz.ndim-1]))
+        return [theano.gradient.DisconnectedType()(), T.dot(h2.T, gz2)]
+
+    def connection_pattern(self, node):
+        return [[False], [True]]
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        h, W = inputs
+        z, = outputs
+        max_density = self.max_density
+        fail = sub['fail']
+        return '''
+        int nd = PyArray_NDIM(%(h)s);
+        npy_intp D = PyArray_DIMS(%(h)s)[nd - 1];
+        npy_intp K = PyArray_DIMS(%(W)s)[1];
+        npy_intp N = 1;
+        npy_intp dims[3];
+        npy_intp n, d, k, nnz = 0;
+        PyArrayObject* hc;
+        PyArrayObject* Wc;
+        dtype_%(h)s* hp;
+        dtype_%(W)s* Wp;
+        dtype_%(z)s* zp;
+        int i;
+
+        if (PyArray_DIMS(%(W)s)[0] != D) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Samples and weights have different dimensions");
+            %(fail)s
+        }
+        for (i = 0; i < nd - 1; i++) {
+            dims[i] = PyArray_DIMS(%(h)s)[i];
+            N *= dims[i];
+        }
+        dims[nd - 1] = K;
+
+        hc = PyArray_GETCONTIGUOUS(%(h)s);
+        Wc = PyArray_GETCONTIGUOUS(%(W)s);
+        if (!hc || !Wc) {
+            Py_XDECREF(hc);
+            Py_XDECREF(Wc);
+            %(fail)s
+        }
+        hp = (dtype_%(h)s*)PyArray_DATA(hc);
+        Wp = (dtype_%(W)s*)PyArray_DATA(Wc);
+        for (n = 0; n < N * D; n++) {
+            nnz += (hp[n] != 0);
+        }
+
+        Py_XDECREF(%(z)s);
+        if (nnz > %(max_density)s * N * D) {
+            npy_intp dims2[2] = {N, D};
+            PyArray_Dims shape2 = {dims2, 2};
+            PyArray_Dims shape = {dims, nd};
+            PyObject* hf = PyArray_Cast(hc, PyArray_TYPE(Wc));
+            PyObject* hf2 = NULL;
+            PyObject* z2 = NULL;
+            if (hf) {
+                hf2 = PyArray_Newshape((PyArrayObject*)hf, &shape2, NPY_CORDER);
+            }
+            if (hf2) {
+                z2 = PyArray_MatrixProduct2(hf2, (PyObject*)Wc, NULL);
+            }
+            %(z)s = z2 ? (PyArrayObject*)PyArray_Newshape(
+                (PyArrayObject*)z2, &shape, NPY_CORDER) : NULL;
+            Py_XDECREF(hf);
+            Py_XDECREF(hf2);
+            Py_XDECREF(z2);
+        } else {
+            %(z)s = (PyArrayObject*)PyArray_ZEROS(
+                nd, dims, PyArray_TYPE(Wc), 0);
+            if (%(z)s) {
+                zp = (dtype_%(z)s*)PyArray_DATA(%(z)s);
+                for (n = 0; n < N; n++) {
+                    for (d = 0; d < D; d++) {
+                        dtype_%(W)s* row = Wp + d * K;
+                        dtype_%(z)s* z_n = zp + n * K;
+                        if (hp[n * D + d] == 0) {
+                            continue;
+                        }
+                        for (k = 0; k < K; k++) {
+                            z_n[k] += row[k];
+                        }
+                    }
+                }
+            }
+        }
+        Py_DECREF(hc);
+        Py_DECREF(Wc);
+        if (!%(z)s) {
+            %(fail)s
+        }
+        ''' % locals()
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+def dot(x, W, sparse=False):
+    '''
+    T.dot for float or binary `x`.
+
+    Binary `x` is cast to the dtype of `W` for a GEMM, or with `sparse` goes
+    through `BinaryDot`.
+    '''
+    if x.dtype in binary_dtypes:
+        if sparse:
+            return BinaryDot()(x, W)
+        return T.dot(x.astype(W.dtype), W)
+    return T.dot(x, W)
+
+
+class UniqueSamples(theano.Op):
+    '''
+    Distinct samples of each example in (n_samples, batch, dim) binary `h`.
+
+    Rows of `h` are packed to bits and keyed with their example, and the
+    keys are made unique. Returns the distinct rows (n_unique, dim), the
+    example of each (n_unique,), and for every sample the index of its row
+    (n_samples, batch), so that `h[s, b] == h_u[inverse[s, b]]`.
+    '''
+    __props__ = ()
+
+    def make_node(self, h):
+        h = T.as_tensor_variable(h)
+        if h.dtype not in binary_dtypes:
+            raise TypeError('Expected binary samples, got %s' % h.dtype)
+        if h.ndim != 3:
+            raise TypeError('Expected (n_samples, batch, dim) samples, got %d '
+                            'dimensions' % h.ndim)
+        h_u = T.TensorType(h.dtype, (False, False))()
+        return theano.Apply(self, [h], [h_u, T.lvector(), T.lmatrix()])
+
+    def perform(self, node, inputs, output_storage):
+        h, = inputs
+        n_samples, batch_size, dim = h.shape
+        h = h.transpose(1, 0, 2).reshape((batch_size * n_samples, dim))
+        example = np.repeat(np.arange(batch_size), n_samples)
+
+        keys = np.concatenate(
+            [example.astype('>i8').view(np.uint8).reshape((-1, 8)),
+             np.packbits(h != 0, axis=1)], axis=1)
+        keys = np.ascontiguousarray(keys).view(
+            np.dtype((np.void, keys.shape[1]))).ravel()
+        _, index, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+
+        output_storage[0][0] = h[index]
+        output_storage[1][0] = example[index].astype('int64')
+        output_storage[2][0] = np.ascontiguousarray(
+            inverse.reshape((batch_size, n_samples)).T).astype('int64')
+
+    def grad(self, inputs, output_grads):
+        return [theano.gradient.DisconnectedType()()]
+
+    def connection_pattern(self, node):
+        return [[False, False, False]]
+
+
+def unique_samples(h):
+    '''
+    Distinct samples per example of binary `h` (see `UniqueSamples`).
+    '''
+    return UniqueSamples()(h)
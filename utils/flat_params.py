@@ -0,0 +1,105 @@
+'''
+Learnable parameters packed into one contiguous shared vector.
+
+Each parameter becomes a view (a reshaped slice) of the buffer, and the
+views replace the shared variables set by `set_tparams` on the model and its
+sublayers. Optimizers then see a single parameter and gradient, so their
+state is one vector per statistic and each update is a few vectorized ops.
+'''
+
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano import tensor as T
+
+from models import Layer
+from utils import floatX
+
+
+def _layers(model, _seen=None):
+    '''
+    `model` and its sublayers, including those held in lists.
+    '''
+    if _seen is None:
+        _seen = set()
+    _seen.add(id(model))
+
+    layers = [model]
+    for v in model.__dict__.values():
+        vs = v if isinstance(v, (list, tuple)) else [v]
+        for u in vs:
+            if isinstance(u, Layer) and id(u) not in _seen:
+                layers += _layers(u, _seen=_seen)
+    return layers
+
+
+class FlatParams(object):
+    '''
+    One shared vector holding all of `tparams`.
+
+    Attributes:
+        buffer: theano.shared. Flat vector of parameter values.
+        views: OrderedDict. Reshaped slices of `buffer`, with the keys and
+            names of `tparams`.
+        shapes: list of tuple. Parameter shapes.
+        offsets: np.array. Start of each parameter in `buffer`, followed by
+            its size.
+    '''
+    def __init__(self, model, tparams, name='params'):
+        values = [v.get_value() for v in tparams.values()]
+        for k, v in zip(tparams.keys(), values):
+            if v.dtype.kind != 'f':
+                raise ValueError('Cannot pack %s of dtype %s' % (k, v.dtype))
+
+        self.keys = tparams.keys()
+        self.shapes = [v.shape for v in values]
+        self.offsets = np.cumsum([0] + [v.size for v in values])
+        self.buffer = theano.shared(
+            np.concatenate([v.flatten() for v in values]).astype(floatX),
+            name=name)
+
+        self.views = OrderedDict()
+        self._set_views(model, tparams)
+
+    def _set_views(self, model, params):
+        '''
+        Makes views of the buffer and puts them in place of `params` on
+        `model` and its sublayers.
+        '''
+        views = OrderedDict()
+        replacements = dict()
+        for i, (k, tp) in enumerate(params.iteritems()):
+            view = self.buffer[self.offsets[i]:self.offsets[i+1]].reshape(
+                self.shapes[i], ndim=len(self.shapes[i]))
+            view.name = tp.name
+            views[k] = view
+            replacements[id(tp)] = view
+        self.views = views
+
+        for layer in _layers(model):
+            for k, v in layer.__dict__.items():
+                if id(v) in replacements:
+                    layer.__dict__[k] = replacements[id(v)]
+
+    def rebind(self, model, buffer):
+        '''
+        Switches to `buffer` (e.g. loaded with cached functions), and points
+        `model` at views of it.
+        '''
+        self.buffer = buffer
+        self._set_views(model, self.views)
+
+    def flatten(self, xs):
+        '''
+        Concatenates per-parameter tensors (e.g., gradients) into one vector.
+        '''
+        return T.concatenate([x.flatten() for x in xs])
+
+    def get_values(self):
+        '''
+        Parameter values as views of a single copy of the buffer.
+        '''
+        buffer = self.buffer.get_value()
+        return OrderedDict(
+            (k, buffer[self.offsets[i]:self.offsets[i+1]].reshape(shape))
+            for i, (k, shape) in enumerate(zip(self.keys, self.shapes)))
@@ -0,0 +1,155 @@
+'''
+Persistent on-disk cache of compiled Theano functions.
+
+Compiled functions are pickled together with the shared variables they
+depend on, keyed by a hash of the configuration that determined the graph.
+Unpickled functions own copies of those shared variables, so on a cache hit
+the current values (e.g., freshly initialized or loaded parameters) are
+copied into the copies. Callers must use the returned copies, and a model
+passed to `cached_functions` is pointed at them (see `rebind`).
+'''
+
+import cPickle
+import hashlib
+import os
+from os import path
+import pprint
+import sys
+import theano
+
+from models import Layer
+from utils import floatX
+from utils.flat_params import _layers
+
+
+# `irvi` holds the scripts whose builders are passed to `cached_functions`.
+_source_dirs = ['inference', 'irvi', 'models', 'utils']
+
+def _source_hash():
+    '''
+    Hash of the graph-building code, so edits invalidate the cache.
+    '''
+    root = path.abspath(path.join(path.dirname(path.realpath(__file__)), '..'))
+    h = hashlib.sha1()
+    for d in _source_dirs:
+        for f in sorted(os.listdir(path.join(root, d))):
+            if f.endswith('.py'):
+                with open(path.join(root, d, f), 'rb') as fp:
+                    h.update(fp.read())
+    return h.hexdigest()
+
+def model_signature(model, _seen=None):
+    '''
+    Picklable description of a model and its sublayers.
+
+    Covers class names, simple attributes (dimensions, activations, etc.) and
+    parameter shapes, but not parameter values.
+    '''
+    if _seen is None:
+        _seen = set()
+    _seen.add(id(model))
+
+    signature = dict(type=model.__class__.__name__)
+    for k, v in model.__dict__.iteritems():
+        if isinstance(v, Layer):
+            if id(v) not in _seen:
+                signature[k] = model_signature(v, _seen=_seen)
+        elif isinstance(v, (str, int, long, float, bool, type(None))):
+            signature[k] = v
+        elif (isinstance(v, (list, tuple))
+              and all(isinstance(u, (int, long)) for u in v)):
+            signature[k] = list(v)
+
+    params = getattr(model, 'params', None) or dict()
+    signature['params'] = dict((k, getattr(v, 'shape', None))
+                               for k, v in params.iteritems())
+    return signature
+
+def get_key(**config):
+    '''
+    Hash of `config` together with floatX, Theano version and source code.
+    '''
+    config = dict(config, floatX=floatX, theano_version=theano.__version__,
+                  source=_source_hash())
+    return hashlib.sha1(pprint.pformat(config)).hexdigest()
+
+def load(cache_dir, key, shared):
+    '''
+    Loads functions under `key` and binds them to the values in `shared`.
+
+    Returns (functions, shared) where `shared` holds the shared variables used
+    by the loaded functions, or None on a cache miss.
+    '''
+    cache_file = path.join(cache_dir, key + '.pkl')
+    if not path.isfile(cache_file):
+        print 'No compiled functions found at %s' % cache_file
+        return None
+
+    print 'Loading compiled functions from %s' % cache_file
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    try:
+        with open(cache_file, 'rb') as f:
+            d = cPickle.load(f)
+    except Exception as e:
+        print 'Failed to load %s (%s), recompiling' % (cache_file, e)
+        return None
+
+    if set(d['shared'].keys()) != set(shared.keys()):
+        print 'Cached shared variables do not match the model, recompiling'
+        return None
+
+    for k, v in shared.iteritems():
+        d['shared'][k].set_value(v.get_value())
+
+    return d['functions'], d['shared']
+
+def save(cache_dir, key, functions, shared):
+    '''
+    Pickles `functions` together with the `shared` variables they use.
+    '''
+    if not path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_file = path.join(cache_dir, key + '.pkl')
+    print 'Saving compiled functions to %s' % cache_file
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        cPickle.dump(dict(functions=functions, shared=shared), f,
+                     protocol=cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_file, cache_file)
+
+def rebind(model, old, new):
+    '''
+    Points `model` and its sublayers at the shared variables in `new` where
+    they hold those in `old` with the same keys.
+    '''
+    replacements = dict((id(v), new[k]) for k, v in old.iteritems()
+                        if k in new)
+    for layer in _layers(model):
+        for k, v in layer.__dict__.items():
+            if id(v) in replacements:
+                layer.__dict__[k] = replacements[id(v)]
+
+def cached_functions(cache_dir, key, shared, f_build, model=None):
+    '''
+    Returns (functions, shared) from the cache, or from `f_build` if missing.
+
+    `f_build` takes no arguments and returns a dictionary of compiled
+    functions (and any picklable metadata, such as output keys). On a cache
+    hit, `model` (if given) is rebound to the loaded shared variables, so
+    graphs built from it later see the trained values.
+    '''
+    if cache_dir is not None:
+        rval = load(cache_dir, key, shared)
+        if rval is not None:
+            if model is not None:
+                rebind(model, shared, rval[1])
+            return rval
+
+    functions = f_build()
+
+    if cache_dir is not None:
+        save(cache_dir, key, functions, shared)
+
+    return functions, shared
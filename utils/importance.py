@@ -0,0 +1,263 @@
+'''
+Fused ops over importance weights.
+
+The inference methods turn (n_samples, batch) log weights into a
+log-normalizer and normalized weights, then average samples with the
+weights. As Theano graphs these are several elementwise and reduction passes
+with their own temporaries. Here each is one op with a C implementation.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+from theano.gradient import DisconnectedType
+
+from utils.binary import binary_dtypes
+from utils.precision import upcast
+
+
+class NormalizedWeights(theano.Op):
+    '''
+    Log-normalizer and normalized weights of (n_samples, batch) log weights.
+
+    Returns log_z = log(sum(exp(log_w), axis=0)) and
+    w_tilde = exp(log_w - log_z). Sums accumulate in double precision.
+    '''
+    __props__ = ()
+
+    def make_node(self, log_w):
+        log_w = T.as_tensor_variable(log_w)
+        if log_w.ndim != 2:
+            raise TypeError('Expected (n_samples, batch) log weights, got %d '
+                            'dimensions' % log_w.ndim)
+        if log_w.dtype not in ['float32', 'float64']:
+            raise TypeError('Expected float32 or float64 log weights, got %s'
+                            % log_w.dtype)
+        log_z = T.TensorType(log_w.dtype, log_w.broadcastable[1:])()
+        w_tilde = log_w.type()
+        return theano.Apply(self, [log_w], [log_z, w_tilde])
+
+    def perform(self, node, inputs, output_storage):
+        log_w, = inputs
+        log_w_max = log_w.max(axis=0)
+        w = np.exp(log_w.astype('float64') - log_w_max)
+        w_sum = w.sum(axis=0)
+        output_storage[0][0] = (log_w_max + np.log(w_sum)).astype(log_w.dtype)
+        output_storage[1][0] = (w / w_sum).astype(log_w.dtype)
+
+    def infer_shape(self, node, shapes):
+        shape, = shapes
+        return [tuple(shape[1:]), tuple(shape)]
+
+    def grad(self, inputs, output_grads):
+        log_w, = inputs
+        g_z, g_w = output_grads
+        _, w_tilde = self(log_w)
+
+        grad = T.zeros_like(log_w)
+        if not isinstance(g_z.type, DisconnectedType):
+            grad += w_tilde * g_z[None, :]
+        if not isinstance(g_w.type, DisconnectedType):
+            grad += w_tilde * (g_w - (w_tilde * g_w).sum(axis=0, keepdims=True))
+        return [grad]
+
+    def c_headers(self):
+        return ['<math.h>']
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        log_w, = inputs
+        log_z, w_tilde = outputs
+        fail = sub['fail']
+        return '''
+        npy_intp S = PyArray_DIMS(%(log_w)s)[0];
+        npy_intp B = PyArray_DIMS(%(log_w)s)[1];
+        npy_intp xs0 = PyArray_STRIDES(%(log_w)s)[0] / sizeof(dtype_%(log_w)s);
+        npy_intp xs1 = PyArray_STRIDES(%(log_w)s)[1] / sizeof(dtype_%(log_w)s);
+        npy_intp dims[2] = {S, B};
+        npy_intp s, b;
+        dtype_%(log_w)s* x = (dtype_%(log_w)s*)PyArray_DATA(%(log_w)s);
+        dtype_%(log_z)s* z;
+        dtype_%(w_tilde)s* w;
+        double* w_sum;
+
+        if (%(log_z)s == NULL || PyArray_DIMS(%(log_z)s)[0] != B
+            || !PyArray_IS_C_CONTIGUOUS(%(log_z)s)) {
+            Py_XDECREF(%(log_z)s);
+            %(log_z)s = (PyArrayObject*)PyArray_EMPTY(
+                1, dims + 1, PyArray_TYPE(%(log_w)s), 0);
+            if (!%(log_z)s) {
+                %(fail)s
+            }
+        }
+        if (%(w_tilde)s == NULL || PyArray_DIMS(%(w_tilde)s)[0] != S
+            || PyArray_DIMS(%(w_tilde)s)[1] != B
+            || !PyArray_IS_C_CONTIGUOUS(%(w_tilde)s)) {
+            Py_XDECREF(%(w_tilde)s);
+            %(w_tilde)s = (PyArrayObject*)PyArray_EMPTY(
+                2, dims, PyArray_TYPE(%(log_w)s), 0);
+            if (!%(w_tilde)s) {
+                %(fail)s
+            }
+        }
+        z = (dtype_%(log_z)s*)PyArray_DATA(%(log_z)s);
+        w = (dtype_%(w_tilde)s*)PyArray_DATA(%(w_tilde)s);
+
+        w_sum = (double*)malloc((B + 1) * sizeof(double));
+        if (!w_sum) {
+            PyErr_NoMemory();
+            %(fail)s
+        }
+
+        for (b = 0; b < B; b++) {
+            z[b] = -NPY_INFINITY;
+            w_sum[b] = 0.;
+        }
+        for (s = 0; s < S; s++) {
+            for (b = 0; b < B; b++) {
+                if (x[s * xs0 + b * xs1] > z[b]) {
+                    z[b] = x[s * xs0 + b * xs1];
+                }
+            }
+        }
+        for (s = 0; s < S; s++) {
+            for (b = 0; b < B; b++) {
+                double e = exp((double)x[s * xs0 + b * xs1] - (double)z[b]);
+                w[s * B + b] = e;
+                w_sum[b] += e;
+            }
+        }
+        for (s = 0; s < S; s++) {
+            for (b = 0; b < B; b++) {
+                w[s * B + b] /= w_sum[b];
+            }
+        }
+        for (b = 0; b < B; b++) {
+            z[b] += log(w_sum[b]);
+        }
+        free(w_sum);
+        ''' % locals()
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+class WeightedSum(theano.Op):
+    '''
+    sum(w[:, :, None] * h, axis=0) for (n_samples, batch) weights `w` and
+    (n_samples, batch, dim) samples `h`.
+
+    `h` may be binary (see `utils.binary`), in which case it is read without
+    a cast and gets no gradient.
+    '''
+    __props__ = ()
+
+    def make_node(self, w, h):
+        w = T.as_tensor_variable(w)
+        h = T.as_tensor_variable(h)
+        if w.ndim != 2 or h.ndim != 3:
+            raise TypeError('Expected 2d weights and 3d samples, got %d and %d '
+                            'dimensions' % (w.ndim, h.ndim))
+        if w.dtype not in ['float32', 'float64']:
+            raise TypeError('Expected float32 or float64 weights, got %s'
+                            % w.dtype)
+        out = T.TensorType(w.dtype, h.broadcastable[1:])()
+        return theano.Apply(self, [w, h], [out])
+
+    def perform(self, node, inputs, output_storage):
+        w, h = inputs
+        output_storage[0][0] = np.einsum(
+            'sb,sbd->bd', w, h.astype(w.dtype)).astype(w.dtype)
+
+    def infer_shape(self, node, shapes):
+        _, h_shape = shapes
+        return [tuple(h_shape[1:])]
+
+    def connection_pattern(self, node):
+        return [[True], [node.inputs[1].dtype not in binary_dtypes]]
+
+    def grad(self, inputs, output_grads):
+        w, h = inputs
+        g, = output_grads
+        grad_w = (h.astype(w.dtype) * g[None, :, :]).sum(axis=2)
+        if h.dtype in binary_dtypes:
+            grad_h = DisconnectedType()()
+        else:
+            grad_h = w[:, :, None] * g[None, :, :]
+        return [grad_w, grad_h]
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        w, h = inputs
+        out, = outputs
+        fail = sub['fail']
+        return '''
+        npy_intp S = PyArray_DIMS(%(h)s)[0];
+        npy_intp B = PyArray_DIMS(%(h)s)[1];
+        npy_intp D = PyArray_DIMS(%(h)s)[2];
+        npy_intp ws0 = PyArray_STRIDES(%(w)s)[0] / sizeof(dtype_%(w)s);
+        npy_intp ws1 = PyArray_STRIDES(%(w)s)[1] / sizeof(dtype_%(w)s);
+        npy_intp hs0 = PyArray_STRIDES(%(h)s)[0] / sizeof(dtype_%(h)s);
+        npy_intp hs1 = PyArray_STRIDES(%(h)s)[1] / sizeof(dtype_%(h)s);
+        npy_intp hs2 = PyArray_STRIDES(%(h)s)[2] / sizeof(dtype_%(h)s);
+        npy_intp dims[2] = {B, D};
+        npy_intp s, b, d;
+        dtype_%(w)s* wp = (dtype_%(w)s*)PyArray_DATA(%(w)s);
+        dtype_%(h)s* hp = (dtype_%(h)s*)PyArray_DATA(%(h)s);
+        dtype_%(out)s* o;
+
+        if (PyArray_DIMS(%(w)s)[0] != S || PyArray_DIMS(%(w)s)[1] != B) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Weights and samples have different shapes");
+            %(fail)s
+        }
+        if (%(out)s == NULL || PyArray_DIMS(%(out)s)[0] != B
+            || PyArray_DIMS(%(out)s)[1] != D
+            || !PyArray_IS_C_CONTIGUOUS(%(out)s)) {
+            Py_XDECREF(%(out)s);
+            %(out)s = (PyArrayObject*)PyArray_EMPTY(
+                2, dims, PyArray_TYPE(%(w)s), 0);
+            if (!%(out)s) {
+                %(fail)s
+            }
+        }
+        o = (dtype_%(out)s*)PyArray_DATA(%(out)s);
+
+        for (b = 0; b < B * D; b++) {
+            o[b] = 0;
+        }
+        for (s = 0; s < S; s++) {
+            for (b = 0; b < B; b++) {
+                dtype_%(w)s wt = wp[s * ws0 + b * ws1];
+                dtype_%(h)s* row = hp + s * hs0 + b * hs1;
+                dtype_%(out)s* o_b = o + b * D;
+                if (wt == 0) {
+                    continue;
+                }
+                for (d = 0; d < D; d++) {
+                    o_b[d] += wt * row[d * hs2];
+                }
+            }
+        }
+        ''' % locals()
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+def normalized_weights(log_w):
+    '''
+    Log-normalizer and normalized weights over the first (sample) axis.
+
+    float16 log weights are upcast first, as in `log_sum_exp`.
+
+    Returns:
+        T.tensor: (batch,) log(sum(exp(log_w), axis=0)).
+        T.tensor: (n_samples, batch) exp(log_w - log_z).
+
+    '''
+    return NormalizedWeights()(upcast(log_w))
+
+def weighted_sum(w, h):
+    '''
+    sum(w[:, :, None] * h, axis=0), e.g. the AIR update from samples `h`.
+    '''
+    return WeightedSum()(w, h)
@@ -0,0 +1,59 @@
+'''
+Memory-mapped per-example store of refined posteriors.
+'''
+
+import numpy as np
+from os import path
+
+
+class PosteriorCache(object):
+    '''
+    Stores the last refined posterior parameters of each example on disk.
+
+    The store is a (n_examples, dim) `.npy` file opened as a memory map, so
+    it need not fit in memory and persists across runs. Rows that have not
+    been written yet are NaN. An existing store only belongs to the model
+    that wrote it, so pass `reset` unless that model is being resumed.
+
+    Attributes:
+        cache_file: str. Path of the `.npy` file.
+        q: np.memmap. (n_examples, dim) posterior parameters.
+    '''
+    def __init__(self, cache_file, n_examples, dim, dtype='float16',
+                 reset=False):
+        shape = (n_examples, dim)
+        self.cache_file = cache_file
+
+        if path.isfile(cache_file) and not reset:
+            q = np.lib.format.open_memmap(cache_file, mode='r+')
+            if q.shape != shape or q.dtype != np.dtype(dtype):
+                raise ValueError('Posterior cache %s has shape %s (%s), '
+                                 'expected %s (%s)'
+                                 % (cache_file, q.shape, q.dtype, shape, dtype))
+            print 'Loaded posterior cache from %s' % cache_file
+        else:
+            if path.isfile(cache_file):
+                print 'Resetting posterior cache at %s' % cache_file
+            else:
+                print 'Creating posterior cache at %s' % cache_file
+            q = np.lib.format.open_memmap(
+                cache_file, mode='w+', dtype=dtype, shape=shape)
+            q[:] = np.nan
+            q.flush()
+
+        self.q = q
+
+    def get(self, idx, dtype='float32'):
+        '''
+        Rows for examples `idx`, NaN where not yet filled.
+        '''
+        return self.q[idx].astype(dtype)
+
+    def set(self, idx, q):
+        self.q[idx] = q
+
+    def n_filled(self):
+        return int((~np.isnan(self.q[:, 0])).sum())
+
+    def flush(self):
+        self.q.flush()
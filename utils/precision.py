@@ -0,0 +1,73 @@
+'''
+Reduced precision storage of sample tensors and activations.
+
+With `float16`, the uniform noise of posterior samples and the conditional
+network, i.e. the large (n_samples, batch, dim) tensors of the bounds and of
+AIR and RWS, are kept as float16. Log probabilities and log-sum-exps
+accumulate in float32. The posterior has one activation per example, not
+per sample, and stays at floatX.
+
+`bfloat16` is emulated for accuracy checks only: tensors stay floatX but are
+rounded to the 8 significant bits of bfloat16, so it saves no memory.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from utils import floatX
+from utils.binary import binary_dtypes
+
+
+precisions = ['float32', 'float16', 'bfloat16']
+accumulate_dtype = 'float32'
+
+
+def check_precision(precision):
+    if precision not in precisions:
+        raise ValueError('Precision must be one of %s, got %s'
+                         % (precisions, precision))
+
+def storage_dtype(precision):
+    '''
+    Dtype of reduced precision tensors.
+    '''
+    check_precision(precision)
+    if precision == 'float16':
+        return 'float16'
+    return floatX
+
+def upcast(x):
+    '''
+    Casts float16 `x` to the accumulation dtype.
+    '''
+    if x.dtype == 'float16':
+        return x.astype(accumulate_dtype)
+    return x
+
+def round_bfloat16(x):
+    '''
+    Rounds to the 8 significant bits of bfloat16.
+
+    Gradients are passed straight through the rounding.
+    '''
+    a = T.maximum(abs(x), np.float32(2 ** -126))
+    step = T.exp2(T.floor(T.log2(a)) - 7).astype(x.dtype)
+    x_r = T.round(x / step) * step
+    return x + theano.gradient.disconnected_grad(x_r - x)
+
+def reduce_precision(x, precision):
+    '''
+    `x` (e.g., weights or preactivations) at `precision`.
+
+    Binary samples are exact at any precision and are returned as they are.
+    Probabilities should be taken from reduced preactivations rather than
+    reduced themselves, as 1 - p rounds to 0 in float16 for p > 1 - 2**-12.
+    '''
+    check_precision(precision)
+    if precision == 'float32' or x.dtype in binary_dtypes:
+        return x
+    elif precision == 'float16':
+        return x.astype('float16')
+    else:
+        return round_bfloat16(x)
@@ -0,0 +1,64 @@
+'''
+Tests for binary samples and their products
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from utils import floatX
+from utils.binary import (
+    BinaryDot,
+    binary_samples,
+    dot,
+    unique_samples
+)
+
+
+def test_binary_dot(dim_in=13, dim_out=5):
+    H = T.tensor3('h', dtype='int8')
+    W = T.matrix('W', dtype=floatX)
+    w = np.random.normal(size=(dim_in, dim_out)).astype(floatX)
+
+    z = T.dot(H.astype(floatX), W)
+    f = theano.function([H, W], [dot(H, W), dot(H, W, sparse=True),
+                                 BinaryDot(max_density=1.)(H, W),
+                                 BinaryDot(max_density=0.)(H, W), z])
+    f_grad = theano.function([H, W], [T.grad(dot(H, W, sparse=True).sum(), W),
+                                      T.grad(z.sum(), W)])
+
+    for density in [0., 0.05, 0.5, 1.]:
+        h = (np.random.uniform(size=(3, 4, dim_in)) < density).astype('int8')
+        outs = f(h, w)
+        for out in outs[:-1]:
+            assert out.shape == (3, 4, dim_out)
+            np.testing.assert_allclose(out, outs[-1], rtol=1e-5, atol=1e-5)
+        g, g_z = f_grad(h, w)
+        np.testing.assert_allclose(g, g_z, rtol=1e-5, atol=1e-5)
+
+def test_binary_samples(n_samples=7, dim=5):
+    R = T.tensor3('r', dtype=floatX)
+    Q = T.matrix('q', dtype=floatX)
+    f = theano.function([R, Q], binary_samples(R, Q[None, :, :]))
+    r = np.random.uniform(size=(n_samples, 3, dim)).astype(floatX)
+    q = np.random.uniform(size=(3, dim)).astype(floatX)
+    h = f(r, q)
+    assert h.dtype == np.int8
+    np.testing.assert_array_equal(h, (r <= q[None, :, :]).astype('int8'))
+
+def test_unique_samples(n_samples=17, batch_size=4, dim=11):
+    H = T.tensor3('h', dtype='int8')
+    f = theano.function([H], unique_samples(H))
+
+    # Few distinct rows per example, shared across examples.
+    rows = (np.random.uniform(size=(3, dim)) < 0.5).astype('int8')
+    h = rows[np.random.randint(0, 3, size=(n_samples, batch_size))]
+    h_u, example, inverse = f(h)
+
+    assert h_u.dtype == np.int8
+    assert inverse.shape == (n_samples, batch_size)
+    np.testing.assert_array_equal(h_u[inverse], h)
+    np.testing.assert_array_equal(
+        example[inverse], np.tile(np.arange(batch_size), (n_samples, 1)))
+    n_unique = sum(len(set(map(tuple, h[:, b]))) for b in xrange(batch_size))
+    assert h_u.shape == (n_unique, dim)
@@ -0,0 +1,76 @@
+'''
+Tests for flat parameter buffers.
+'''
+
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano import tensor as T
+
+from models.tests import test_sbn
+from utils import floatX
+from utils import op
+from utils.flat_params import FlatParams
+from utils.tools import itemlist
+
+
+def test_views(dim_in=11, dim_h=7):
+    model = test_sbn.test_build_sbn(dim_in, dim_h)
+    tparams = model.set_tparams()
+    values = OrderedDict((k, v.get_value()) for k, v in tparams.iteritems())
+    flat = FlatParams(model, tparams)
+
+    assert flat.buffer.get_value().size == sum(v.size for v in values.values())
+    assert flat.views.keys() == tparams.keys()
+    # Sublayers use the views.
+    assert model.conditional.W0 is flat.views['sbn_conditional_W0']
+    assert model.prior.z is flat.views['binomial_z']
+
+    f = theano.function([], flat.views.values())
+    for (k, v), v_f, v_g in zip(values.iteritems(), f(),
+                                flat.get_values().values()):
+        np.testing.assert_array_equal(v, v_f)
+        np.testing.assert_array_equal(v, v_g)
+
+def test_optimizers(batch_size=5, n_posterior_samples=3, learning_rate=0.01):
+    x = np.random.randint(0, 2, size=(batch_size, 11)).astype(floatX)
+    X = T.matrix('x', dtype=floatX)
+
+    for optimizer in ['sgd', 'rmsprop', 'adam2']:
+        values = []
+        for flat in [False, True]:
+            np.random.seed(0)
+            model = test_sbn.test_build_sbn()
+            tparams = model.set_tparams()
+            if flat:
+                for v, v_0 in zip(tparams.values(), init_values):
+                    v.set_value(v_0)
+            else:
+                init_values = [v.get_value() for v in tparams.values()]
+            r = np.random.uniform(
+                size=(n_posterior_samples, batch_size, 7)).astype(floatX)
+            test_sbn.fix_samples(model, r)
+
+            if flat:
+                flat_params = FlatParams(model, tparams)
+                tparams = flat_params.views
+            results, _, _ = model(X, X, n_posterior_samples=n_posterior_samples)
+            grads = T.grad(results['cost'], wrt=itemlist(tparams))
+            if flat:
+                grads = [flat_params.flatten(grads)]
+                tparams = OrderedDict(params=flat_params.buffer)
+
+            lr = T.scalar('lr')
+            f_grad_shared, f_update = getattr(op, optimizer)(
+                lr, tparams, grads, [X], results['cost'])
+            for _ in xrange(3):
+                f_grad_shared(x)
+                f_update(learning_rate)
+
+            if flat:
+                values.append(flat_params.get_values().values())
+            else:
+                values.append([v.get_value() for v in tparams.values()])
+
+        for v, v_f in zip(*values):
+            np.testing.assert_allclose(v, v_f, rtol=1e-5, atol=1e-6)
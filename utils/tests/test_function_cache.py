@@ -0,0 +1,112 @@
+'''
+Tests for the compiled function cache
+'''
+
+from collections import OrderedDict
+import numpy as np
+from os import path
+import shutil
+import tempfile
+import theano
+from theano import tensor as T
+
+from inference.air import AIR
+from models.tests import test_sbn
+from utils import floatX
+from utils import function_cache
+from utils import op
+from utils.function_cache import (
+    cached_functions,
+    get_key,
+    model_signature
+)
+from utils.tools import itemlist
+
+
+def test_key(dim_in=11, dim_h=7):
+    model = test_sbn.test_build_sbn(dim_in, dim_h)
+    model_o = test_sbn.test_build_sbn(dim_in, dim_h + 1)
+
+    key = get_key(model=model_signature(model), n_posterior_samples=10)
+    assert key == get_key(model=model_signature(model), n_posterior_samples=10)
+    assert key != get_key(model=model_signature(model), n_posterior_samples=11)
+    assert key != get_key(model=model_signature(model_o), n_posterior_samples=10)
+
+def test_source_key():
+    assert 'irvi' in function_cache._source_dirs
+
+    # Editing a builder module changes the key.
+    source_dir = tempfile.mkdtemp()
+    source_dirs = function_cache._source_dirs
+    try:
+        function_cache._source_dirs = source_dirs + [source_dir]
+        builder = path.join(source_dir, 'builder.py')
+        with open(builder, 'w') as f:
+            f.write('cost = results["cost"]\n')
+        key = get_key(n_posterior_samples=10)
+        assert key == get_key(n_posterior_samples=10)
+
+        with open(builder, 'w') as f:
+            f.write('cost = results["cost"] + l2_cost\n')
+        assert key != get_key(n_posterior_samples=10)
+    finally:
+        function_cache._source_dirs = source_dirs
+        shutil.rmtree(source_dir)
+
+def test_cache(dim_in=11, dim_h=7, batch_size=5):
+    cache_dir = tempfile.mkdtemp()
+    x = np.random.randint(0, 2, size=(batch_size, dim_in)).astype(floatX)
+
+    def setup():
+        model = test_sbn.test_build_sbn(dim_in, dim_h)
+        tparams = model.set_tparams()
+        X = T.matrix('x', dtype=floatX)
+
+        def build():
+            air = AIR(model, n_inference_steps=3, n_inference_samples=5)
+            i_results, constants, updates = air.inference(X, X)
+            results, _, _ = model(X, X, i_results['qk'], n_posterior_samples=5)
+            cost = results['cost']
+            grads = T.grad(cost, wrt=itemlist(tparams),
+                           consider_constant=constants)
+            lr = T.scalar(name='lr')
+            f_grad_shared, f_grad_updates = op.rmsprop(
+                lr, tparams, grads, [X], cost, extra_ups=updates)
+            f_test = theano.function([X], results['-log p(x|h)'])
+            return OrderedDict(f_grad_shared=f_grad_shared,
+                               f_grad_updates=f_grad_updates,
+                               f_test=f_test)
+
+        return model, tparams, build
+
+    try:
+        model, tparams, build = setup()
+        key = get_key(model=model_signature(model))
+        functions, shared = cached_functions(cache_dir, key, tparams, build)
+        assert shared is tparams
+
+        model_c, tparams_c, build_c = setup()
+        for k, v in tparams.iteritems():
+            tparams_c[k].set_value(v.get_value())
+
+        def fail():
+            raise AssertionError('Cached functions were rebuilt')
+
+        functions_c, shared_c = cached_functions(
+            cache_dir, key, tparams_c, fail, model=model_c)
+        assert shared_c is not tparams_c
+        # The model now uses the loaded shared variables.
+        assert model_c.conditional.W0 is shared_c['sbn_conditional_W0']
+
+        for k, v in tparams.iteritems():
+            np.testing.assert_allclose(v.get_value(), shared_c[k].get_value())
+        np.testing.assert_allclose(
+            functions['f_test'](x), functions_c['f_test'](x), rtol=1e-5)
+
+        # Training through the cached functions updates the returned params.
+        W0 = shared_c['sbn_conditional_W0'].get_value()
+        functions_c['f_grad_shared'](x)
+        functions_c['f_grad_updates'](0.01)
+        assert not np.allclose(W0, shared_c['sbn_conditional_W0'].get_value())
+    finally:
+        shutil.rmtree(cache_dir)
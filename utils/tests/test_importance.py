@@ -0,0 +1,74 @@
+'''
+Tests for fused importance weight ops.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from utils import floatX
+from utils.binary import binary_samples
+from utils.importance import (
+    normalized_weights,
+    weighted_sum
+)
+from utils.tools import log_sum_exp
+
+
+def test_normalized_weights(n_samples=13, batch_size=7):
+    L = T.matrix('log_w', dtype=floatX)
+    C = T.matrix('c', dtype=floatX)
+    log_z, w_tilde = normalized_weights(L)
+    log_z_r = log_sum_exp(L, axis=0)
+    w_tilde_r = T.exp(L - log_z_r[None, :])
+
+    # Both outputs and either output alone.
+    costs = [log_z.sum() + (C * w_tilde).sum(), log_z.sum(),
+             (C * w_tilde).sum()]
+    costs_r = [log_z_r.sum() + (C * w_tilde_r).sum(), log_z_r.sum(),
+               (C * w_tilde_r).sum()]
+    f = theano.function([L, C], [log_z, w_tilde] + [T.grad(c, L) for c in costs])
+    f_r = theano.function([L, C], [log_z_r, w_tilde_r]
+                          + [T.grad(c, L) for c in costs_r])
+
+    log_w = np.random.normal(scale=50., size=(n_samples, batch_size)).astype(floatX)
+    c = np.random.normal(size=(n_samples, batch_size)).astype(floatX)
+    for v, v_r in zip(f(log_w, c), f_r(log_w, c)):
+        np.testing.assert_allclose(v, v_r, rtol=1e-4, atol=1e-5)
+
+    # Strided inputs.
+    for v, v_r in zip(f(np.asfortranarray(log_w), c), f_r(log_w, c)):
+        np.testing.assert_allclose(v, v_r, rtol=1e-4, atol=1e-5)
+
+    f_py = theano.function([L], list(normalized_weights(L)),
+                           mode=theano.compile.mode.Mode(linker='py'))
+    for v, v_r in zip(f_py(log_w), f(log_w, c)[:2]):
+        np.testing.assert_allclose(v, v_r, rtol=1e-5, atol=1e-6)
+
+def test_weighted_sum(n_samples=13, batch_size=7, dim=5):
+    W = T.matrix('w', dtype=floatX)
+    R = T.tensor3('r', dtype=floatX)
+    G = T.matrix('g', dtype=floatX)
+    H = binary_samples(R, 0.3)
+    rvals = []
+    for h in [H, R]:
+        y = weighted_sum(W, h)
+        y_r = (W[:, :, None] * h).sum(axis=0)
+        wrt = [W] + ([R] if h is not H else [])
+        f = theano.function([W, R, G], [y] + T.grad((G * y).sum(), wrt),
+                            on_unused_input='ignore')
+        f_r = theano.function([W, R, G], [y_r] + T.grad((G * y_r).sum(), wrt),
+                              on_unused_input='ignore')
+        rvals.append((f, f_r))
+
+    w = np.random.uniform(size=(n_samples, batch_size)).astype(floatX)
+    w[0] = 0.
+    r = np.random.uniform(size=(n_samples, batch_size, dim)).astype(floatX)
+    g = np.random.normal(size=(batch_size, dim)).astype(floatX)
+    for f, f_r in rvals:
+        for v, v_r in zip(f(w, r, g), f_r(w, r, g)):
+            np.testing.assert_allclose(v, v_r, rtol=1e-5, atol=1e-5)
+        # Strided inputs.
+        for v, v_r in zip(f(np.asfortranarray(w), np.asfortranarray(r), g),
+                          f_r(w, r, g)):
+            np.testing.assert_allclose(v, v_r, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,43 @@
+'''
+Tests for the posterior cache
+'''
+
+import numpy as np
+from os import path
+import shutil
+import tempfile
+
+from utils.posterior_cache import PosteriorCache
+
+
+def test_posterior_cache(n_examples=17, dim=5):
+    cache_dir = tempfile.mkdtemp()
+    cache_file = path.join(cache_dir, 'q.npy')
+    idx = np.array([3, 11, 0])
+    q = np.random.uniform(size=(3, dim)).astype('float32')
+
+    try:
+        cache = PosteriorCache(cache_file, n_examples, dim)
+        assert np.isnan(cache.get(idx)).all()
+        cache.set(idx, q)
+        cache.flush()
+        assert cache.n_filled() == 3
+
+        # Persists across instances, at float16 precision.
+        cache = PosteriorCache(cache_file, n_examples, dim)
+        np.testing.assert_allclose(cache.get(idx), q, atol=1e-3)
+        assert cache.n_filled() == 3
+
+        # A fresh model starts from an empty cache.
+        cache = PosteriorCache(cache_file, n_examples, dim, reset=True)
+        assert np.isnan(cache.get(idx)).all()
+        assert cache.n_filled() == 0
+
+        try:
+            PosteriorCache(cache_file, n_examples + 1, dim)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Shape mismatch was not detected')
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,55 @@
+'''
+Tests for reduced precision storage.
+'''
+
+import numpy as np
+import theano
+from theano import tensor as T
+
+from utils import floatX
+from utils.precision import (
+    reduce_precision,
+    round_bfloat16,
+    storage_dtype,
+    upcast
+)
+from utils.tools import log_sum_exp
+
+
+def test_reduce_precision():
+    Z = T.vector('z', dtype=floatX)
+    z = np.array([-20., -1. / 3, 0., 0.3, 12.], dtype=floatX)
+
+    f = theano.function([Z], [reduce_precision(Z, 'float16'),
+                              T.nnet.sigmoid(upcast(reduce_precision(
+                                  Z, 'float16')))])
+    z16, p16 = f(z)
+    assert z16.dtype == storage_dtype('float16')
+    np.testing.assert_allclose(z16, z, rtol=2 ** -11)
+    # Probabilities from float16 preactivations are not clipped.
+    assert p16.dtype == 'float32'
+    assert np.log1p(-p16[-1]) < np.log(2 ** -12), p16
+
+    f = theano.function([Z], [reduce_precision(Z, 'bfloat16'),
+                              T.grad(round_bfloat16(Z).sum(), Z)])
+    zb, grad = f(z)
+    assert zb.dtype == floatX
+    np.testing.assert_allclose(zb, z, rtol=2 ** -8)
+    # 8 significant bits: the rounded mantissa has no lower bits set.
+    m, _ = np.frexp(zb)
+    np.testing.assert_array_equal(m * 2 ** 8, np.round(m * 2 ** 8))
+    np.testing.assert_array_equal(grad, np.ones_like(z))
+
+    # Binary samples are exact and kept.
+    H = T.matrix('h', dtype='int8')
+    assert reduce_precision(H, 'float16') is H
+
+def test_log_sum_exp_float16():
+    X = T.matrix('x', dtype='float16')
+    y = log_sum_exp(X, axis=0)
+    assert y.dtype == 'float32'
+
+    x = np.random.normal(scale=100., size=(1000, 3)).astype('float16')
+    x_max = x.astype('float64').max(axis=0)
+    y_np = np.log(np.exp(x.astype('float64') - x_max).sum(axis=0)) + x_max
+    np.testing.assert_allclose(theano.function([X], y)(x), y_np, rtol=1e-5)
@@ -14,6 +14,8 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 import warnings
 import yaml
 
+from utils.precision import upcast
+
 
 floatX = theano.config.floatX
 pi = theano.shared(np.pi).astype(floatX)
@@ -219,6 +221,15 @@ def check_bad_nums(rvals, names):
             found = True
     return found
 
+def steps_histogram(n_steps, max_steps=None):
+    '''
+    Histogram of the number of inference steps used per example.
+    '''
+    n_steps = np.asarray(n_steps).astype('int64').flatten()
+    if max_steps is None:
+        max_steps = n_steps.max()
+    return np.bincount(n_steps, minlength=max_steps + 1)
+
 def flatten_dict(d):
     rval = OrderedDict()
     for k, v in d.iteritems():
@@ -283,6 +294,7 @@ def log_mean_exp(x, axis=None, as_numpy=False):
         Te = np
     else:
         Te = T
+        x = upcast(x)
     x_max = Te.max(x, axis=axis, keepdims=True)
     return Te.log(Te.mean(Te.exp(x - x_max), axis=axis, keepdims=True)) + x_max
 
@@ -290,11 +302,34 @@ def log_sum_exp(x, axis=None):
     '''
     Numerically stable log( sum( exp(A) ) ).
     '''
+    x = upcast(x)
     x_max = T.max(x, axis=axis, keepdims=True)
     y = T.log(T.sum(T.exp(x - x_max), axis=axis, keepdims=True)) + x_max
     y = T.sum(y, axis=axis)
     return y
 
+def online_log_sum_exp(x, x_max, x_sum, values=[], value_sums=[]):
+    '''
+    One chunk of a streaming `log_sum_exp` over axis 0.
+
+    Carries a running max and a sum of exponentials relative to it, so that
+    `x_max + log(x_sum)` is the log_sum_exp of every chunk seen so far, with
+    the same gradient: the max is held constant, which leaves the gradient
+    of the log-sum-exp unchanged. Each of `values` is accumulated as an
+    exp(x)-weighted sum in `value_sums` (on the same scale as `x_sum`), with
+    the weights held constant for gradients.
+    '''
+    x         = upcast(x)
+    x_max_new = theano.gradient.disconnected_grad(
+        T.maximum(x_max, T.max(x, axis=0)))
+    scale     = T.exp(x_max - x_max_new)
+    e         = T.exp(x - x_max_new[None, :])
+    x_sum     = x_sum * scale + e.sum(axis=0)
+    w         = theano.gradient.disconnected_grad(e)
+    value_sums = [value_sum * scale + (w * value).sum(axis=0)
+                  for value, value_sum in zip(values, value_sums)]
+    return x_max_new, x_sum, value_sums
+
 def concatenate(tensor_list, axis=0):
     """
     Alternative implementation of `theano.T.concatenate`.